@@ -0,0 +1,96 @@
+import argparse
+import random
+import time
+import yaml
+import numpy as np
+from manager.manager import Manager
+from mdp_label_wrappers.cooperative_buttons_mdp_labeled import CooperativeButtonsLabeled
+from mdp_label_wrappers.four_buttons_mdp_labeled import FourButtonsLabeled
+from mdp_label_wrappers.repairs_task_mdp_labeled import RepairsTaskLabeled
+from reward_machines.sparse_reward_machine import SparseRewardMachine
+from pettingzoo_product_env.buttons_product_env import ButtonsProductEnv
+from pettingzoo_product_env.vectorized_buttons_product_env import VectorizedButtonsProductEnv
+
+### Step throughput of the buttons product environments ###
+# Runs random actions through ButtonsProductEnv (no learning) and reports env steps per second
+# and MDP transitions (labeled_mdp.environment_step calls) per agent step.
+# Example: python benchmark_env_step.py --experiment_name cooperative_buttons --steps 20000
+# With --num_vec_envs N, VectorizedButtonsProductEnv steps N episodes at once instead (--steps batched steps).
+
+parser = argparse.ArgumentParser(description="Measure the step throughput of ButtonsProductEnv")
+parser.add_argument('--experiment_name', type=str, default="cooperative_buttons", help="Name of the buttons config/reward machine folder eg: cooperative_buttons, four_buttons, repairs_task")
+parser.add_argument('--decomposition_file', type=str, default="None", help="Reward machine file to step. Default is individual_{experiment_name}.txt")
+parser.add_argument('--add_mono_file', type=str, default="None", help="Provide a monolithic file for global statekeeping")
+parser.add_argument('--steps', type=int, default=20000, help="Number of env steps to time. Default is 20000")
+parser.add_argument('--seed', type=int, default=0, help="Seed for the actions and MDP slips. Default is 0")
+parser.add_argument('--num_vec_envs', type=int, default=0, help="Time VectorizedButtonsProductEnv with this many parallel episodes. Default is 0 (ButtonsProductEnv)")
+args = parser.parse_args()
+
+
+def make_env(args, num_vec_envs=0):
+    with open(f'config/buttons/{args.experiment_name}.yaml', 'r') as file:
+        run_config = yaml.safe_load(file)
+    run_config["render_mode"] = None
+    decomposition_file = args.decomposition_file if args.decomposition_file != "None" else f"individual_{args.experiment_name}.txt"
+    train_rm = SparseRewardMachine(f"reward_machines/buttons/{args.experiment_name}/{decomposition_file}")
+    train_rm.is_monolithic = True
+    mono_rm = SparseRewardMachine(f"reward_machines/buttons/{args.experiment_name}/{args.add_mono_file}") if args.add_mono_file != "None" else None
+    if mono_rm is not None:
+        mono_rm.is_monolithic = True
+    manager = Manager(num_agents=run_config['num_agents'], num_decomps=len(run_config["initial_rm_states"]), seed=args.seed)
+    if num_vec_envs > 0:
+        return VectorizedButtonsProductEnv(manager, eval(run_config['labeled_mdp_class']), train_rm, run_config, run_config['num_agents'], num_vec_envs=num_vec_envs, addl_mono_rm=mono_rm, seed=args.seed)
+    return ButtonsProductEnv(manager, eval(run_config['labeled_mdp_class']), train_rm, run_config, run_config['num_agents'], addl_mono_rm=mono_rm)
+
+
+def count_mdp_transitions(env):
+    '''
+    Wraps env.labeled_mdp.environment_step to count its calls, returns the counter {'calls': int}
+    '''
+    counter = {'calls': 0}
+    environment_step = env.labeled_mdp.environment_step
+    def counted_environment_step(*step_args):
+        counter['calls'] += 1
+        return environment_step(*step_args)
+    env.labeled_mdp.environment_step = counted_environment_step
+    return counter
+
+
+def benchmark(args, rng):
+    env = make_env(args)
+    counter = count_mdp_transitions(env)
+
+    env.reset()
+    agent_steps = 0
+    start = time.perf_counter()
+    for _ in range(args.steps):
+        if not env.agents:
+            env.reset()
+        actions = {agent: int(rng.integers(5)) for agent in env.agents}
+        agent_steps += len(actions)
+        env.step(actions)
+    elapsed = time.perf_counter() - start
+
+    print(f"{args.experiment_name}: {args.steps} steps in {elapsed:.2f}s, {args.steps / elapsed:.0f} steps/s, "
+          f"{counter['calls'] / max(agent_steps, 1):.2f} MDP transitions per agent step")
+
+
+def benchmark_vectorized(args, rng):
+    env = make_env(args, args.num_vec_envs)
+    env.reset()
+    start = time.perf_counter()
+    for _ in range(args.steps):
+        env.step(rng.integers(5, size=env.num_envs))
+    elapsed = time.perf_counter() - start
+
+    env_steps = args.steps * args.num_vec_envs
+    print(f"{args.experiment_name}: {env_steps} steps ({args.num_vec_envs} episodes at once) in {elapsed:.2f}s, {env_steps / elapsed:.0f} steps/s")
+
+
+if __name__ == "__main__":
+    random.seed(args.seed)
+    rng = np.random.default_rng(args.seed)
+    if args.num_vec_envs > 0:
+        benchmark_vectorized(args, rng)
+    else:
+        benchmark(args, rng)
@@ -0,0 +1,99 @@
+import argparse
+import itertools
+import numpy as np
+from reward_machines.sparse_reward_machine import SparseRewardMachine
+import reward_machines.task_assignment.bisimilarity_check as bs
+
+### Checks the compiled reward machine tables and the projection relation against the dict based API ###
+# Checks bs.get_relation against the fixpoint definition (reference_relation) on every event space of at most two
+# events, their complements and --num_event_spaces random ones.
+# Steps every (state, event) pair of a reward machine with step_batch and checks it against get_next_state,
+# get_reward and is_terminal_state, then adds transitions to it and checks that step_batch refuses the ids
+# taken before and agrees with the dicts again on ids taken after.
+# Example: python check_reward_machine.py --rm_file reward_machines/buttons/four_buttons/mono_four_buttons.txt
+
+parser = argparse.ArgumentParser(description="Check SparseRewardMachine.step_batch against the dict based API")
+parser.add_argument('--rm_file', type=str, default="reward_machines/buttons/four_buttons/mono_four_buttons.txt", help="Reward machine file to check")
+parser.add_argument('--num_event_spaces', type=int, default=100, help="Number of random event spaces to check get_relation on. Default is 100")
+parser.add_argument('--seed', type=int, default=0, help="Seed for the random event spaces. Default is 0")
+args = parser.parse_args()
+
+
+def reference_relation(event_space, rm):
+    '''
+    The relation of Cyrus' paper (above Def 2) as a fixpoint: states joined by an event outside event_space are
+    related, then the successors of related states under each event in event_space, until nothing changes
+    '''
+    relation = bs.EquivalenceRelation()
+    for u1, u2 in itertools.combinations_with_replacement(rm.U, 2):
+        if u1 == u2 or any(rm.delta_u.get(u1, {}).get(e) == u2 or rm.delta_u.get(u2, {}).get(e) == u1 for e in rm.events - event_space):
+            relation.add_relation((u1, u2))
+    checked_combos = set()
+    all_related_combos = relation.get_all_related_combos()
+    while all_related_combos:
+        for u1, v1 in all_related_combos:
+            for e in event_space:
+                if rm.is_event_available(u1, e) and rm.is_event_available(v1, e):
+                    relation.add_relation((rm.delta_u[u1][e], rm.delta_u[v1][e]))
+            checked_combos.update(((u1, v1), (v1, u1)))
+        all_related_combos = relation.get_all_related_combos() - checked_combos
+    return relation
+
+
+def check_relations(rm, rng):
+    '''
+    Checks that bs.get_relation gives the classes of reference_relation
+    '''
+    events = sorted(rm.events)
+    event_spaces = [set(c) for k in range(3) for c in itertools.combinations(events, k)]
+    event_spaces += [set(events) - event_space for event_space in event_spaces]
+    event_spaces += [{e for e in events if rng.random() < 0.5} for _ in range(args.num_event_spaces)]
+    for event_space in event_spaces:
+        found = {frozenset(cl) for cl in bs.get_relation(event_space, rm).classes}
+        expected = {frozenset(cl) for cl in reference_relation(event_space, rm).classes}
+        if found != expected:
+            raise Exception(f"Event space {sorted(event_space)}: get_relation gives {found}, the fixpoint gives {expected}")
+    return len(event_spaces)
+
+
+def check_step_batch(rm, events):
+    '''
+    Checks step_batch on every state of rm against the dicts, for each event of events (known or not)
+    '''
+    for e in events:
+        rm.get_null_event_id() # compiles, so that id_to_state also lists the states only the dicts know
+        states = list(rm.id_to_state)
+        next_ids, rewards, is_terminal = rm.step_batch(rm.get_state_ids(states), rm.get_event_ids([e] * len(states)))
+        for u, next_id, reward, terminal in zip(states, next_ids, rewards, is_terminal):
+            u2 = rm.get_next_state(u, e)
+            expected = (u2, rm.get_reward(u, u2), rm.is_terminal_state(u2))
+            found = (rm.get_state_from_id(next_id), reward, bool(terminal))
+            if expected != found:
+                raise Exception(f"State {u}, event {e}: step_batch gives {found}, the dicts give {expected}")
+
+
+if __name__ == "__main__":
+    rm = SparseRewardMachine(args.rm_file)
+    num_event_spaces = check_relations(rm, np.random.default_rng(args.seed))
+    print(f"{args.rm_file}: get_relation matches the fixpoint on {num_event_spaces} event spaces")
+
+    events = sorted(rm.events) + ["unknown"]
+    check_step_batch(rm, events)
+
+    # an event sorting first shifts the ids of all the others, the old ones must not be stepped on the new tables
+    new_event = "0" + min(rm.events, key=str)
+    state_ids, event_ids = rm.get_state_ids([rm.u0]), rm.get_event_ids([max(rm.events)])
+    rm.add_transition_open(rm.u0, rm.u0, new_event, 0)
+    try:
+        rm.step_batch(state_ids, event_ids)
+    except ValueError:
+        pass
+    else:
+        raise Exception("step_batch accepted ids taken before the reward machine changed")
+    check_step_batch(rm, events + [new_event])
+
+    # a new state changes the state ids
+    new_state, other_event = max(rm.U) + 1, "1" + new_event
+    rm.add_transition_and_reward_only(rm.u0, new_state, other_event, 1)
+    check_step_batch(rm, events + [new_event, other_event])
+    print(f"{args.rm_file}: step_batch matches the dicts on {len(rm.id_to_state)} states and {len(rm.id_to_event)} events, before and after adding transitions")
@@ -0,0 +1,217 @@
+import argparse
+import random
+import yaml
+import numpy as np
+from manager.manager import Manager
+from mdp_label_wrappers.cooperative_buttons_mdp_labeled import CooperativeButtonsLabeled
+from mdp_label_wrappers.four_buttons_mdp_labeled import FourButtonsLabeled
+from mdp_label_wrappers.repairs_task_mdp_labeled import RepairsTaskLabeled
+from reward_machines.sparse_reward_machine import SparseRewardMachine
+from reward_machines.rm_generator import generate_rm_decompositions
+from pettingzoo_product_env.buttons_product_env import ButtonsProductEnv
+from pettingzoo_product_env.vectorized_buttons_product_env import VectorizedButtonsProductEnv
+
+### Checks VectorizedButtonsProductEnv against ButtonsProductEnv ###
+# Steps --num_vec_envs ButtonsProductEnvs one after the other and one VectorizedButtonsProductEnv with the
+# same random actions and slips (python_random), each with its own UCB manager, and checks that every step
+# gives the same observations, rewards, dones and terminations (vs truncations).
+# An episode is done on the step ButtonsProductEnv ends it on. supersuit's black_death_v3 adds an all zero
+# step after that, which VectorizedButtonsProductEnv leaves out, so that step is not compared.
+# With one episode at once the managers also have to end up with the same counts and rewards (with more,
+# ButtonsProductEnv rewards the decomposition assigned last instead of the one the episode used).
+# Random actions rarely finish an episode, so the reward machines are also compared on their own: both envs'
+# step_reward_machines get the same random label streams (--label_steps steps, every event of the reward machines
+# plus an unknown one, each emitted by a random subset of the episodes), and must give the same rewards,
+# terminations and rm states. Episodes that terminate are reset with the manager reward ButtonsProductEnv gives.
+# Example: python check_vectorized_env.py --experiment_name repairs_task --add_mono_file mono_repairs_task.txt
+
+parser = argparse.ArgumentParser(description="Check that VectorizedButtonsProductEnv steps like ButtonsProductEnv")
+parser.add_argument('--experiment_name', type=str, default="cooperative_buttons", help="Name of the buttons config/reward machine folder eg: cooperative_buttons, four_buttons, repairs_task")
+parser.add_argument('--decomposition_file', type=str, default="None", help="Reward machine file to step. Default is individual_{experiment_name}.txt")
+parser.add_argument('--add_mono_file', type=str, default="None", help="Provide a monolithic file for global statekeeping")
+parser.add_argument('--num_candidates', type=int, default=0, help="Step this many generated decompositions of the reward machine, as run.py does. Default is 0 (the file as is)")
+parser.add_argument('--num_vec_envs', type=int, default=1, help="Number of episodes stepped at once. Default is 1")
+parser.add_argument('--steps', type=int, default=5000, help="Number of env steps to compare. Default is 5000")
+parser.add_argument('--test', action='store_true', help="Compare the envs in test mode (as the eval env)")
+parser.add_argument('--label_steps', type=int, default=2000, help="Number of random label steps to compare step_reward_machines on. Default is 2000")
+parser.add_argument('--seed', type=int, default=0, help="Seed for the actions, MDP slips and labels. Default is 0")
+args = parser.parse_args()
+
+
+def load_run_config(args):
+    '''
+    Returns (run_config, train_rm, mono_rm) set up like run.py does
+    '''
+    with open(f'config/buttons/{args.experiment_name}.yaml', 'r') as file:
+        run_config = yaml.safe_load(file)
+    run_config["render_mode"] = None
+    decomposition_file = args.decomposition_file if args.decomposition_file != "None" else f"individual_{args.experiment_name}.txt"
+    train_rm = SparseRewardMachine(f"reward_machines/buttons/{args.experiment_name}/{decomposition_file}")
+    train_rm.is_monolithic = True
+    mono_rm = SparseRewardMachine(f"reward_machines/buttons/{args.experiment_name}/{args.add_mono_file}") if args.add_mono_file != "None" else None
+    if mono_rm is not None:
+        mono_rm.is_monolithic = True
+    if args.num_candidates > 0:
+        forbidden = {idx: fb for idx, fb in enumerate(run_config["forbidden_events"])}
+        required = {idx: req for idx, req in enumerate(run_config["required_events"])}
+        train_rm, rm_initial_states, _ = generate_rm_decompositions(train_rm, run_config['num_agents'], top_k=args.num_candidates,
+                                                                    enforced_dict=required, forbidden_dict=forbidden, config=run_config)
+        run_config["initial_rm_states"] = [[rm_initial_states[rm][agentidx] for agentidx in range(run_config['num_agents'])] for rm in rm_initial_states]
+        train_rm.find_max_subgraph_size_and_assign_subtasks()
+    return run_config, train_rm, mono_rm
+
+
+def make_manager(run_config):
+    return Manager(num_agents=run_config['num_agents'], num_decomps=len(run_config["initial_rm_states"]), assignment_method="UCB")
+
+
+def run_scalar(args, run_config, train_rm, mono_rm, actions):
+    '''
+    Steps num_vec_envs ButtonsProductEnvs, resetting each when it has no agents left.
+    Returns (manager, [(observations, rewards, dones, terminations) of every step in VecEnv slot order])
+    '''
+    manager = make_manager(run_config)
+    labeled_mdp_class = eval(run_config['labeled_mdp_class'])
+    envs = [ButtonsProductEnv(manager, labeled_mdp_class, train_rm, run_config, run_config['num_agents'], test=args.test, addl_mono_rm=mono_rm)
+            for _ in range(args.num_vec_envs)]
+    random.seed(args.seed)
+    for env in envs:
+        env.reset()
+
+    steps = []
+    for step_actions in actions:
+        observations, rewards, dones, terminations = [], [], [], []
+        for n, env in enumerate(envs):
+            agents = env.possible_agents
+            obs, r, term, _, _ = env.step({agent: int(step_actions[n*len(agents) + idx]) for idx, agent in enumerate(agents)})
+            done = not env.agents
+            terminated = done and all(term.values())
+            if done:
+                obs, _ = env.reset()
+            observations += [obs[agent] for agent in agents]
+            rewards += [r[agent] for agent in agents]
+            dones += [done] * len(agents)
+            terminations += [terminated] * len(agents)
+        steps.append((np.array(observations, dtype=np.float32), np.array(rewards, dtype=np.float32), np.array(dones), np.array(terminations)))
+    return manager, steps
+
+
+def run_vectorized(args, run_config, train_rm, mono_rm, actions):
+    '''
+    Same as run_scalar for one VectorizedButtonsProductEnv
+    '''
+    manager = make_manager(run_config)
+    env = VectorizedButtonsProductEnv(manager, eval(run_config['labeled_mdp_class']), train_rm, run_config, run_config['num_agents'],
+                                      num_vec_envs=args.num_vec_envs, test=args.test, addl_mono_rm=mono_rm, python_random=True)
+    random.seed(args.seed)
+    env.reset()
+
+    steps = []
+    for step_actions in actions:
+        observations, rewards, dones, infos = env.step(step_actions)
+        terminations = np.array([done and not info["TimeLimit.truncated"] for done, info in zip(dones, infos)])
+        steps.append((observations, rewards, dones, terminations))
+    return manager, steps
+
+
+def run_label_streams(args, run_config, train_rm, mono_rm):
+    '''
+    Steps the reward machines of num_vec_envs ButtonsProductEnvs and of one VectorizedButtonsProductEnv through
+    the same random labels and checks that they agree after every step.
+    Returns (scalar_manager, vectorized_manager, number of terminated episodes, total reward)
+    '''
+    num_agents = run_config['num_agents']
+    scalar_manager, vectorized_manager = make_manager(run_config), make_manager(run_config)
+    labeled_mdp_class = eval(run_config['labeled_mdp_class'])
+    envs = [ButtonsProductEnv(scalar_manager, labeled_mdp_class, train_rm, run_config, num_agents, test=args.test, addl_mono_rm=mono_rm)
+            for _ in range(args.num_vec_envs)]
+    vectorized_env = VectorizedButtonsProductEnv(vectorized_manager, labeled_mdp_class, train_rm, run_config, num_agents,
+                                                 num_vec_envs=args.num_vec_envs, test=args.test, addl_mono_rm=mono_rm)
+    # the decomposition of each scalar episode, so the manager rewards the one that episode used
+    random.seed(args.seed)
+    scalar_decomps = []
+    for env in envs:
+        env.reset()
+        scalar_decomps.append(scalar_manager.curr_decomp)
+    random.seed(args.seed)
+    vectorized_env.reset()
+
+    # the events of the transitions (rm.events is not filled in for generated decompositions)
+    events = {event for rm in (train_rm, mono_rm) if rm is not None for transitions in rm.delta_u.values() for event in transitions}
+    events = sorted(events, key=str) + ["unknown"]
+    rng = np.random.default_rng(args.seed)
+    time_steps = np.zeros(args.num_vec_envs, dtype=np.int64)
+    num_terminated, total_reward = 0, 0.0
+    for t in range(args.label_steps):
+        all_labels = [(events[k], rng.random(args.num_vec_envs) < 0.5) for k in rng.integers(len(events), size=rng.integers(1, 4))]
+        vectorized_rewards, vectorized_terminations = vectorized_env.step_reward_machines(all_labels)
+        time_steps += 1
+        finished, manager_rewards = [], []
+        for n, env in enumerate(envs):
+            rm_rewards, mono_reward = env.step_reward_machines(env.possible_agents, [event for event, mask in all_labels if mask[n]])
+            rewards = np.array([rm_rewards[agent] + mono_reward for agent in env.possible_agents])
+            if mono_rm is not None:
+                terminated = mono_rm.is_terminal_state(env.monolithic_rm_state)
+            else:
+                terminated = all(train_rm.is_terminal_state(env.rm_states[agent]) for agent in env.possible_agents)
+            rm_states = [env.rm_states[agent] for agent in env.possible_agents]
+            vectorized_rm_states = [train_rm.get_state_from_id(u_id) for u_id in vectorized_env.rm_state_ids[n]]
+            if mono_rm is not None:
+                rm_states.append(env.monolithic_rm_state)
+                vectorized_rm_states.append(mono_rm.get_state_from_id(vectorized_env.monolithic_rm_state_ids[n]))
+            if not np.allclose(rewards, vectorized_rewards[n]) or terminated != vectorized_terminations[n] or rm_states != vectorized_rm_states:
+                raise Exception(f"Label step {t}, episode {n}: ButtonsProductEnv gives rewards {rewards}, termination {terminated}, rm states {rm_states}, "
+                                f"VectorizedButtonsProductEnv {vectorized_rewards[n]}, {vectorized_terminations[n]}, {vectorized_rm_states}")
+            total_reward += float(rewards.sum())
+
+            truncated = time_steps[n] >= run_config["max_episode_length"]
+            if terminated or truncated:
+                num_terminated += int(terminated)
+                manager_reward = 0 if truncated else 1*run_config["gamma"]**int(time_steps[n])
+                scalar_manager.update_rewards(manager_reward, decomp=scalar_decomps[n])
+                env.reset()
+                scalar_decomps[n] = scalar_manager.curr_decomp
+                finished.append(n)
+                manager_rewards.append(manager_reward)
+        if finished:
+            vectorized_env.reset_episodes(np.array(finished), manager_rewards)
+            time_steps[finished] = 0
+    return scalar_manager, vectorized_manager, num_terminated, total_reward
+
+
+def check_managers(scalar_manager, vectorized_manager):
+    for name in ("decomp_counts", "decomp_total_rewards"):
+        if not np.allclose(list(getattr(scalar_manager, name).values()), list(getattr(vectorized_manager, name).values())):
+            raise Exception(f"Manager {name} differ, ButtonsProductEnv {getattr(scalar_manager, name)}, VectorizedButtonsProductEnv {getattr(vectorized_manager, name)}")
+
+
+if __name__ == "__main__":
+    run_config, train_rm, mono_rm = load_run_config(args)
+    rng = np.random.default_rng(args.seed)
+    actions = rng.integers(5, size=(args.steps, args.num_vec_envs * run_config['num_agents']))
+
+    scalar_manager, scalar_steps = run_scalar(args, run_config, train_rm, mono_rm, actions)
+    vectorized_manager, vectorized_steps = run_vectorized(args, run_config, train_rm, mono_rm, actions)
+
+    for t, (scalar, vectorized) in enumerate(zip(scalar_steps, vectorized_steps)):
+        for name, scalar_value, vectorized_value in zip(("observations", "rewards", "dones", "terminations"), scalar, vectorized):
+            differ = ~np.isclose(scalar_value, vectorized_value).reshape(len(scalar_value), -1).all(axis=1)
+            if differ.any():
+                slots = np.flatnonzero(differ)
+                raise Exception(f"Step {t}: {name} of slots {slots} differ, ButtonsProductEnv {scalar_value[slots]}, VectorizedButtonsProductEnv {vectorized_value[slots]}")
+    if args.num_vec_envs == 1:
+        check_managers(scalar_manager, vectorized_manager)
+
+    num_done = sum(int(dones.sum()) for _, _, dones, _ in scalar_steps) // run_config['num_agents']
+    num_terminated = sum(int(terminations.sum()) for _, _, _, terminations in scalar_steps) // run_config['num_agents']
+    total_reward = sum(float(rewards.sum()) for _, rewards, _, _ in scalar_steps)
+    print(f"{args.experiment_name}: {args.steps} steps of {args.num_vec_envs} episodes match, {num_done} episodes ended "
+          f"({num_terminated} terminated), total reward {total_reward:.2f}, UCB counts {scalar_manager.decomp_counts}")
+
+    if args.label_steps > 0:
+        scalar_manager, vectorized_manager, num_terminated, total_reward = run_label_streams(args, run_config, train_rm, mono_rm)
+        check_managers(scalar_manager, vectorized_manager)
+        if num_terminated == 0:
+            raise Exception(f"No episode terminated in {args.label_steps} label steps, the reward machines were not compared on terminations")
+        print(f"{args.experiment_name}: {args.label_steps} label steps of {args.num_vec_envs} episodes match, {num_terminated} episodes terminated, "
+              f"total reward {total_reward:.2f}, UCB total rewards {scalar_manager.decomp_total_rewards}")
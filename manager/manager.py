@@ -152,10 +152,13 @@ class Manager:
     
     
     ### FOR UCB ###
-    def update_rewards(self, reward):
-        self.decomp_total_rewards[self.curr_decomp] = self.decomp_total_rewards[self.curr_decomp] * self.ucb_gamma + reward
+    def update_rewards(self, reward, decomp=None):
+        # decomp: decomposition the finished episode used, by default the current one
+        if decomp is None:
+            decomp = self.curr_decomp
+        self.decomp_total_rewards[decomp] = self.decomp_total_rewards[decomp] * self.ucb_gamma + reward
         self.decomp_curr_rewards = {i: 0.0 for i in range(self.num_decomps)}
-        self.decomp_curr_rewards[self.curr_decomp] = reward
+        self.decomp_curr_rewards[decomp] = reward
     
     def calculate_ucb_value(self, decomp):
         if self.decomp_counts[decomp] == 0:
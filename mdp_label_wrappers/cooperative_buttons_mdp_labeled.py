@@ -16,26 +16,54 @@ class CooperativeButtonsLabeled(CooperativeButtonsEnv, MDP_Labeler):
 
         ## append real labels
         if (row, col) == self.env_settings["yellow_button"]:
-           CooperativeButtonsEnv.yellow_pressed = True
+           self.yellow_pressed = True
            l.append('by')
         elif (row, col) == self.env_settings["green_button"]:
-            CooperativeButtonsEnv.green_pressed = True
+            self.green_pressed = True
             l.append("bg")
         elif (row, col) == self.env_settings["red_button"] and agent_id == 2:
-            CooperativeButtonsEnv.a2_red_pressed = True
+            self.a2_red_pressed = True
             l.append("a2br")
         elif (row, col) == self.env_settings["red_button"] and agent_id == 3:
-            CooperativeButtonsEnv.a3_red_pressed = True
+            self.a3_red_pressed = True
             l.append("a3br")
         elif (row, col) == self.env_settings["goal_location"]:
             l.append("g")
-        elif CooperativeButtonsEnv.a2_red_pressed and not CooperativeButtonsEnv.red_pressed and agent_id == 2 and (row, col) != self.env_settings["red_button"]:
-            CooperativeButtonsEnv.a2_red_pressed = False
+        elif self.a2_red_pressed and not self.red_pressed and agent_id == 2 and (row, col) != self.env_settings["red_button"]:
+            self.a2_red_pressed = False
             l.append("a2lr")
-        elif CooperativeButtonsEnv.a3_red_pressed and not CooperativeButtonsEnv.red_pressed and agent_id == 3 and (row, col) != self.env_settings["red_button"]:
-            CooperativeButtonsEnv.a3_red_pressed = False
+        elif self.a3_red_pressed and not self.red_pressed and agent_id == 3 and (row, col) != self.env_settings["red_button"]:
+            self.a3_red_pressed = False
             l.append("a3lr")
-        if CooperativeButtonsEnv.a3_red_pressed and CooperativeButtonsEnv.a2_red_pressed:
+        if self.a3_red_pressed and self.a2_red_pressed:
             l.append("br")
-            CooperativeButtonsEnv.red_pressed = True
-        return l
\ No newline at end of file
+            self.red_pressed = True
+        return l
+
+    def get_mdp_label_batch(self, s_next, agent_id, world):
+        """
+        Return the labels of the next environment states of many episodes, see MDP_Labeler.get_mdp_label_batch.
+        """
+        at_yellow = s_next == self.get_state_from_description(*self.env_settings["yellow_button"])
+        at_green = s_next == self.get_state_from_description(*self.env_settings["green_button"])
+        at_red = s_next == self.get_state_from_description(*self.env_settings["red_button"])
+        at_goal = s_next == self.get_state_from_description(*self.env_settings["goal_location"])
+
+        ## append real labels, the locations are distinct so at most one of them matches
+        world["yellow_pressed"] |= at_yellow
+        world["green_pressed"] |= at_green
+        l = [('by', at_yellow), ('bg', at_green)]
+        if agent_id in (2, 3):
+            red_pressed = world[f"a{agent_id}_red_pressed"]
+            red_pressed |= at_red
+            l.append((f"a{agent_id}br", at_red))
+        l.append(('g', at_goal))
+        if agent_id in (2, 3):
+            left = red_pressed & ~world["red_pressed"] & ~(at_yellow | at_green | at_red | at_goal)
+            red_pressed &= ~left
+            l.append((f"a{agent_id}lr", left))
+
+        both_red_pressed = world["a2_red_pressed"] & world["a3_red_pressed"]
+        world["red_pressed"] |= both_red_pressed
+        l.append(('br', both_red_pressed))
+        return l
@@ -21,5 +21,11 @@ class FourButtonsLabeled(FourButtonsEnv, MDP_Labeler):
 
         return l
 
-    
-    
\ No newline at end of file
+    def get_mdp_label_batch(self, s_next, agent_id, world):
+        """
+        Return the labels of the next environment states of many episodes, see MDP_Labeler.get_mdp_label_batch.
+        """
+        l = []
+        for button, event in (('yellow_button', 'by'), ('green_button', 'bg'), ('red_button', 'br'), ('blue_button', 'bb')):
+            l.append((event, s_next == self.get_state_from_description(*self.env_settings[button])))
+        return l
@@ -7,4 +7,13 @@ class MDP_Labeler(ABC):
         """
         Return the label of the next environment state and current RM state.
         """
-        raise NotImplementedError
\ No newline at end of file
+        raise NotImplementedError
+
+    def get_mdp_label_batch(self, s_next, agent_id, world):
+        """
+        Return the labels of the next environment states s_next[n] of many episodes at once, 
+        as a list of (event, mask) in the order get_mdp_label emits them: episode n gets the 
+        events whose mask[n] is True. world is the batched world state of the MDP, updated in place.
+        Only needed by VectorizedButtonsProductEnv.
+        """
+        raise NotImplementedError
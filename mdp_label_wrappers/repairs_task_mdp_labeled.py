@@ -22,26 +22,49 @@ class RepairsTaskLabeled(RepairsTaskEnv, MDP_Labeler):
         elif (row, col) == self.env_settings["red_button"]:
             l.append("r")
         elif (row, col) == self.env_settings["hq_location"] and agent_id == 1:
-            RepairsTaskEnv.a1hq = True
+            self.a1hq = True
             l.append("a1hq")
         elif (row, col) == self.env_settings["hq_location"] and agent_id == 2:
-            RepairsTaskEnv.a2hq = True
+            self.a2hq = True
             l.append("a2hq")
         elif (row, col) == self.env_settings["hq_location"] and agent_id == 3:
-            RepairsTaskEnv.a3hq = True
+            self.a3hq = True
             l.append("a3hq")
-        elif RepairsTaskEnv.a1hq and not RepairsTaskEnv.signal and agent_id == 1 and (row, col) != self.env_settings["hq_location"]:
-            RepairsTaskEnv.a1hq = False
+        elif self.a1hq and not self.signal and agent_id == 1 and (row, col) != self.env_settings["hq_location"]:
+            self.a1hq = False
             l.append("!a1hq")
-        elif RepairsTaskEnv.a2hq and not RepairsTaskEnv.signal and agent_id == 2 and (row, col) != self.env_settings["hq_location"]:
-            RepairsTaskEnv.a2hq = False
+        elif self.a2hq and not self.signal and agent_id == 2 and (row, col) != self.env_settings["hq_location"]:
+            self.a2hq = False
             l.append("!a2hq")
-        elif RepairsTaskEnv.a3hq and not RepairsTaskEnv.signal and agent_id == 3 and (row, col) != self.env_settings["hq_location"]:
-            RepairsTaskEnv.a3hq = False
+        elif self.a3hq and not self.signal and agent_id == 3 and (row, col) != self.env_settings["hq_location"]:
+            self.a3hq = False
             l.append("!a3hq")
         
-        if (RepairsTaskEnv.a1hq and RepairsTaskEnv.a2hq) or (RepairsTaskEnv.a2hq and RepairsTaskEnv.a3hq) or (RepairsTaskEnv.a1hq and RepairsTaskEnv.a3hq):
-            RepairsTaskEnv.signal = True
+        if (self.a1hq and self.a2hq) or (self.a2hq and self.a3hq) or (self.a1hq and self.a3hq):
+            self.signal = True
             l.append("sig")
 
-        return l
\ No newline at end of file
+        return l
+
+    def get_mdp_label_batch(self, s_next, agent_id, world):
+        """
+        Return the labels of the next environment states of many episodes, see MDP_Labeler.get_mdp_label_batch.
+        """
+        at_yellow = s_next == self.get_state_from_description(*self.env_settings["yellow_button"])
+        at_green = s_next == self.get_state_from_description(*self.env_settings["green_button"])
+        at_red = s_next == self.get_state_from_description(*self.env_settings["red_button"])
+        at_hq = s_next == self.get_state_from_description(*self.env_settings["hq_location"])
+
+        # ## append real labels, the locations are distinct so at most one of them matches
+        l = [('y', at_yellow), ('g', at_green), ('r', at_red)]
+        if agent_id in (1, 2, 3):
+            in_hq = world[f"a{agent_id}hq"]
+            in_hq |= at_hq
+            left = in_hq & ~world["signal"] & ~(at_yellow | at_green | at_red | at_hq)
+            in_hq &= ~left
+            l += [(f"a{agent_id}hq", at_hq), (f"!a{agent_id}hq", left)]
+
+        signal = (world["a1hq"] & world["a2hq"]) | (world["a2hq"] & world["a3hq"]) | (world["a1hq"] & world["a3hq"])
+        world["signal"] |= signal
+        l.append(("sig", signal))
+        return l
@@ -6,6 +6,7 @@ import matplotlib.pyplot as plt
 import matplotlib.patches as patches
 import matplotlib.colors as mcolors
 import matplotlib.animation as animation
+from mdps.gridworld_transitions import GridworldTransitions
 
 
 """
@@ -18,7 +19,7 @@ class Actions(Enum):
     left  = 3 # move left
     none  = 4 # none 
 
-class CooperativeButtonsEnv:
+class CooperativeButtonsEnv(GridworldTransitions):
 
     def __init__(self, env_config):
         """
@@ -53,20 +54,28 @@ class CooperativeButtonsEnv:
         self.env_settings = env_settings
         self.p = env_settings["p"]
 
+        # world state of this instance's episode (set again by reset), kept per instance so several 
+        # envs in one process do not press each other's buttons
+        self.a2_red_pressed = False
+        self.a3_red_pressed = False
+        self.yellow_pressed = False
+        self.green_pressed = False
+        self.red_pressed = False
+        self.u = {} # {agent_id: rm state}
 
         self._load_map()
         self.fig, self.ax = None, None
 
     def reset(self, decomp_idx):
-        CooperativeButtonsEnv.a2_red_pressed = False
-        CooperativeButtonsEnv.a3_red_pressed = False
-        CooperativeButtonsEnv.yellow_pressed = False
-        CooperativeButtonsEnv.green_pressed = False
-        CooperativeButtonsEnv.red_pressed = False
+        self.a2_red_pressed = False
+        self.a3_red_pressed = False
+        self.yellow_pressed = False
+        self.green_pressed = False
+        self.red_pressed = False
 
-        rm_state_array = copy.deepcopy(self.env_settings["initial_rm_states"]) if np.array(self.env_settings["initial_rm_states"]).ndim == 2 else [copy.deepcopy(self.env_settings["initial_rm_states"])]
+        rm_state_array = self.env_settings["initial_rm_states"] if np.array(self.env_settings["initial_rm_states"]).ndim == 2 else [self.env_settings["initial_rm_states"]] # only read, no copy needed
 
-        CooperativeButtonsEnv.u = {i+1:rm_state_array[decomp_idx][i] for i in range(len(self.env_settings["initial_states"]))}
+        self.u = {i+1:rm_state_array[decomp_idx][i] for i in range(len(self.env_settings["initial_states"]))}
 
     def _load_map(self):
         """
@@ -108,6 +117,17 @@ class CooperativeButtonsEnv:
             self.forbidden_transitions.add((row+1, col, Actions.up))
             self.forbidden_transitions.add((row-1, col, Actions.down))
 
+        self.compile_transitions()
+        self.yellow_tile_mask = np.zeros(self.num_states, dtype=bool) # [s]
+        for (row, col) in self.yellow_tiles:
+            self.yellow_tile_mask[self.get_state_from_description(row, col)] = True
+        self.green_tile_mask = np.zeros(self.num_states, dtype=bool) # [s]
+        for (row, col) in self.green_tiles:
+            self.green_tile_mask[self.get_state_from_description(row, col)] = True
+        self.red_tile_mask = np.zeros(self.num_states, dtype=bool) # [s]
+        for (row, col) in self.red_tiles:
+            self.red_tile_mask[self.get_state_from_description(row, col)] = True
+
     def environment_step(self, s, a, agent_id):
         """
         Execute action a from state s.
@@ -151,65 +171,63 @@ class CooperativeButtonsEnv:
         last_action :int
             Last action taken by agent due to slip proability.
         """
-        slip_p = [self.p, (1-self.p)/2, (1-self.p)/2]
         check = random.random()
-
-        row, col = self.get_state_description(s)
-
-        # up    = 0
-        # right = 1 
-        # down  = 2 
-        # left  = 3 
-
-        if (check<=slip_p[0]) or (a == Actions.none.value):
-            a_ = a
-
-        elif (check>slip_p[0]) & (check<=(slip_p[0]+slip_p[1])):
-            if a == 0: 
-                a_ = 3
-            elif a == 2: 
-                a_ = 1
-            elif a == 3: 
-                a_ = 2
-            elif a == 1: 
-                a_ = 0
-
-        else:
-            if a == 0: 
-                a_ = 1
-            elif a == 2: 
-                a_ = 3
-            elif a == 3: 
-                a_ = 0
-            elif a == 1: 
-                a_ = 2
-
-        action_ = Actions(a_)
-        if (row, col, action_) not in self.forbidden_transitions:
-            if action_ == Actions.up:
-                row -= 1
-            if action_ == Actions.down:
-                row += 1
-            if action_ == Actions.left:
-                col -= 1
-            if action_ == Actions.right:
-                col += 1
-
-        s_next = self.get_state_from_description(row, col)
+        s_next, last_action = self.get_next_cell(s, a, check)
 
         # If the appropriate button hasn't yet been pressed, don't allow the agent into the colored region
         if agent_id == 1:
-            if (row, col) in self.red_tiles and not (CooperativeButtonsEnv.a2_red_pressed and CooperativeButtonsEnv.a3_red_pressed):
+            if self.red_tile_mask[s_next] and not (self.a2_red_pressed and self.a3_red_pressed):
                 s_next = s
         if agent_id == 2:
-            if (row, col) in self.yellow_tiles and not CooperativeButtonsEnv.yellow_pressed:
+            if self.yellow_tile_mask[s_next] and not self.yellow_pressed:
                 s_next = s
         if agent_id == 3:
-            if (row, col) in self.green_tiles and not CooperativeButtonsEnv.green_pressed:
+            if self.green_tile_mask[s_next] and not self.green_pressed:
                 s_next = s
 
-        last_action = a_
-        return s_next, last_action
+        return int(s_next), int(last_action)
+
+    def get_batch_world_state(self, num_envs):
+        """
+        Return the button flags of num_envs episodes after reset, {flag: bool array of shape (num_envs,)}.
+        """
+        return {flag: np.zeros(num_envs, dtype=bool) for flag in ('a2_red_pressed', 'a3_red_pressed', 'yellow_pressed', 'green_pressed', 'red_pressed')}
+
+    def environment_step_batch(self, s, a, agent_id, world, check):
+        """
+        Execute action a[n] from state s[n] in every episode n at once (environment_step of many episodes).
+
+        Parameters
+        ----------
+        s : np.ndarray
+            Current environment state of each episode.
+        a : np.ndarray
+            Action taken in each episode.
+        agent_id : int
+            Agent taking the actions.
+        world : dict
+            Button flags of the episodes (see get_batch_world_state).
+        check : np.ndarray
+            Uniform sample in [0, 1) of each episode deciding the slip (random.random() in get_next_state).
+
+        Outputs
+        -------
+        s_next : np.ndarray
+            Next state of each episode.
+        """
+        s_next, _ = self.get_next_cell(s, a, check)
+
+        # If the appropriate button hasn't yet been pressed, don't allow the agent into the colored region
+        if agent_id == 1:
+            gated = self.red_tile_mask[s_next] & ~(world['a2_red_pressed'] & world['a3_red_pressed'])
+        elif agent_id == 2:
+            gated = self.yellow_tile_mask[s_next] & ~world['yellow_pressed']
+        elif agent_id == 3:
+            gated = self.green_tile_mask[s_next] & ~world['green_pressed']
+        else:
+            return s_next
+
+        return np.where(gated, s, s_next)
 
     def get_state_from_description(self, row, col):
         """
@@ -6,6 +6,7 @@ import matplotlib.pyplot as plt
 import matplotlib.patches as patches
 import matplotlib.colors as mcolors
 import matplotlib.animation as animation
+from mdps.gridworld_transitions import GridworldTransitions
 
 class Actions(Enum):
     up    = 0 # move up
@@ -14,7 +15,7 @@ class Actions(Enum):
     left  = 3 # move left
     none  = 4 # none 
 
-class FourButtonsEnv():
+class FourButtonsEnv(GridworldTransitions):
 
     def __init__(self, env_config):
         """
@@ -89,6 +90,8 @@ class FourButtonsEnv():
             self.forbidden_transitions.add((row+1, col, Actions.up))
             self.forbidden_transitions.add((row-1, col, Actions.down))
 
+        self.compile_transitions()
+
     def reset(self,*args):
         ...
 
@@ -129,54 +132,42 @@ class FourButtonsEnv():
         last_action :int
             Last action taken by agent due to slip proability.
         """
-        slip_p = [self.p, (1-self.p)/2, (1-self.p)/2]
         check = random.random()
+        s_next, last_action = self.get_next_cell(s, a, check)
 
-        row, col = self.get_state_description(s)
+        return int(s_next), int(last_action)
 
-        # up    = 0
-        # right = 1 
-        # down  = 2 
-        # left  = 3 
+    def get_batch_world_state(self, num_envs):
+        """
+        Return the world state of num_envs episodes after reset. Four buttons keeps none.
+        """
+        return {}
 
-        if (check<=slip_p[0]) or (a == Actions.none.value):
-            a_ = a
+    def environment_step_batch(self, s, a, agent_id, world, check):
+        """
+        Execute action a[n] from state s[n] in every episode n at once (environment_step of many episodes).
 
-        elif (check>slip_p[0]) & (check<=(slip_p[0]+slip_p[1])):
-            if a == 0: 
-                a_ = 3
-            elif a == 2: 
-                a_ = 1
-            elif a == 3: 
-                a_ = 2
-            elif a == 1: 
-                a_ = 0
+        Parameters
+        ----------
+        s : np.ndarray
+            Current environment state of each episode.
+        a : np.ndarray
+            Action taken in each episode.
+        agent_id : int
+            Agent taking the actions.
+        world : dict
+            World state of the episodes (see get_batch_world_state), unused.
+        check : np.ndarray
+            Uniform sample in [0, 1) of each episode deciding the slip (random.random() in get_next_state).
 
-        else:
-            if a == 0: 
-                a_ = 1
-            elif a == 2: 
-                a_ = 3
-            elif a == 3: 
-                a_ = 0
-            elif a == 1: 
-                a_ = 2
-
-        action_ = Actions(a_)
-        if (row, col, action_) not in self.forbidden_transitions:
-            if action_ == Actions.up:
-                row -= 1
-            if action_ == Actions.down:
-                row += 1
-            if action_ == Actions.left:
-                col -= 1
-            if action_ == Actions.right:
-                col += 1
-
-        s_next = self.get_state_from_description(row, col)
-
-        last_action = a_
-        return s_next, last_action
+        Outputs
+        -------
+        s_next : np.ndarray
+            Next state of each episode.
+        """
+        s_next, _ = self.get_next_cell(s, a, check)
+
+        return s_next
 
     def get_state_from_description(self, row, col):
         """
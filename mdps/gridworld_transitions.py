@@ -0,0 +1,57 @@
+import numpy as np
+
+class GridworldTransitions:
+    """
+    Precomputed transitions of the slippery gridworld MDPs, shared by their scalar get_next_state
+    and their batched environment_step_batch.
+
+    A class using it provides num_states, p, forbidden_transitions (a set of (row, col, action)),
+    get_state_description and get_state_from_description, and calls compile_transitions once
+    forbidden_transitions is filled. Actions are numbered up = 0, right = 1, down = 2, left = 3, none = 4.
+    """
+
+    # (row, col) offset of each action
+    action_moves = [(-1, 0), (0, 1), (1, 0), (0, -1), (0, 0)]
+
+    # action taken when action a is chosen and it does not slip (slip 0) or slips to either side (1, 2)
+    slip_actions = np.array([[0, 3, 1], [1, 0, 2], [2, 1, 3], [3, 2, 0], [4, 4, 4]])
+
+    def compile_transitions(self):
+        """
+        Build next_cell[s, a], the state reached from state s by taking action a (s itself where
+        forbidden_transitions blocks the move), and slip_thresholds, the bounds of the slip intervals:
+        a uniform sample check slips by searchsorted(slip_thresholds, check).
+        """
+        forbidden = {(row, col, action.value) for (row, col, action) in self.forbidden_transitions}
+        self.next_cell = np.empty((self.num_states, len(self.action_moves)), dtype=np.int64)
+        for s in range(self.num_states):
+            row, col = self.get_state_description(s)
+            for a, (d_row, d_col) in enumerate(self.action_moves):
+                if (row, col, a) in forbidden:
+                    d_row, d_col = 0, 0
+                self.next_cell[s, a] = self.get_state_from_description(row + d_row, col + d_col)
+        self.slip_thresholds = np.array([self.p, self.p + (1-self.p)/2])
+
+    def get_next_cell(self, s, a, check):
+        """
+        Look up the state reached from state s when action a is chosen and the slip sample is check.
+        Works on single values and on arrays of them alike.
+
+        Parameters
+        ----------
+        s : int or np.ndarray
+            Index of the current state.
+        a : int or np.ndarray
+            Action to be taken from state s.
+        check : float or np.ndarray
+            Uniform sample in [0, 1) deciding whether the action slips.
+
+        Outputs
+        -------
+        s_next : np.int64 or np.ndarray
+            Index of the next state, before any button or region restrictions.
+        last_action : np.int64 or np.ndarray
+            Last action taken by agent due to slip proability.
+        """
+        last_action = self.slip_actions[a, np.searchsorted(self.slip_thresholds, check)]
+        return self.next_cell[s, last_action], last_action
@@ -6,6 +6,7 @@ import matplotlib.pyplot as plt
 import matplotlib.patches as patches
 import matplotlib.colors as mcolors
 import matplotlib.animation as animation
+from mdps.gridworld_transitions import GridworldTransitions
 
 """
 Enum with the actions that the agent can execute
@@ -17,7 +18,7 @@ class Actions(Enum):
     left  = 3 # move left
     none  = 4 # none 
 
-class RepairsTaskEnv:
+class RepairsTaskEnv(GridworldTransitions):
 
 
     def __init__(self, env_config):
@@ -56,22 +57,24 @@ class RepairsTaskEnv:
         env_settings['p'] = 0.98
         self.env_settings = env_settings
         self.p = env_settings["p"]
-        RepairsTaskEnv.in_hazard = None
+        # world state of this instance's episode (set again by reset), kept per instance so several 
+        # envs in one process do not share the hazard region or the hq signal
+        self.in_hazard = None
 
-        RepairsTaskEnv.signal = False
-        RepairsTaskEnv.a1hq = False
-        RepairsTaskEnv.a2hq = False
-        RepairsTaskEnv.a3hq = False
+        self.signal = False
+        self.a1hq = False
+        self.a2hq = False
+        self.a3hq = False
 
         self._load_map()
         self.fig, self.ax = None, None
 
     def reset(self, *args):
-        RepairsTaskEnv.in_hazard = None
-        RepairsTaskEnv.signal = False
-        RepairsTaskEnv.a1hq = False
-        RepairsTaskEnv.a2hq = False
-        RepairsTaskEnv.a3hq = False
+        self.in_hazard = None
+        self.signal = False
+        self.a1hq = False
+        self.a2hq = False
+        self.a3hq = False
         ...
 
     def _load_map(self):
@@ -112,6 +115,11 @@ class RepairsTaskEnv:
             self.forbidden_transitions.add((row+1, col, Actions.up))
             self.forbidden_transitions.add((row-1, col, Actions.down))
 
+        self.compile_transitions()
+        self.yellow_tile_mask = np.zeros(self.num_states, dtype=bool) # [s]
+        for (row, col) in self.yellow_tiles:
+            self.yellow_tile_mask[self.get_state_from_description(row, col)] = True
+
     def environment_step(self, s, a, agent_id):
         """
         Execute action a from state s.
@@ -155,69 +163,72 @@ class RepairsTaskEnv:
         last_action :int
             Last action taken by agent due to slip proability.
         """
-        slip_p = [self.p, (1-self.p)/2, (1-self.p)/2]
         check = random.random()
+        s_next, last_action = self.get_next_cell(s, a, check)
 
-        row, col = self.get_state_description(s)
-
-        # up    = 0
-        # right = 1 
-        # down  = 2 
-        # left  = 3 
-
-        if (check<=slip_p[0]) or (a == Actions.none.value):
-            a_ = a
-
-        elif (check>slip_p[0]) & (check<=(slip_p[0]+slip_p[1])):
-            if a == 0: 
-                a_ = 3
-            elif a == 2: 
-                a_ = 1
-            elif a == 3: 
-                a_ = 2
-            elif a == 1: 
-                a_ = 0
-
-        else:
-            if a == 0: 
-                a_ = 1
-            elif a == 2: 
-                a_ = 3
-            elif a == 3: 
-                a_ = 0
-            elif a == 1: 
-                a_ = 2
-
-        action_ = Actions(a_)
-        if (row, col, action_) not in self.forbidden_transitions:
-            if action_ == Actions.up:
-                row -= 1
-            if action_ == Actions.down:
-                row += 1
-            if action_ == Actions.left:
-                col -= 1
-            if action_ == Actions.right:
-                col += 1
-
-        s_next = self.get_state_from_description(row, col)
-
-        in_yellow = (row, col) in self.yellow_tiles
+        in_yellow = self.yellow_tile_mask[s_next]
 
         # check if agent is in the yellow region
-        if RepairsTaskEnv.in_hazard is None:
+        if self.in_hazard is None:
             if in_yellow:
-                RepairsTaskEnv.in_hazard = agent_id
-        elif RepairsTaskEnv.in_hazard == agent_id:
+                self.in_hazard = agent_id
+        elif self.in_hazard == agent_id:
             if not in_yellow:
-                RepairsTaskEnv.in_hazard = None
+                self.in_hazard = None
             
         # If there's already an agent in the yellow region, don't allow the agent into the yellow region
-        if RepairsTaskEnv.in_hazard is not None and RepairsTaskEnv.in_hazard != agent_id:
+        if self.in_hazard is not None and self.in_hazard != agent_id:
             if in_yellow:
                 s_next = s
 
-        last_action = a_
-        return s_next, last_action
+        return int(s_next), int(last_action)
+
+    def get_batch_world_state(self, num_envs):
+        """
+        Return the world state of num_envs episodes after reset, {name: array of shape (num_envs,)}.
+        in_hazard holds the id of the agent in the yellow region, 0 for none (None in the single episode state).
+        """
+        world = {flag: np.zeros(num_envs, dtype=bool) for flag in ('signal', 'a1hq', 'a2hq', 'a3hq')}
+        world['in_hazard'] = np.zeros(num_envs, dtype=np.int64)
+        return world
+
+    def environment_step_batch(self, s, a, agent_id, world, check):
+        """
+        Execute action a[n] from state s[n] in every episode n at once (environment_step of many episodes).
+
+        Parameters
+        ----------
+        s : np.ndarray
+            Current environment state of each episode.
+        a : np.ndarray
+            Action taken in each episode.
+        agent_id : int
+            Agent taking the actions.
+        world : dict
+            World state of the episodes (see get_batch_world_state), in_hazard is updated in place.
+        check : np.ndarray
+            Uniform sample in [0, 1) of each episode deciding the slip (random.random() in get_next_state).
+
+        Outputs
+        -------
+        s_next : np.ndarray
+            Next state of each episode.
+        """
+        s_next, _ = self.get_next_cell(s, a, check)
+
+        in_yellow = self.yellow_tile_mask[s_next]
+
+        # check if agent is in the yellow region
+        in_hazard = world['in_hazard']
+        enters = (in_hazard == 0) & in_yellow
+        leaves = (in_hazard == agent_id) & ~in_yellow
+        in_hazard[enters] = agent_id
+        in_hazard[leaves] = 0
+
+        # If there's already an agent in the yellow region, don't allow the agent into the yellow region
+        blocked = (in_hazard != 0) & (in_hazard != agent_id) & in_yellow
+
+        return np.where(blocked, s, s_next)
 
     def get_state_from_description(self, row, col):
         """
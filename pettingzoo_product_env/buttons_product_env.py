@@ -1,7 +1,6 @@
 from reward_machines.sparse_reward_machine import SparseRewardMachine
 from gymnasium.spaces import Discrete, Box
 import numpy as np
-import copy
 from mdp_label_wrappers.generic_mdp_labeled import MDP_Labeler
 import os
 from .pettingzoo_product_env import MultiAgentEnvironment
@@ -13,13 +12,12 @@ class ButtonsProductEnv(MultiAgentEnvironment):
 
     def __init__(self, manager, labeled_mdp_class: MDP_Labeler, reward_machine: SparseRewardMachine, 
                  config, max_agents, test=False, is_monolithic=False, addl_mono_rm: SparseRewardMachine=None, 
-                 render_mode=None, monolithic_weight=1.0, log_dir=None, video=False):
+                 render_mode=None, monolithic_weight=1.0, log_dir=None, video=False, record_trajectory=False, manager_key=None):
         
         super().__init__(manager, labeled_mdp_class, reward_machine, 
                          config, max_agents, test, is_monolithic, addl_mono_rm, 
-                         render_mode, monolithic_weight, log_dir, video)
+                         render_mode, monolithic_weight, log_dir, video, record_trajectory, manager_key)
         
-        ButtonsProductEnv.manager = manager
         self.is_monolithic = is_monolithic # deprecated
 
     def observation_space(self, agent):
@@ -38,14 +36,12 @@ class ButtonsProductEnv(MultiAgentEnvironment):
         self.time_step = 0
         self.traj_mdp_states = []
 
-        mdp_state_array = copy.deepcopy(self.env_config["initial_mdp_states"])
-        rm_array = copy.deepcopy(self.env_config["initial_rm_states"]) if np.array(self.env_config["initial_rm_states"]).ndim == 2 else [copy.deepcopy(self.env_config["initial_rm_states"])]
-
-        rm_state_array = [[self.reward_machine.get_one_hot_encoded_state(state, len(self.possible_agents), idx) for idx, state in enumerate(init_states)] for init_states in rm_array]
-
+        # states are ints, nothing needs to be copied out of the config
+        mdp_state_array = self.env_config["initial_mdp_states"]
+        rm_array, rm_state_array = self.get_initial_rm_states()
 
         if not self.local_manager:
-            self.local_manager = ButtonsProductEnv.manager
+            self.local_manager = self.manager
 
         if self.addl_monolithic_rm is not None:
             self.monolithic_rm_state = self.addl_monolithic_rm.get_initial_state()
@@ -61,7 +57,8 @@ class ButtonsProductEnv(MultiAgentEnvironment):
         infos = {agent: {} for agent in self.agents}
         self.state = observations
 
-        self.traj_mdp_states.append(copy.deepcopy(self.mdp_states))
+        if self.record_trajectory:
+            self.traj_mdp_states.append(dict(self.mdp_states))
 
         return observations, infos
 
@@ -72,10 +69,9 @@ class ButtonsProductEnv(MultiAgentEnvironment):
         rewards = {}
         infos = {}
 
-        old_rm_states = copy.deepcopy(self.rm_states)
-        old_mdp_states = copy.deepcopy(self.mdp_states)
-
+        # each agent takes its (possibly slipping) transition once, the labels and the stored next state come from it
         all_labels = []
+        next_mdp_states = {}
         for i in range(len(self.possible_agents)):
             if self.possible_agents[i] not in actions:
                 continue
@@ -83,47 +79,33 @@ class ButtonsProductEnv(MultiAgentEnvironment):
             s = self.mdp_states[curr_agent]
             a = actions[curr_agent]
             s_next = self.labeled_mdp.environment_step(s, a, i+1)
+            next_mdp_states[curr_agent] = s_next
             labels = self.labeled_mdp.get_mdp_label(s_next, i+1, self.rm_states[curr_agent], self.test, self.is_monolithic)
             all_labels.extend(labels)
 
-        mono_rm_reward = 0
+        stepped_agents = list(next_mdp_states)
+        rm_rewards, mono_rm_reward = self.step_reward_machines(stepped_agents, all_labels)
 
         for i in range(len(self.possible_agents)):
             if self.possible_agents[i] not in actions:
                 continue
 
             curr_agent = self.possible_agents[i]
-            s = self.mdp_states[curr_agent]
-            a = actions[curr_agent]
 
             #### FOR UPDATING AGENT FROM CURRENT STATE TO NEXT STATE ####
-            current_u = self.rm_states[curr_agent]
-            
-            s_next = self.labeled_mdp.environment_step(s, a, i+1)
-            self.mdp_states[curr_agent] = s_next
-
-            r = 0
-            for e in all_labels:
-                u2 = self.reward_machine.get_next_state(self.rm_states[curr_agent], e)
-                r = r + self.reward_machine.get_reward(self.rm_states[curr_agent], u2)
-                self.rm_states[curr_agent] = u2
-                if self.addl_monolithic_rm is not None:
-                    next_ms = self.addl_monolithic_rm.get_next_state(self.monolithic_rm_state, e) #TODO: check that the order invariance here doesn't matter
-                    mono_rm_reward += self.monolithic_weight*self.addl_monolithic_rm.get_reward(self.monolithic_rm_state, next_ms)
-                    self.monolithic_rm_state = next_ms
+            self.mdp_states[curr_agent] = next_mdp_states[curr_agent]
 
-    
+            r = rm_rewards[curr_agent]
 
             if hasattr(self.labeled_mdp, "u"):
                 self.labeled_mdp.u[i+1] = self.rm_states[curr_agent]
 
              #### FOR UPDATING AGENT FROM CURRENT STATE TO NEXT STATE ####
 
-    
-            observations[curr_agent] =  np.array([self.mdp_states[curr_agent], self.rm_states[curr_agent]])
             rewards[curr_agent] = r
 
-        self.traj_mdp_states.append(copy.deepcopy(self.mdp_states))    
+        if self.record_trajectory:
+            self.traj_mdp_states.append(dict(self.mdp_states))
 
         if self.addl_monolithic_rm is not None:
             for agent in rewards:
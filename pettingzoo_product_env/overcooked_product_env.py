@@ -4,7 +4,6 @@ from jaxmarl.viz.overcooked_visualizer import OvercookedVisualizer
 from gymnasium.spaces import Box, Discrete
 from mdp_label_wrappers.generic_mdp_labeled import MDP_Labeler
 from reward_machines.sparse_reward_machine import SparseRewardMachine
-import copy
 from datetime import datetime
 import wandb
 import os
@@ -16,12 +15,11 @@ class OvercookedProductEnv(MultiAgentEnvironment):
 
     def __init__(self, manager, labeled_mdp_class: MDP_Labeler, reward_machine: SparseRewardMachine, 
                  config, max_agents, test=False, is_monolithic=False, addl_mono_rm: SparseRewardMachine=None, 
-                 render_mode=None, monolithic_weight=1.0, log_dir=None, video=False):
+                 render_mode=None, monolithic_weight=1.0, log_dir=None, video=False, record_trajectory=False, manager_key=None):
         super().__init__(manager, labeled_mdp_class, reward_machine, 
                          config, max_agents, test, is_monolithic, addl_mono_rm, 
-                         render_mode, monolithic_weight, log_dir, video)
+                         render_mode, monolithic_weight, log_dir, video, record_trajectory, manager_key)
         
-        OvercookedProductEnv.manager = manager
 
         ###### FOR VISUALIZING ######
         self.viz = OvercookedVisualizer()
@@ -45,7 +43,7 @@ class OvercookedProductEnv(MultiAgentEnvironment):
     def reset(self, seed=None, options=None):
 
         if not self.local_manager:
-            self.local_manager = OvercookedProductEnv.manager
+            self.local_manager = self.manager
 
         self.agents = self.possible_agents[:]
         self.timestep = 0
@@ -57,13 +55,11 @@ class OvercookedProductEnv(MultiAgentEnvironment):
         jax_observations, state = self.mdp.reset(key_r)
         jax_observations = self.labeled_mdp.trim_observation(jax_observations)
 
-        rm_array = copy.deepcopy(self.env_config["initial_rm_states"]) if np.array(self.env_config["initial_rm_states"]).ndim == 2 else [copy.deepcopy(self.env_config["initial_rm_states"])]
+        rm_array, rm_state_array = self.get_initial_rm_states()
         
         if self.addl_monolithic_rm is not None:
             self.monolithic_rm_state = self.addl_monolithic_rm.get_initial_state()
 
-        rm_state_array = [[self.reward_machine.get_one_hot_encoded_state(state, len(self.possible_agents), idx) for idx, state in enumerate(init_states)] for init_states in rm_array]
-
         mdp_state_array = [jax_observations[agent].flatten() for agent in self.agents]
 
         decomp_idx = self.local_manager.get_rm_assignments(mdp_state_array, rm_state_array, test=self.test)
@@ -72,7 +68,8 @@ class OvercookedProductEnv(MultiAgentEnvironment):
         
         print("reset step", state.time)
         self.curr_state = state
-        self.traj_mdp_states.append(self.curr_state)
+        if self.record_trajectory:
+            self.traj_mdp_states.append(self.curr_state)
         infos = {agent: {} for agent in self.agents}
 
         observations = {}
@@ -101,21 +98,7 @@ class OvercookedProductEnv(MultiAgentEnvironment):
 
         jax_obs, labels = self.labeled_mdp.get_mdp_label(state, jax_rewards)
 
-        rm_rewards = {}
-        mono_rm_reward = 0
-        for i in range(len(self.possible_agents)):
-            agent = self.possible_agents[i]
-            r = 0
-            for e in labels:
-                u2 = self.reward_machine.get_next_state(self.rm_states[agent], e)
-                r = r + self.reward_machine.get_reward(self.rm_states[agent], u2)
-                self.rm_states[agent] = u2
-                if self.addl_monolithic_rm is not None:
-                    next_ms = self.addl_monolithic_rm.get_next_state(self.monolithic_rm_state, e) #TODO: check that the order invariance here doesn't matter
-                    mono_rm_reward += self.monolithic_weight*self.addl_monolithic_rm.get_reward(self.monolithic_rm_state, next_ms)
-                    self.monolithic_rm_state = next_ms
-                    
-            rm_rewards[agent] = r
+        rm_rewards, mono_rm_reward = self.step_reward_machines(self.possible_agents, labels)
 
         if self.addl_monolithic_rm is not None:
             for agent in self.possible_agents:
@@ -132,7 +115,8 @@ class OvercookedProductEnv(MultiAgentEnvironment):
 
         
         self.curr_state = state
-        self.traj_mdp_states.append(state)
+        if self.record_trajectory:
+            self.traj_mdp_states.append(state)
         obs = {i: self.flatten_and_add_rm(jax_obs[i].flatten(), self.rm_states[i], idx) for idx, i in enumerate(self.agents)}
 
         self.timestep += 1
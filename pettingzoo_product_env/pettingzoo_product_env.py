@@ -4,10 +4,28 @@ from mdp_label_wrappers.generic_mdp_labeled import MDP_Labeler
 from reward_machines.sparse_reward_machine import SparseRewardMachine
 import numpy as np
 
+# managers shared by all envs of a run, by the key the run registered them under (see register_manager)
+_registered_managers = {}
+
+def register_manager(key, manager):
+    '''
+    Registers manager under key in this process. Envs built with manager_key=key are pickled without 
+    their manager and the copies (e.g. the ones supersuit's concat_vec_envs makes) use this one, so 
+    assignments and rewards of all of them go to one manager. Call unregister_manager(key) when done.
+    '''
+    if key in _registered_managers and _registered_managers[key] is not manager:
+        raise Exception(f"Another manager is already registered as {key}")
+    _registered_managers[key] = manager
+
+def unregister_manager(key):
+    _registered_managers.pop(key, None)
+
 class MultiAgentEnvironment(ParallelEnv, ABC):
-    def __init__(self, manager, labeled_mdp_class: MDP_Labeler, reward_machine: SparseRewardMachine, config, max_agents, test=False, is_monolithic=False, addl_mono_rm: SparseRewardMachine=None, render_mode=None, monolithic_weight=1.0, log_dir=None, video=False):
+    def __init__(self, manager, labeled_mdp_class: MDP_Labeler, reward_machine: SparseRewardMachine, config, max_agents, test=False, is_monolithic=False, addl_mono_rm: SparseRewardMachine=None, render_mode=None, monolithic_weight=1.0, log_dir=None, video=False, record_trajectory=False, manager_key=None):
         self.render_mode = render_mode
         self.env_config = config
+        self.manager = manager # copies share it through manager_key, envs without one can not be copied (see __getstate__)
+        self.manager_key = manager_key
         self.max_agents = max_agents
         self.possible_agents = ["agent_" + str(r) for r in range(self.max_agents)]
         self.labeled_mdp = labeled_mdp_class(config)
@@ -17,9 +35,31 @@ class MultiAgentEnvironment(ParallelEnv, ABC):
         self.monolithic_weight = monolithic_weight
         self.log_dir = log_dir
         self.video = video
+        self.record_trajectory = record_trajectory or video # traj_mdp_states is only filled if needed (videos)
         self.traj_mdp_states = []
         self.local_manager = None
+        self.initial_rm_states = None # see get_initial_rm_states
+        self.initial_rm_one_hots = None
         
+    def __getstate__(self):
+        '''
+        The manager is left out, a copy gets the manager registered under manager_key in its process 
+        (see register_manager). Envs without a manager_key can not be copied: a pickled manager would 
+        silently diverge from the original, the copy's assignments and rewards never reaching it.
+        '''
+        if self.manager_key is None:
+            raise Exception("Copying an env built without manager_key would copy its manager, register the manager (see register_manager) and pass its key")
+        state = self.__dict__.copy()
+        state['local_manager'] = None
+        state['manager'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self.manager_key not in _registered_managers:
+            raise Exception(f"No manager is registered as {self.manager_key} in this process, see register_manager")
+        self.manager = _registered_managers[self.manager_key]
+
     @abstractmethod
     def observation_space(self, agent):
         pass
@@ -44,6 +84,46 @@ class MultiAgentEnvironment(ParallelEnv, ABC):
     def send_animation(self):
         pass
 
+    def get_initial_rm_states(self):
+        '''
+        Returns env_config["initial_rm_states"] as [[rm state of each agent] for each decomposition] and 
+        their one hot encodings in the same layout. Both are built on the first reset and shared by all 
+        later ones, they must not be modified.
+        '''
+        if self.initial_rm_states is None:
+            rm_array = self.env_config["initial_rm_states"]
+            if np.array(rm_array).ndim != 2:
+                rm_array = [rm_array]
+            self.initial_rm_states = [list(init_states) for init_states in rm_array]
+            self.initial_rm_one_hots = [[self.reward_machine.get_one_hot_encoded_state(state, len(self.possible_agents), idx) for idx, state in enumerate(init_states)] for init_states in self.initial_rm_states]
+        return self.initial_rm_states, self.initial_rm_one_hots
+
+    def step_reward_machines(self, agents, labels):
+        '''
+        Advances the rm state of every agent in agents through labels (in order) with a single 
+        batched call, and the monolithic rm once per agent, as if each agent had stepped it.
+        Updates self.rm_states and self.monolithic_rm_state.
+
+        Returns: ({agent: rm reward}, weighted monolithic rm reward)
+        '''
+        rm = self.reward_machine
+        state_ids = rm.get_state_ids([self.rm_states[agent] for agent in agents])
+        next_ids, rewards, _ = rm.step_batch(state_ids, rm.get_event_ids(labels))
+        rm_rewards = {}
+        for agent, u_id, r in zip(agents, next_ids, rewards):
+            self.rm_states[agent] = rm.get_state_from_id(u_id)
+            rm_rewards[agent] = float(r)
+
+        mono_rm_reward = 0
+        if self.addl_monolithic_rm is not None:
+            mono_rm = self.addl_monolithic_rm
+            mono_events = np.tile(mono_rm.get_event_ids(labels), len(agents))
+            mono_id, mono_r, _ = mono_rm.step_batch(mono_rm.get_state_id(self.monolithic_rm_state), mono_events)
+            self.monolithic_rm_state = mono_rm.get_state_from_id(mono_id)
+            mono_rm_reward = self.monolithic_weight*float(mono_r)
+
+        return rm_rewards, mono_rm_reward
+
     def flatten_and_add_rm(self, obs, rm_state, agent_idx):
         rm_ohe = self.reward_machine.get_one_hot_encoded_state(rm_state, len(self.possible_agents), agent_idx)
         if self.addl_monolithic_rm is not None:
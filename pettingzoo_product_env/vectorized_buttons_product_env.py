@@ -0,0 +1,230 @@
+import random
+from reward_machines.sparse_reward_machine import SparseRewardMachine
+from gymnasium.spaces import Discrete, Box
+import numpy as np
+from stable_baselines3.common.vec_env import VecEnv
+from mdp_label_wrappers.generic_mdp_labeled import MDP_Labeler
+
+class VectorizedButtonsProductEnv(VecEnv):
+    '''
+    ButtonsProductEnv for num_vec_envs episodes at once, as a SB3 VecEnv with the layout
+    ss.pettingzoo_env_to_vec_env_v1 + ss.concat_vec_envs_v1 give it: one slot per (episode, agent),
+    slot episode*max_agents + agent index, and finished episodes are reset automatically.
+
+    Positions, world flags (buttons, hazard, ...) and RM states of all episodes are kept in NumPy arrays.
+    A step loops over the agents only, the episodes are advanced together by the labeled MDP's
+    environment_step_batch / get_mdp_label_batch and SparseRewardMachine.step_batch.
+
+    Differences to ButtonsProductEnv wrapped with supersuit:
+    - an episode is done on the step it terminates or is truncated on (black_death_v3 adds an all zero
+      step after it) and the manager gets its reward once, for the decomposition that episode used
+    - infos only hold "terminal_observation" and "TimeLimit.truncated" of the finished episodes
+    - slips are drawn from a NumPy generator (seed) instead of random, unless python_random is set
+    - no rendering or videos, use ButtonsProductEnv for those (e.g. for the eval env)
+    - all slots share one set of attributes (get_attr, set_attr, env_method)
+    check_vectorized_env.py compares its episodes to ButtonsProductEnv's.
+
+    python_random: draw the slips with random.random(), in the order num_vec_envs ButtonsProductEnvs stepped 
+                   one after the other would. For the same random.seed the episodes are then the same as theirs.
+    '''
+    def __init__(self, manager, labeled_mdp_class: MDP_Labeler, reward_machine: SparseRewardMachine,
+                 config, max_agents, num_vec_envs=1, test=False, is_monolithic=False, addl_mono_rm: SparseRewardMachine=None,
+                 render_mode=None, monolithic_weight=1.0, log_dir=None, video=False, seed=None, manager_key=None, python_random=False):
+        if render_mode is not None or video:
+            raise Exception("VectorizedButtonsProductEnv can not render, use ButtonsProductEnv")
+
+        self.manager = manager
+        self.manager_key = manager_key # only kept for ButtonsProductEnv's arguments, this env is not copied
+        self.env_config = config
+        self.max_agents = max_agents
+        self.possible_agents = ["agent_" + str(r) for r in range(self.max_agents)]
+        self.labeled_mdp = labeled_mdp_class(config)
+        self.reward_machine = reward_machine
+        self.test = test
+        self.is_monolithic = is_monolithic # deprecated
+        self.addl_monolithic_rm = addl_mono_rm
+        self.monolithic_weight = monolithic_weight
+        self.log_dir = log_dir
+        self.num_vec_envs = num_vec_envs
+        self.render_mode = render_mode
+        self.rng = np.random.default_rng(seed)
+        self.python_random = python_random
+
+        for rm in (reward_machine, addl_mono_rm):
+            if rm is not None and not rm.is_compiled():
+                rm.compile()
+
+        rm_array = config["initial_rm_states"]
+        if np.array(rm_array).ndim != 2:
+            rm_array = [rm_array]
+        self.initial_rm_states = [list(init_states) for init_states in rm_array]
+        self.initial_rm_ids = np.array([reward_machine.get_state_ids(init_states) for init_states in self.initial_rm_states]) # [decomp, agent]
+        self.initial_mdp_states = np.array(config["initial_mdp_states"], dtype=np.int64)
+        self.agent_indices = np.arange(max_agents)
+
+        # one hot encodings of every (rm state id, agent), see SparseRewardMachine.get_one_hot_encodings
+        rm_encodings, self.rm_valid = reward_machine.get_one_hot_encodings(max_agents)
+        self.rm_encodings = rm_encodings.astype(np.float32)
+        obs_size = 1 + self.rm_encodings.shape[2]
+        if self.addl_monolithic_rm is not None:
+            self.monolithic_rm_encodings = self.addl_monolithic_rm.get_one_hot_encodings(max_agents)[0].astype(np.float32)
+            self.initial_monolithic_rm_id = self.addl_monolithic_rm.get_state_id(self.addl_monolithic_rm.get_initial_state())
+            obs_size += self.monolithic_rm_encodings.shape[2]
+
+        # same spaces as ButtonsProductEnv
+        super().__init__(num_vec_envs * max_agents, Box(0, 255, [obs_size]), Discrete(5))
+
+        # state of each episode
+        self.mdp_states = np.zeros((num_vec_envs, max_agents), dtype=np.int64)
+        self.rm_state_ids = np.zeros((num_vec_envs, max_agents), dtype=np.int64)
+        self.monolithic_rm_state_ids = np.zeros(num_vec_envs, dtype=np.int64)
+        self.decomp_idx = np.zeros(num_vec_envs, dtype=np.int64)
+        self.time_steps = np.zeros(num_vec_envs, dtype=np.int64)
+        self.world = self.labeled_mdp.get_batch_world_state(num_vec_envs)
+        self.actions = None
+
+    def reset(self):
+        if self._seeds[0] is not None:
+            self.rng = np.random.default_rng(self._seeds[0])
+        self._reset_seeds()
+        self.reset_episodes(np.arange(self.num_vec_envs))
+        self.reset_infos = [{} for _ in range(self.num_envs)]
+        return self.get_observations()
+
+    def reset_episodes(self, episodes, manager_rewards=None):
+        '''
+        Starts a new episode in each of the given episode indices, with a decomposition from the manager.
+        If manager_rewards is given, the manager first gets the reward of the finished episode
+        (manager_rewards[j] for episodes[j]), like ButtonsProductEnv does before it is reset.
+        '''
+        for j, n in enumerate(episodes):
+            if manager_rewards is not None:
+                self.manager.update_rewards(manager_rewards[j], decomp=int(self.decomp_idx[n]))
+            self.decomp_idx[n] = self.manager.get_rm_assignments(self.env_config["initial_mdp_states"], self.initial_rm_states, test=self.test)
+
+        self.mdp_states[episodes] = self.initial_mdp_states
+        self.rm_state_ids[episodes] = self.initial_rm_ids[self.decomp_idx[episodes]]
+        if self.addl_monolithic_rm is not None:
+            self.monolithic_rm_state_ids[episodes] = self.initial_monolithic_rm_id
+        self.time_steps[episodes] = 0
+        for name, values in self.labeled_mdp.get_batch_world_state(len(episodes)).items():
+            self.world[name][episodes] = values
+
+    def step_async(self, actions):
+        self.actions = actions
+
+    def step_wait(self):
+        actions = np.asarray(self.actions, dtype=np.int64).reshape(self.num_vec_envs, self.max_agents)
+        if self.python_random:
+            checks = np.array([random.random() for _ in range(self.num_envs)]).reshape(self.num_vec_envs, self.max_agents)
+        else:
+            checks = self.rng.random((self.num_vec_envs, self.max_agents))
+
+        # each agent steps and labels all episodes, in agent order like ButtonsProductEnv.step
+        all_labels = []
+        for i in range(self.max_agents):
+            s_next = self.labeled_mdp.environment_step_batch(self.mdp_states[:, i], actions[:, i], i+1, self.world, checks[:, i])
+            all_labels.extend(self.labeled_mdp.get_mdp_label_batch(s_next, i+1, self.world))
+            self.mdp_states[:, i] = s_next
+        all_labels = [(event, mask) for event, mask in all_labels if mask.any()]
+
+        rewards, terminations = self.step_reward_machines(all_labels)
+
+        self.time_steps += 1
+        truncations = self.time_steps >= self.env_config["max_episode_length"]
+
+        if self.test:
+            terminations &= ~truncations
+            won = terminations & (rewards > 0).any(axis=1)
+            rewards = np.where(won[:, None], 1.0, np.where(terminations[:, None], rewards, 0.0))
+        rewards = np.maximum(rewards, 0)
+
+        observations = self.get_observations()
+        dones = terminations | truncations
+        infos = [{} for _ in range(self.num_envs)]
+        if dones.any():
+            finished = np.flatnonzero(dones)
+            for n in finished:
+                for slot in range(n*self.max_agents, (n+1)*self.max_agents):
+                    infos[slot]["terminal_observation"] = observations[slot]
+                    infos[slot]["TimeLimit.truncated"] = bool(truncations[n] and not terminations[n])
+            manager_rewards = None
+            if not self.test:
+                manager_rewards = [0 if truncations[n] else 1*self.env_config["gamma"]**int(self.time_steps[n]) for n in finished]
+            self.reset_episodes(finished, manager_rewards)
+            observations = self.get_observations()
+
+        return observations, rewards.reshape(self.num_envs).astype(np.float32), np.repeat(dones, self.max_agents), infos
+
+    def step_reward_machines(self, all_labels):
+        '''
+        Advances the rm state of every agent and the monolithic rm of every episode through the labels of
+        its episode (in order, the monolithic rm once per agent as in ButtonsProductEnv).
+
+        Returns: (rewards of shape (num_vec_envs, max_agents), terminations of shape (num_vec_envs,))
+        '''
+        rm = self.reward_machine
+        event_ids = self.get_event_ids(rm, all_labels)
+        self.rm_state_ids, rewards, rm_terminal = rm.step_batch(self.rm_state_ids, event_ids[:, None, :])
+        terminations = rm_terminal.all(axis=1)
+
+        if self.addl_monolithic_rm is not None:
+            mono_rm = self.addl_monolithic_rm
+            mono_event_ids = np.tile(self.get_event_ids(mono_rm, all_labels), (1, self.max_agents))
+            self.monolithic_rm_state_ids, mono_rewards, terminations = mono_rm.step_batch(self.monolithic_rm_state_ids, mono_event_ids)
+            rewards = rewards + self.monolithic_weight*mono_rewards[:, None]
+
+        return rewards, terminations
+
+    def get_event_ids(self, rm, all_labels):
+        '''
+        Returns the ids in rm of the events each episode emitted, in order, as a (num_vec_envs, most events of
+        an episode) array padded with the null event. Events rm does not know are left out, they keep its state.
+        '''
+        ids = rm.get_event_ids([event for event, _ in all_labels])
+        null_event = rm.get_null_event_id()
+        emitted = np.zeros((self.num_vec_envs, len(all_labels)), dtype=bool)
+        for k, (_, mask) in enumerate(all_labels):
+            emitted[:, k] = mask
+        emitted &= ids != null_event
+        if not emitted.any():
+            return np.full((self.num_vec_envs, 0), null_event, dtype=np.int64)
+
+        # move the emitted events of each episode to its first columns, keeping their order
+        columns = np.cumsum(emitted, axis=1) - 1
+        event_ids = np.full((self.num_vec_envs, columns[:, -1].max() + 1), null_event, dtype=np.int64)
+        episodes, labels = np.nonzero(emitted)
+        event_ids[episodes, columns[episodes, labels]] = ids[labels]
+        return event_ids
+
+    def get_observations(self):
+        '''
+        Returns the observation of every slot, [mdp state, rm one hot, monolithic rm one hot] like ButtonsProductEnv
+        '''
+        if not self.rm_valid[self.rm_state_ids].all():
+            raise ValueError("State not assigned to any subtask!")
+        rm_size = self.rm_encodings.shape[2]
+        observations = np.empty((self.num_vec_envs, self.max_agents, self.observation_space.shape[0]), dtype=np.float32)
+        observations[:, :, 0] = self.mdp_states
+        observations[:, :, 1:1 + rm_size] = self.rm_encodings[self.rm_state_ids, self.agent_indices]
+        if self.addl_monolithic_rm is not None:
+            observations[:, :, 1 + rm_size:] = self.monolithic_rm_encodings[self.monolithic_rm_state_ids[:, None], self.agent_indices]
+        return observations.reshape(self.num_envs, -1)
+
+    def close(self):
+        pass
+
+    def get_attr(self, attr_name, indices=None):
+        return [getattr(self, attr_name) for _ in self._get_indices(indices)]
+
+    def set_attr(self, attr_name, value, indices=None):
+        if indices is not None and set(self._get_indices(indices)) != set(range(self.num_envs)):
+            raise ValueError("VectorizedButtonsProductEnv can only set an attribute of all slots at once")
+        setattr(self, attr_name, value)
+
+    def env_method(self, method_name, *method_args, indices=None, **method_kwargs):
+        result = getattr(self, method_name)(*method_args, **method_kwargs)
+        return [result for _ in self._get_indices(indices)]
+
+    def env_is_wrapped(self, wrapper_class, indices=None):
+        return [False for _ in self._get_indices(indices)]
@@ -0,0 +1,80 @@
+import hashlib
+import json
+import os
+import tempfile
+from reward_machines.sparse_reward_machine import SparseRewardMachine
+import reward_machines.task_assignment.helper_functions as hf
+
+### Persistent cache for generate_rm_decompositions results ###
+# Every entry is stored under a content hash of the search inputs as two files:
+#     <key>.json  the ranked knapsacks [(score, knapsack)] found by the tree search
+#     <key>.npz   the subsuming reward machine and decomps_init_states (see SparseRewardMachine.save_npz)
+
+CACHE_FORMAT_VERSION = 2 # 2: permutations of interchangeable agents are no longer reported
+
+
+def get_cache_key(monolithic_rm, num_agents, top_k, enforced_dict, forbidden_dict, weights, incompatible_pairs):
+    '''
+    Canonical sha256 of everything the decomposition search depends on. Transitions, events and 
+    (event, agent) assignments are sorted, so the key does not depend on dict or set ordering.
+    '''
+    transitions = []
+    for u1, td in monolithic_rm.delta_u.items():
+        for e, u2 in td.items():
+            transitions.append([repr(u1), repr(u2), repr(e), repr(monolithic_rm.get_reward(u1, u2))])
+
+    def canonical_sack(assignments):
+        if not assignments:
+            return []
+        if type(assignments) == dict:
+            assignments = hf.get_sack_from_dict(assignments)
+        return sorted([repr(e), a] for e, a in assignments)
+
+    inputs = {
+        'version': CACHE_FORMAT_VERSION,
+        'u0': repr(monolithic_rm.u0),
+        'events': sorted(repr(e) for e in monolithic_rm.events),
+        'transitions': sorted(transitions),
+        'num_agents': num_agents,
+        'top_k': top_k,
+        'enforced': canonical_sack(enforced_dict),
+        'forbidden': canonical_sack(forbidden_dict),
+        'weights': list(weights),
+        'incompatible_pairs': sorted(sorted(repr(e) for e in pair) for pair in incompatible_pairs),
+    }
+    return hashlib.sha256(json.dumps(inputs, sort_keys=True).encode()).hexdigest()
+
+
+def load_decompositions(cache_dir, key):
+    '''
+    Returns (ranked knapsacks, subsuming_rm, decomps_init_states) stored under key, or None on a miss.
+    '''
+    json_file = os.path.join(cache_dir, key + '.json')
+    npz_file = os.path.join(cache_dir, key + '.npz')
+    if not (os.path.exists(json_file) and os.path.exists(npz_file)):
+        return None
+    with open(json_file) as f:
+        entry = json.load(f)
+    ranked_knapsacks = [(score, {(e, a) for e, a in knapsack}) for score, knapsack in entry['knapsacks']]
+    subsuming_rm = SparseRewardMachine()
+    decomps_init_states = subsuming_rm.load_rm_from_npz(npz_file)
+    return ranked_knapsacks, subsuming_rm, decomps_init_states
+
+
+def save_decompositions(cache_dir, key, ranked_knapsacks, subsuming_rm, decomps_init_states):
+    '''
+    Stores a search result under key. Files are written to a temporary name first and then 
+    renamed, so concurrent runs (e.g. a seed sweep) never read a partially written entry.
+    '''
+    os.makedirs(cache_dir, exist_ok=True)
+    entry = {'knapsacks': [(score, sorted([e, a] for e, a in knapsack)) for score, knapsack in ranked_knapsacks]}
+
+    fd, tmp_npz = tempfile.mkstemp(dir=cache_dir, suffix='.npz')
+    os.close(fd)
+    subsuming_rm.save_npz(tmp_npz, decomps_init_states)
+    os.replace(tmp_npz, os.path.join(cache_dir, key + '.npz'))
+
+    fd, tmp_json = tempfile.mkstemp(dir=cache_dir, suffix='.json')
+    with os.fdopen(fd, 'w') as f:
+        json.dump(entry, f)
+    os.replace(tmp_json, os.path.join(cache_dir, key + '.json'))
@@ -1,9 +1,11 @@
 import itertools
 from reward_machines.sparse_reward_machine import SparseRewardMachine, combine_to_single_rm
 import reward_machines.task_assignment.bisimilarity_check as bs
+from reward_machines.task_assignment.bisimilarity_check import EquivalenceRelation, get_relation # union-find relation, shared with the tree search
 import reward_machines.task_assignment.helper_functions as hf
-from reward_machines.task_assignment.tree_search import Node 
+from reward_machines.task_assignment.tree_search import Node, SearchBudget
 from reward_machines.task_assignment.configurations import Configurations
+import reward_machines.decomposition_cache as dc
 
 
 def generate_le_decompositions(set_x, num_subsets, size_weight=1.0, fairness_weight=0.4, top_k=5):
@@ -40,7 +42,49 @@ def score_decomposition_fairness(decomposition):
     assert fairness_score <= 1
     return fairness_score
 
-def generate_rm_decompositions(monolithic_rm: SparseRewardMachine, num_agents: int, top_k: int=5, enforced_dict: dict=None, forbidden_dict: dict=None, handpicked_decomp:str=None, config:dict=None):
+def get_decomposition_rms(monolithic_rm: SparseRewardMachine, configs: Configurations, knapsack: set):
+    """
+    Builds the reward machines of the decomposition that keeps every (event, agent) assignment not in knapsack.
+
+    Returns:
+        decomp (dict): {agent: SparseRewardMachine}, projected onto the agent's events, with the events of 
+            no agent leading to an accident state
+    """
+    event_spaces, event_spaces_dict = hf.get_event_spaces_from_knapsack(configs.all_events, knapsack) # event_spaces_dict = {agent: [events] }
+    strategy_set = set()
+    for es in event_spaces:
+        strategy_set = strategy_set.union(es)
+    acc_set = monolithic_rm.events.copy() - strategy_set
+    strategic_rm = bs.get_strategy_rm(monolithic_rm, strategy_set)
+    shared_events = set()
+    for e in strategy_set:
+        share_count = 0
+        for es in event_spaces:
+            if e in es:
+                share_count += 1 
+        if share_count > 1:
+            shared_events.add(e)
+    shared_events_dict  = {} # {agent# : shared events list} agent # start at 0
+    for i, esi in event_spaces_dict.items():
+        my_shared_events = shared_events & set(esi)
+        shared_events_dict[i] = list(my_shared_events)
+    pre_decomp = {idx: bs.project_rm(set(event_set), strategic_rm) for idx, event_set in event_spaces_dict.items()}
+    decomp = {idx: bs.get_accident_avoidance_rm_less(sub_rm, acc_set, monolithic_rm) for idx, sub_rm in pre_decomp.items()}
+    return decomp
+
+SEARCH_WEIGHTS = [1, .5, 0] # [shared events, fairness, utility] weights of the decomposition score
+
+def get_search_root(monolithic_rm, num_agents, enforced_dict, forbidden_dict, weights, incompatible_pairs, budget = None, rm_cache_size = 1024):
+    '''
+    Returns (configs, root) of the decomposition tree search. With a budget the root searches the most 
+    constrained events first (anytime search).
+    '''
+    configs = Configurations(num_agents, monolithic_rm, enforced_set = enforced_dict, forbidden_set = forbidden_dict, weights = weights, incompatible_pairs= incompatible_pairs, rm_cache_size = rm_cache_size)
+    future_events = configs.future_events if budget is None else configs.get_fail_first_events() # anytime search: most constrained events first
+    root = Node(name = 'root', future_events = future_events, all_events= configs.all_events, knapsack = configs.forbidden_set) #forbidden set is the starting knapsack
+    return configs, root
+
+def generate_rm_decompositions(monolithic_rm: SparseRewardMachine, num_agents: int, top_k: int=5, enforced_dict: dict=None, forbidden_dict: dict=None, handpicked_decomp:str=None, config:dict=None, cache_dir:str=None, num_workers:int=1, split_depth:int=4, time_budget_s:float=None, max_nodes:int=None, rm_cache_size:int=1024, verbose:bool=False):
     """
 
     Args:
@@ -49,15 +93,53 @@ def generate_rm_decompositions(monolithic_rm: SparseRewardMachine, num_agents: i
         top_k (int, optional): Number of decompositions we want to introduce. Defaults to 5.
         enforced_dict (_type_, optional): _description_. Defaults to None.
         forbidden_dict (_type_, optional): _description_. Defaults to None.
+        cache_dir (str, optional): directory of the persistent decomposition cache. If the same search 
+            (rm, agents, enforced/forbidden events, top_k) was already run, its result is loaded from 
+            there instead of searching again. Defaults to None (no caching).
+        num_workers (int, optional): number of processes for the tree search. With more than 1 (or None, 
+            one per cpu) the search tree is split at split_depth and the subtrees are searched in parallel. 
+            The result is the same as the single process search. Defaults to 1.
+        split_depth (int, optional): depth at which the parallel search splits the tree. Defaults to 4.
+        time_budget_s (float, optional): seconds the tree search may take. Defaults to None (no limit).
+        max_nodes (int, optional): number of tree nodes the search may visit. Defaults to None (no limit).
+            With either budget the search is anytime: it looks at the most promising knapsacks first 
+            and, when the budget runs out, uses the best top_k found so far. 
+        rm_cache_size (int, optional): entries kept by each LRU cache of projections, strategy RMs and 
+            win-ability results during the tree search (0 disables them). Defaults to 1024.
+        verbose (bool, optional): also print the hits and misses of those caches. Defaults to False.
 
     Returns:
-        _type_: _description_
+        subsuming_rm (SparseRewardMachine): the top_k decompositions combined into one RM. Its rm_cache_stats 
+            holds the hits, misses and sizes of those caches (RMCache.get_stats), None when loaded from cache_dir
+        decomps_init_states (dict): {decomposition: {agent: initial state in subsuming_rm}}
+        exhaustive (bool): False if a budget ran out before the whole search tree was covered
     """
     incompatible_pairs = []
-    weights = [1, .5, 0]
-    configs = Configurations(num_agents, monolithic_rm, enforced_set = enforced_dict, forbidden_set = forbidden_dict, weights = weights, incompatible_pairs= incompatible_pairs)
-    root = Node(name = 'root', future_events = configs.future_events, all_events= configs.all_events, knapsack = configs.forbidden_set) #forbidden set is the starting knapsack
-    bd = root.traverse_last_minute_change(configs, num_solutions=top_k)
+    weights = SEARCH_WEIGHTS
+    if cache_dir is not None:
+        cache_key = dc.get_cache_key(monolithic_rm, num_agents, top_k, enforced_dict, forbidden_dict, weights, incompatible_pairs)
+        cached = dc.load_decompositions(cache_dir, cache_key)
+        if cached is not None:
+            bd, subsuming_rm, decomps_init_states = cached
+            print(f"Loaded {len(bd)} decompositions with scores {[soln[0] for soln in bd]} from cache {cache_key}")
+            return subsuming_rm, decomps_init_states, True
+    budget = None
+    if time_budget_s is not None or max_nodes is not None:
+        budget = SearchBudget(time_budget_s = time_budget_s, max_nodes = max_nodes)
+    configs, root = get_search_root(monolithic_rm, num_agents, enforced_dict, forbidden_dict, weights, incompatible_pairs, budget, rm_cache_size)
+    if num_workers == 1:
+        bd = root.traverse_iterative(configs, num_solutions=top_k, budget=budget)
+    else:
+        bd = root.traverse_parallel(configs, num_solutions=top_k, num_workers=num_workers, split_depth=split_depth, budget=budget)
+    exhaustive = budget is None or not budget.exhausted
+    rm_cache_stats = configs.rm_cache.get_stats()
+    if verbose:
+        for name, stats in rm_cache_stats.items():
+            print(f"RM cache {name}: {stats['hits']} hits, {stats['misses']} misses")
+    if not exhaustive:
+        print(f"Search budget ran out after {budget.num_nodes} nodes, using the best {len(bd)} decompositions found so far")
+    if not bd:
+        raise Exception("No decomposition was found" + ("" if exhaustive else " within the search budget"))
     hf.print_results(configs, bd)  
     rm_decomps = {}
     decomps_init_states = {}
@@ -66,26 +148,7 @@ def generate_rm_decompositions(monolithic_rm: SparseRewardMachine, num_agents: i
 
     for sol_idx, solution in enumerate(bd, start=start):
         score, k = solution
-        event_spaces, event_spaces_dict = hf.get_event_spaces_from_knapsack(configs.all_events, k) # event_spaces_dict = {agent: [events] }
-        strategy_set = set()
-        for es in event_spaces:
-            strategy_set = strategy_set.union(es)
-        acc_set = monolithic_rm.events.copy() - strategy_set
-        strategic_rm = bs.get_strategy_rm(monolithic_rm, strategy_set)
-        shared_events = set()
-        for e in strategy_set:
-            share_count = 0
-            for es in event_spaces:
-                if e in es:
-                    share_count += 1 
-            if share_count > 1:
-                shared_events.add(e)
-        shared_events_dict  = {} # {agent# : shared events list} agent # start at 0
-        for i, esi in event_spaces_dict.items():
-            my_shared_events = shared_events & set(esi)
-            shared_events_dict[i] = list(my_shared_events)
-        pre_decomp = {idx: bs.project_rm(set(event_set), strategic_rm) for idx, event_set in event_spaces_dict.items()}
-        decomp = {idx: bs.get_accident_avoidance_rm_less(sub_rm, acc_set, monolithic_rm) for idx, sub_rm in pre_decomp.items()}
+        decomp = get_decomposition_rms(monolithic_rm, configs, k)
         # import pdb; pdb.set_trace()
         rm_decomps[sol_idx], decomps_init_states[sol_idx] = combine_to_single_rm(decomp)
     # import pdb; pdb.set_trace()
@@ -94,219 +157,31 @@ def generate_rm_decompositions(monolithic_rm: SparseRewardMachine, num_agents: i
         offset = decomp_offsets[rmidx]
         for state in decomps_init_states[rmidx]:
             decomps_init_states[rmidx][state] += offset
-    return subsuming_rm, decomps_init_states
-
-# The below code adapted from https://github.com/smithsophia1688/automated_task_assignment_with_rm
-class EquivalenceRelation:
-    '''
-    Relation should be:
-        - reflexive: a ~ a
-        - symmetric: a ~ b -> b ~ a
-        - transitive: a ~ b, b ~ c -> a ~ c
-    '''
-    def __init__(self, classes = None):
-        '''
-        Inputs
-        classes: list of sets
-        
-        Attributes
-            classes: list holding a set of each equivalence class
-        '''
-        if classes == None:
-            self.classes = []
-        else:
-            self.classes = classes
-
-        self.check_classes()
-
-    def __repr__(self):
-        s = "Equivalence Classes: \n"
-        for cl in self.classes:
-            s += "    " + str(cl) + "\n"
-        return s
-
-        
-    def add_relation(self, elements):
-        '''
-        Inputs
-            elements: (list) holds strings of elements to be added to related * MAYBE CHANGE TO TUPLE?
-        '''
-        #print("     I am adding a relation", elements)
-        cls = []
-        for e in elements:
-            cl = self.find_class(e) 
-            if cl:
-                if cl not in cls:
-                    cls.append(cl)
-    
-        if cls: # at least one element belongs in a class already
-            new_cl = self.merge_classes(cls)  #if only one element in cls, returns cls[0]
-            self.add_elements_to_class(elements, new_cl)  
-        
-        else:
-            self.add_new_class(elements) 
-
-        self.check_classes() 
-
-    def find_class(self, element):
-        '''
-        Finds class the element belongs to
-        Input:
-            element: (str) (or integer?) element in an equivalence class
-        Returns:
-            cl: (set) The set containing the element if element is already in a class
-                (None) if element is not in a set
-        '''
-        for cl in self.classes:
-            if element in cl:
-                return cl
-        #print('Element', element, "classes", self.classes)
-        return None 
-            
-    def merge_classes(self, cls):
-        '''
-        Takes a list of classes, combines them
-        Removes existing classes and replaces as ONE 
-        Expecting a list of classes at least length 1
-        Inputs:
-            cls: (list) contains sets that are elements of the list self.classes
-        Return:
-            megacl: (set) merged classes
-        '''
-        megacl = set()
-        for cl in cls:
-            megacl = megacl.union(cl) # build merged class
-            self.classes.remove(cl) # remove individual classes
-
-        self.classes.append(megacl) # add merged class
-        return megacl
-        
-    def add_elements_to_class(self, elements, cl):
-        '''
-        add an element to the set
-        Inputs:
-            elements: (list) contains strings or int to be added to cl
-            cl: (set) equivalence class 
-        '''  
-        for e in elements:
-            cl.add(e)
-
-    def add_new_class(self, elements):
-        '''
-        Adds a set containting entries in element to list of classes
+    if cache_dir is not None and exhaustive: # partial results are not cached
+        dc.save_decompositions(cache_dir, cache_key, bd, subsuming_rm, decomps_init_states)
+    subsuming_rm.rm_cache_stats = rm_cache_stats
+    return subsuming_rm, decomps_init_states, exhaustive
 
-        elements: List or tuple of elements 
-        '''
-        new_class = set()
-        for e in elements:
-            new_class.add(e)
-        self.classes.append(new_class)
-
-    def check_classes(self):
-        '''
-        checks that your equivalence classes are disjoint 
-        '''
-        full_union = set()
-        
-        for cl in self.classes:
-            for e in cl:
-                if e in full_union:
-                    raise NameError(" Classes are not disjoint")
-                full_union.add(e)
-
-    def are_related(self, elements):
-
-        '''
-        Checks if elements belong to the same equivalence class
-        Inputs:
-            elements: (list or tuple) 
-        Returns:
-            Bool, true if elements are related, false otherwise 
-        '''  
-        cls = []
-        for e in elements:
-            e_cl = self.find_class(e)
-            if e_cl == None: # element is not in any equivalence class, elements cannot be related
-                return False 
-            cls.append(e_cl)
-        if len(cls) == 1:
-            return True
-
-        if len(cls) == 0: 
-            Warning("You are asking if an empty set of elements are related. Returned False")
-        
-        return False #elements belonged to more than one equivalenc class
-
-    def get_all_related_combos(self):
-        '''
-        Get all pairs of related elements. Order does not matter.
-
-        For example, if my classes are [{1,2,3}, {4,5}]
-        all related combos would be {{1,2}, {1,3}, {2,3}, {4,5}}
-        
-        Returns: list set of sets
-        '''
-        all_related_combos = set()
-        for cl in self.classes:
-            related_combos= set(itertools.combinations(cl, 2))
-            for x in related_combos:
-                all_related_combos.add(x)
-        return all_related_combos    
-
-def get_relation(event_space, rm):
-    '''
-    generates equivalence class relation given set of events and a reward machine
-    Follows definition of equivalence relation outlined in Cyrus' paper (above Def 2)
-
-    Inputs
-        event_space: (set) set of strings, subset of rm.events
-        rm: (SparseRewardMachine)
-    Returns
-     (EquivalenceRelation) 
-
-    '''
-    relation = EquivalenceRelation()
-    state_pairs = list(itertools.combinations_with_replacement(rm.U, 2)) # all combinations length 2 of rm.U (order doesn't matter)
-    #print("     state pairs", state_pairs)
-    actual_related_pairs = []
-    for state_pair in state_pairs: # pair is a tuple
-        if relation.are_related(state_pair) == False:
-            #print("     ", state_pair , " is related")
-            #print("     here", rm.events - event_space )
-            u1, u2 = state_pair
-            if u1 == u2:
-                relation.add_relation(state_pair)
-
-            for e in rm.events - event_space:
-                if rm.is_event_available(u1,e):
-                    if rm.delta_u[u1][e] == u2:
-                        relation.add_relation(state_pair)
-
-                if rm.is_event_available(u2,e):
-                    if rm.delta_u[u2][e] == u1: 
-                        relation.add_relation(state_pair)
-        else:
-            print("     ", state_pair, " is not related")
-    checked_combos = set()
-    all_related_combos = relation.get_all_related_combos()
-
-    while len(all_related_combos) != 0:
-        for u1, v1 in all_related_combos:
-            for e in event_space: 
-                if rm.is_event_available(u1,e) and rm.is_event_available(v1,e): 
-                    u2 = rm.delta_u[u1][e]
-                    v2 = rm.delta_u[v1][e]
-                    relation.add_relation((u2, v2))
-            checked_combos.add((u1, v1))
-            checked_combos.add((v1, u1))
-
-        all_related_combos = relation.get_all_related_combos() - checked_combos 
-    # if event_space == {'bg', 'bb'}:
-        # import pdb; pdb.set_trace()
-    
-    return relation
+def iter_rm_decompositions(monolithic_rm: SparseRewardMachine, num_agents: int, top_k: int=5, enforced_dict: dict=None, forbidden_dict: dict=None, time_budget_s:float=None, max_nodes:int=None, rm_cache_size:int=1024):
+    """
+    Streaming version of generate_rm_decompositions: runs the same (single process) tree search and yields 
+    each decomposition as soon as it is found, so a caller can start using the first ones while the search 
+    goes on, or stop iterating early. A decomposition is yielded when it enters the top_k found so far: 
+    they are yielded in discovery order, not sorted by score, and earlier ones may end up outside the final top_k. 
 
+    Args: as in generate_rm_decompositions
 
+    Yields:
+        score (float): the decomposition score
+        knapsack (set): the (event, agent) assignments removed by this decomposition 
+        decomp (dict): {agent: SparseRewardMachine} (see get_decomposition_rms)
+    """
+    budget = None
+    if time_budget_s is not None or max_nodes is not None:
+        budget = SearchBudget(time_budget_s = time_budget_s, max_nodes = max_nodes)
+    configs, root = get_search_root(monolithic_rm, num_agents, enforced_dict, forbidden_dict, SEARCH_WEIGHTS, [], budget, rm_cache_size)
+    for score, knapsack in root.iter_decompositions(configs, num_solutions=top_k, budget=budget):
+        yield score, knapsack, get_decomposition_rms(monolithic_rm, configs, knapsack)
 
 # Example usage:
 # ex_rm = SparseRewardMachine("overcooked/asymm_advantages/mono_asymm_adv.txt")
@@ -1,10 +1,26 @@
+import re
+import struct
+import zipfile
 import numpy as np
 # from graphviz import Digraph
 
+# Tokens of a reward machine file line, e.g. "(0, 1, 'by', 0)  # Yellow button is pressed"
+_RM_TOKEN = re.compile(r"""\s*(?:
+      (?P<number>[+-]?(?:\d+\.\d*|\.\d+|\d+)(?:[eE][+-]?\d+)?)
+    | (?P<string>'[^']*'|"[^"]*")
+    | (?P<punct>[(),])
+    | (?P<comment>\#.*)
+    | (?P<error>\S)
+    )""", re.VERBOSE)
+_RM_INT = re.compile(r"[+-]?\d+")
+_RM_TRANSITION_SHAPE = ['(', 'number', ',', 'number', ',', 'string', ',', 'number', ')']
+NPZ_FORMAT_VERSION = 1 # version of the .npz layout written by SparseRewardMachine.save_npz
+
 class SparseRewardMachine:
     def __init__(self,file=None):
         # <U,u0,delta_u,delta_r>
         self.U = []       # list of machine states
+        self.state_set = set() # the states of U, kept in sync by _add_state and set_states
         self.events = set() # set of events
         self.u0 = None    # initial state
         self.delta_u = {} # state-transition function
@@ -19,6 +35,16 @@ class SparseRewardMachine:
         self.equivalence_class_name_dict = {} # dict {name: equivalence class} Used in projections only 
         self.state_to_subtask_idx = {}
         self.is_monolithic = False
+        self.rm_cache_stats = None # RMCache.get_stats() of the decomposition search that built this RM, see generate_rm_decompositions
+        # Compiled transition tables, built by compile() (see get_state_id / get_event_id)
+        self.state_ids = {}     # dict {state: contiguous id}
+        self.event_ids = {}     # dict {event: contiguous id}, id len(event_ids) is the null event
+        self.id_to_state = []   # list of states ordered by id
+        self.id_to_event = []   # list of events ordered by id
+        self.next_state_table = None # next_state_table[u_id, e_id] = next state id
+        self.reward_table = None     # reward_table[u_id, e_id] = reward of that transition
+        self.terminal_table = None   # terminal_table[u_id] = True if the state is terminal
+        self.one_hot_cache = {}      # dict {(num_agents, is_monolithic): (encodings, valid)} see get_one_hot_encodings
         if file is not None:
             self._load_reward_machine(file)
         # One hot encoding setup for reward machine states and decomp idx
@@ -131,12 +157,139 @@ class SparseRewardMachine:
 
         return all_origins 
 
+    def compile(self):
+        """Intern states and events to contiguous integer ids and build dense NumPy 
+        transition tables. The dict based API (get_next_state, get_reward, ...) stays the 
+        source of truth; the tables and the ids are a read-only snapshot of it and are dropped 
+        whenever a transition is added through one of the add_transition methods (see 
+        clear_compiled). The id getters compile again on their next call, ids taken before 
+        that belong to the old snapshot and must not be used with the new one.
+
+        An extra null event column (id len(self.event_ids)) is appended, on which every state 
+        self-loops. Unknown events are mapped to it, mirroring get_next_state."""
+        states = list(self.U)
+        seen = set(states)
+        events = set(self.events)
+        for u1, transitions in self.delta_u.items():
+            for u in [u1, *transitions.values()]:
+                if u not in seen:
+                    seen.add(u)
+                    states.append(u)
+            events.update(transitions.keys())
+        for u1, rewards in self.delta_r.items():
+            for u in [u1, *rewards.keys()]:
+                if u not in seen:
+                    seen.add(u)
+                    states.append(u)
+
+        self.id_to_state = states
+        self.state_ids = {u: i for i, u in enumerate(states)}
+        self.id_to_event = sorted(events, key=str)
+        self.event_ids = {e: j for j, e in enumerate(self.id_to_event)}
+
+        self.one_hot_cache = {}
+        num_states = len(self.id_to_state)
+        null_event = len(self.id_to_event)
+        next_state_table = np.repeat(np.arange(num_states, dtype=np.int64)[:, None], null_event + 1, axis=1)
+        reward_table = np.zeros((num_states, null_event + 1), dtype=np.float64)
+        for u1, i in self.state_ids.items():
+            # falling off the reward machine keeps the state, exactly like get_next_state
+            reward_table[i, :] = self.get_reward(u1, u1)
+            for event, u2 in self.delta_u.get(u1, {}).items():
+                next_state_table[i, self.event_ids[event]] = self.state_ids[u2]
+                reward_table[i, self.event_ids[event]] = self.get_reward(u1, u2)
+        terminal_table = np.array([u in self.T for u in self.id_to_state], dtype=bool)
+
+        for table in (next_state_table, reward_table, terminal_table):
+            table.setflags(write=False)
+        self.next_state_table = next_state_table
+        self.reward_table = reward_table
+        self.terminal_table = terminal_table
+
+    def is_compiled(self):
+        return self.next_state_table is not None
+
+    def clear_compiled(self):
+        """Drops the compiled tables and the state and event ids, after the dicts were changed."""
+        self.state_ids = {}
+        self.event_ids = {}
+        self.id_to_state = []
+        self.id_to_event = []
+        self.next_state_table = None
+        self.reward_table = None
+        self.terminal_table = None
+        self.one_hot_cache = {}
+
+    def get_state_id(self, u):
+        if not self.is_compiled():
+            self.compile()
+        if u not in self.state_ids:
+            raise ValueError("State {} is not part of the compiled reward machine!".format(u))
+        return self.state_ids[u]
+
+    def get_event_id(self, event):
+        """Returns the id of the event, or the null event id if the event is unknown."""
+        return self.event_ids.get(event, self.get_null_event_id())
+
+    def get_null_event_id(self):
+        """Returns the id of the null event, on which every state self-loops."""
+        if not self.is_compiled():
+            self.compile()
+        return len(self.id_to_event)
+
+    def get_state_from_id(self, state_id):
+        if not self.is_compiled():
+            self.compile()
+        return self.id_to_state[state_id]
+
+    def get_next_state_id(self, u_id, e_id):
+        if not self.is_compiled():
+            self.compile()
+        return int(self.next_state_table[u_id, e_id])
+
+    def get_state_ids(self, states):
+        if not self.is_compiled():
+            self.compile()
+        return np.array([self.get_state_id(u) for u in states], dtype=np.int64)
+
+    def get_event_ids(self, events):
+        """Returns an array with the id of each event (unknown events map to the null event)."""
+        null_event = self.get_null_event_id()
+        return np.array([self.event_ids.get(e, null_event) for e in events], dtype=np.int64)
+
+    def step_batch(self, state_ids, event_ids):
+        """
+        Vectorized transition for a whole batch of reward machine states (e.g. envs x agents).
+
+        :param state_ids: integer array of current state ids with any shape S.
+        :param event_ids: integer array broadcastable to S + (L,), holding a sequence of L events 
+                          that is applied in order to every entry. Pad shorter sequences with the 
+                          null event id (get_null_event_id()).
+        :return: (next_state_ids, rewards, is_terminal), arrays of shape S. Rewards are summed 
+                 over the event sequence.
+        The ids must come from the current compile: after the reward machine was changed, get 
+        them again with get_state_ids / get_event_ids, which compile it.
+        """
+        if not self.is_compiled():
+            raise ValueError("The reward machine changed (or was never compiled) since the ids were taken, get them again with get_state_ids / get_event_ids")
+        state_ids = np.asarray(state_ids, dtype=np.int64)
+        event_ids = np.asarray(event_ids, dtype=np.int64)
+        event_ids = np.broadcast_to(event_ids, state_ids.shape + event_ids.shape[-1:])
+
+        rewards = np.zeros(state_ids.shape, dtype=self.reward_table.dtype)
+        for k in range(event_ids.shape[-1]):
+            e = event_ids[..., k]
+            rewards += self.reward_table[state_ids, e]
+            state_ids = self.next_state_table[state_ids, e]
+        return state_ids, rewards, self.terminal_table[state_ids]
+
     def find_max_subgraph_size_and_assign_subtasks(self):
         """Find the largest subgraph connected to u0, store its size in self.max_subtask_size, 
         assign subtasks, and save the number of subtasks and the starting state of each subtask."""  # Track visited states
         largest_size = 0
         subtask_number = 0
         self.subtask_start_states = {}  # Reset subtask start states
+        self.one_hot_cache = {}  # Encodings depend on the subtask assignment
 
         # Iterate through neighbors of u0, treating each as the root of a subgraph
         for event, next_state in self.delta_u.get(self.u0, {}).items():
@@ -155,12 +308,132 @@ class SparseRewardMachine:
         self.num_subtasks = subtask_number  # Save the total number of subtasks
         return largest_size
     
+    def save_npz(self, file, decomps_init_states=None):
+        """
+        Saves the compiled reward machine to an uncompressed .npz file: the dense transition 
+        tables, the sparse delta_u / delta_r entries (to rebuild the dict API), the state and 
+        event vocabularies, the subtask assignment and optionally the decomposition initial 
+        states returned by generate_rm_decompositions. Only integer states are supported.
+
+        :param file: path of the .npz file.
+        :param decomps_init_states: dict {decomp idx: {agent idx: initial state}}.
+        """
+        if not self.is_compiled():
+            self.compile()
+        if not all(isinstance(u, (int, np.integer)) for u in self.id_to_state):
+            raise ValueError("Only reward machines with integer states can be saved to .npz")
+        sid, eid = self.state_ids, self.event_ids
+        delta_u = [(sid[u1], eid[e], sid[u2]) for u1, td in self.delta_u.items() for e, u2 in td.items()]
+        delta_r = [(sid[u1], sid[u2]) for u1, rd in self.delta_r.items() for u2 in rd]
+        init_states = [(d, a, u) for d, agent_states in (decomps_init_states or {}).items() for a, u in agent_states.items()]
+        
+        np.savez(file,
+                 format_version=np.array(NPZ_FORMAT_VERSION),
+                 states=np.array(self.id_to_state, dtype=np.int64),
+                 events=np.array(self.id_to_event, dtype=str),
+                 events_mask=np.array([e in self.events for e in self.id_to_event], dtype=bool),
+                 next_state_table=self.next_state_table,
+                 reward_table=self.reward_table,
+                 terminal_table=self.terminal_table,
+                 accepting_mask=np.array([u in self.accepting for u in self.id_to_state], dtype=bool),
+                 u0=np.array(-1 if self.u0 is None else sid[self.u0]),
+                 delta_u_states=np.array([sid[u] for u in self.delta_u], dtype=np.int64),
+                 delta_u=np.array(delta_u, dtype=np.int64).reshape(-1, 3),
+                 delta_r_states=np.array([sid[u] for u in self.delta_r], dtype=np.int64),
+                 delta_r=np.array(delta_r, dtype=np.int64).reshape(-1, 2),
+                 delta_r_values=np.array([r for rd in self.delta_r.values() for r in rd.values()]),
+                 state_to_subtask=np.array([(sid[u], k) for u, k in self.state_to_subtask.items()], dtype=np.int64).reshape(-1, 2),
+                 state_to_subtask_idx=np.array([(sid[u], k) for u, k in self.state_to_subtask_idx.items()], dtype=np.int64).reshape(-1, 2),
+                 subtask_start_states=np.array([(k, sid[u]) for k, u in self.subtask_start_states.items()], dtype=np.int64).reshape(-1, 2),
+                 subtask_sizes=np.array([self.max_subtask_size, self.num_subtasks], dtype=np.int64),
+                 is_monolithic=np.array(self.is_monolithic),
+                 decomps_init_states=np.array(init_states, dtype=np.int64).reshape(-1, 3))
+
+    def load_rm_from_npz(self, file, mmap_mode=None):
+        """
+        Loads a reward machine written by save_npz into this object, without recompiling. 
+        With mmap_mode (e.g. 'r') the arrays are memory-mapped from the file instead of read.
+
+        Returns: decomps_init_states, dict {decomp idx: {agent idx: initial state}} 
+        """
+        data = _load_npz(file, mmap_mode)
+        if int(data['format_version']) != NPZ_FORMAT_VERSION:
+            raise ValueError("{}: unsupported reward machine format version {}".format(file, int(data['format_version'])))
+        states = data['states'].tolist()
+        events = data['events'].tolist()
+        rewards = data['delta_r_values'].tolist()
+
+        self.id_to_state = states
+        self.state_ids = {u: i for i, u in enumerate(states)}
+        self.id_to_event = events
+        self.event_ids = {e: j for j, e in enumerate(events)}
+        self.next_state_table = data['next_state_table']
+        self.reward_table = data['reward_table']
+        self.terminal_table = data['terminal_table']
+        for table in (self.next_state_table, self.reward_table, self.terminal_table):
+            table.setflags(write=False)
+
+        self.set_states(self.id_to_state)
+        self.events = {e for e, kept in zip(events, data['events_mask']) if kept}
+        self.T = {u for u, terminal in zip(states, self.terminal_table) if terminal}
+        self.accepting = {u for u, accepting in zip(states, data['accepting_mask']) if accepting}
+        self.u0 = None if int(data['u0']) == -1 else states[int(data['u0'])]
+        self.delta_u = {states[i]: {} for i in data['delta_u_states'].tolist()}
+        for i, j, k in data['delta_u'].tolist():
+            self.delta_u[states[i]][events[j]] = states[k]
+        self.delta_r = {states[i]: {} for i in data['delta_r_states'].tolist()}
+        for (i, k), r in zip(data['delta_r'].tolist(), rewards):
+            self.delta_r[states[i]][states[k]] = r
+
+        self.one_hot_cache = {}
+        self.state_to_subtask = {states[i]: k for i, k in data['state_to_subtask'].tolist()}
+        self.state_to_subtask_idx = {states[i]: k for i, k in data['state_to_subtask_idx'].tolist()}
+        self.subtask_start_states = {k: states[i] for k, i in data['subtask_start_states'].tolist()}
+        self.max_subtask_size, self.num_subtasks = data['subtask_sizes'].tolist()
+        self.is_monolithic = bool(data['is_monolithic'])
+
+        decomps_init_states = {}
+        for d, a, u in data['decomps_init_states'].tolist():
+            decomps_init_states.setdefault(d, {})[a] = u
+        return decomps_init_states
+
     def get_one_hot_size(self, num_agents):
         if self.is_monolithic:
             return len(self.get_states())
         return (self.num_subtasks) + num_agents + self.max_subtask_size
 
+    def get_one_hot_encodings(self, num_agents):
+        """Returns a read-only (num_states, num_agents, one_hot_size) matrix holding the encoding 
+        of every (state id, agent_idx) pair for the current layout (monolithic or subtask), and 
+        a boolean mask of the state ids that have a valid encoding. Built once and cached."""
+        if not self.is_compiled():
+            self.compile()
+        key = (num_agents, self.is_monolithic)
+        if key not in self.one_hot_cache:
+            encodings = np.zeros((len(self.id_to_state), num_agents, self.get_one_hot_size(num_agents)), dtype=int)
+            valid = np.ones(len(self.id_to_state), dtype=bool)
+            for i, state in enumerate(self.id_to_state):
+                try:
+                    for agent_idx in range(num_agents):
+                        encodings[i, agent_idx] = self._encode_one_hot_state(state, num_agents, agent_idx)
+                except (ValueError, IndexError):
+                    valid[i] = False # e.g. the auxiliary state, which belongs to no subtask
+            encodings.setflags(write=False)
+            valid.setflags(write=False)
+            self.one_hot_cache[key] = (encodings, valid)
+        return self.one_hot_cache[key]
+
     def get_one_hot_encoded_state(self, state, num_agents, agent_idx):
+        """Returns the one-hot encoding of the given state for agent_idx as a row of the 
+        cached encoding matrix (see get_one_hot_encodings). The row is read-only."""
+        encodings, valid = self.get_one_hot_encodings(num_agents)
+        state_id = self.state_ids.get(state)
+        if state_id is None or not valid[state_id]:
+            # raises the same errors as before for states without an encoding
+            return self._encode_one_hot_state(state, num_agents, agent_idx)
+        return encodings[state_id, agent_idx]
+
+    def _encode_one_hot_state(self, state, num_agents, agent_idx):
         """Returns 3 one-hot encoded arrays for the given state."""
         """given state number, need to know: which decomp, which subtask,
         first 2 things already done
@@ -196,14 +469,24 @@ class SparseRewardMachine:
     # Private methods -----------------------------------
 
     def _dfs_subgraph_size_and_assign(self, state, visited, subtask_number):
-        """Helper function to perform DFS, return the size of the subgraph, and assign the subtask number."""
+        """Helper function to perform DFS, return the size of the subgraph, and assign the subtask number.
+        Uses an explicit stack (same visiting order as the recursive version) so that large 
+        reward machines do not hit the recursion limit."""
         visited.add(state)
         self.state_to_subtask[state] = subtask_number  # Assign the state to its subtask
 
         size = 1  # Include the current node
-        for event, next_state in self.delta_u.get(state, {}).items():
-            if next_state not in visited:
-                size += self._dfs_subgraph_size_and_assign(next_state, visited, subtask_number)
+        stack = [iter(self.delta_u.get(state, {}).values())]
+        while stack:
+            for next_state in stack[-1]:
+                if next_state not in visited:
+                    visited.add(next_state)
+                    self.state_to_subtask[next_state] = subtask_number
+                    size += 1
+                    stack.append(iter(self.delta_u.get(next_state, {}).values()))
+                    break
+            else:
+                stack.pop()
         return size
 
     def _load_reward_machine(self, file):
@@ -224,19 +507,22 @@ class SparseRewardMachine:
         lines = [l.rstrip() for l in f]
         f.close()
         # setting the DFA
-        self._load_reward_machine_from_str_lines(lines)
+        try:
+            self._load_reward_machine_from_str_lines(lines)
+        except ValueError as e:
+            raise ValueError("{}: {}".format(file, e)) from None
     
     def _load_reward_machine_from_str_lines(self, lines):
-        self.u0 = eval(lines[0])
+        self.u0, transitions = parse_reward_machine_lines(lines)
         # adding transitions
-        for e in lines[1:]:
-            self._add_transition(*eval(e))
-            self.events.add(eval(e)[2]) # By convention, the event is in the spot indexed by 2
+        for u1, u2, event, reward in transitions:
+            self._set_transition(u1, u2, event, reward)
+            self._add_state((u1, u2))
+            self.events.add(event)
         # adding terminal states
-        for u1 in self.U:
-            if self._is_terminal(u1):
-                self.T.add(u1)
-        self.U = sorted(self.U)
+        self.T.update(u for u in self._get_terminal_states() if u in self.state_set)
+        self.set_states(sorted(self.U))
+        self.compile()
 
     def calculate_reward(self, trace):
         total_reward = 0
@@ -256,15 +542,34 @@ class SparseRewardMachine:
                 if self.delta_r[u0][u1] == 1 or self.delta_r[u0][u1] == -1:
                     return True
         return False
+
+    def _get_terminal_states(self):
+        """Returns every state that _is_terminal would accept, in a single pass over delta_r."""
+        terminal_states = set()
+        for rewards in self.delta_r.values():
+            for u2, reward in rewards.items():
+                if reward == 1 or reward == -1:
+                    terminal_states.add(u2)
+        return terminal_states
             
+    def set_states(self, states):
+        """Replaces the machine states U (and state_set with them)."""
+        self.U = list(states)
+        self.state_set = set(self.U)
+
     def _add_state(self, u_list):
         for u in u_list:
-            if u not in self.U:
+            if u not in self.state_set:
+                self.state_set.add(u)
                 self.U.append(u)
 
     def _add_transition(self, u1, u2, event, reward):
         # Adding machine state
         self._add_state([u1,u2])
+        self._set_transition(u1, u2, event, reward)
+
+    def _set_transition(self, u1, u2, event, reward):
+        self.clear_compiled() # tables and ids no longer reflect the dicts
         # Adding state-transition to delta_u
         if u1 not in self.delta_u:
             self.delta_u[u1] = {}
@@ -282,6 +587,7 @@ class SparseRewardMachine:
             self.accepting.add(u2)
             
     def add_transition_open(self, u1, u2, event, reward):
+        self.clear_compiled() # tables and ids no longer reflect the dicts
         # Adding machine state
         self._add_state([u1,u2])
         # Adding state-transition to delta_u
@@ -311,6 +617,7 @@ class SparseRewardMachine:
             event: string, element of rm.events
             reward: int or float (probably 0 or 1)
         '''
+        self.clear_compiled() # tables and ids no longer reflect the dicts
         # add transition 
         if u1 not in self.delta_u:
             self.delta_u[u1] = {}
@@ -345,6 +652,100 @@ class SparseRewardMachine:
 
         return name_full[0]
 
+def _load_npz(file, mmap_mode=None):
+    '''
+    Reads every array of an .npz file into a dict. np.load ignores mmap_mode for .npz archives, 
+    so with mmap_mode the uncompressed members are memory-mapped directly from the zip file.
+    '''
+    if mmap_mode is None:
+        with np.load(file, allow_pickle=False) as data:
+            return {name: data[name] for name in data.files}
+
+    arrays = {}
+    with zipfile.ZipFile(file) as archive, open(file, 'rb') as f:
+        for info in archive.infolist():
+            name = info.filename[:-len('.npy')]
+            if info.compress_type != zipfile.ZIP_STORED:
+                arrays[name] = np.load(archive.open(info), allow_pickle=False)
+                continue
+            # the member data starts after its local file header (30 bytes + name + extra field)
+            f.seek(info.header_offset + 26)
+            name_length, extra_length = struct.unpack('<HH', f.read(4))
+            f.seek(info.header_offset + 30 + name_length + extra_length)
+            version = np.lib.format.read_magic(f)
+            if version == (1, 0):
+                shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+            else:
+                shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+            if dtype.hasobject:
+                raise ValueError("{}: object arrays cannot be memory-mapped".format(file))
+            if int(np.prod(shape)) == 0:
+                arrays[name] = np.zeros(shape, dtype=dtype)
+                continue
+            arrays[name] = np.memmap(file, dtype=dtype, mode=mmap_mode, shape=shape, 
+                                     order='F' if fortran_order else 'C', offset=f.tell())
+    return arrays
+
+def _tokenize_rm_line(line, line_number):
+    """Splits a reward machine file line into (kind, text) tokens, dropping comments."""
+    tokens = []
+    pos = 0
+    line = line.rstrip()
+    while pos < len(line):
+        match = _RM_TOKEN.match(line, pos)
+        kind = match.lastgroup
+        if kind == 'comment':
+            break
+        if kind == 'error':
+            raise ValueError("line {}: unexpected character {!r} in {!r}".format(line_number, match.group(kind), line))
+        text = match.group(kind)
+        tokens.append((text if kind == 'punct' else kind, text))
+        pos = match.end()
+    return tokens
+
+def _parse_rm_number(text, line_number, integer=False):
+    if _RM_INT.fullmatch(text):
+        return int(text)
+    if integer:
+        raise ValueError("line {}: reward machine states must be integers, got {!r}".format(line_number, text))
+    return float(text)
+
+def parse_reward_machine_lines(lines):
+    '''
+    Parses the lines of a reward machine file without eval(). 
+    The first non-empty line holds the initial state, every following non-empty line a 
+    transition (current state, next state, 'event', reward). Comments start with #.
+
+    Returns: (u0, [(u1, u2, event, reward), ...])
+    Raises ValueError with the offending line number on malformed or non-deterministic input.
+    '''
+    u0 = None
+    transitions = []
+    seen = set() # (u1, event) pairs, the transition function has to be deterministic
+    for line_number, line in enumerate(lines, start=1):
+        tokens = _tokenize_rm_line(line, line_number)
+        if not tokens:
+            continue
+        kinds = [kind for kind, _ in tokens]
+        if u0 is None:
+            if kinds != ['number']:
+                raise ValueError("line {}: expected the initial state, got {!r}".format(line_number, line))
+            u0 = _parse_rm_number(tokens[0][1], line_number, integer=True)
+            continue
+        if kinds != _RM_TRANSITION_SHAPE:
+            raise ValueError("line {}: expected (u1, u2, 'event', reward), got {!r}".format(line_number, line))
+        u1 = _parse_rm_number(tokens[1][1], line_number, integer=True)
+        u2 = _parse_rm_number(tokens[3][1], line_number, integer=True)
+        event = tokens[5][1][1:-1]
+        reward = _parse_rm_number(tokens[7][1], line_number)
+        if (u1, event) in seen:
+            raise ValueError("line {}: trying to make rm transition function non-deterministic ({}, {!r} already defined)".format(line_number, u1, event))
+        seen.add((u1, event))
+        transitions.append((u1, u2, event, reward))
+    if u0 is None:
+        raise ValueError("reward machine has no initial state")
+    return u0, transitions
+
 def rm_to_dfa(reward_machine):
     '''
     Convert a reward machine object to a DFA for usage in DFA decomposition.
@@ -413,10 +814,9 @@ def combine_to_single_rm(rm_dict, tag="rm", skip_aux=False):
                 subsuming_rm.delta_u[u_k + current_offset][event] = next_st + current_offset
         current_offset += len(rm_obj.get_states())
 
-    for u1 in subsuming_rm.U:
-        if subsuming_rm._is_terminal(u1):
-            subsuming_rm.T.add(u1)
-    subsuming_rm.U = sorted(subsuming_rm.U)
+    subsuming_rm.T.update(u for u in subsuming_rm._get_terminal_states() if u in subsuming_rm.state_set)
+    subsuming_rm.set_states(sorted(subsuming_rm.U))
+    subsuming_rm.compile()
     return subsuming_rm, sub_rm_initial_states
 
 
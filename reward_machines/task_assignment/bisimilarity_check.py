@@ -1,4 +1,5 @@
 import itertools
+from collections import deque
 from reward_machines.sparse_reward_machine import SparseRewardMachine
 import reward_machines.task_assignment.helper_functions as hf
 
@@ -8,6 +9,9 @@ class EquivalenceRelation:
         - reflexive: a ~ a
         - symmetric: a ~ b -> b ~ a
         - transitive: a ~ b, b ~ c -> a ~ c
+
+    Backed by a disjoint-set forest (path compression + union by rank), so finding and merging 
+    classes is near constant time. Each root also keeps the set of its class members.
     '''
     def __init__(self, classes = None):
         '''
@@ -15,14 +19,23 @@ class EquivalenceRelation:
         classes: list of sets
         
         Attributes
-            classes: list holding a set of each equivalence class
+            classes: list holding a set of each equivalence class, ordered by when the class was 
+                     last created or merged (read only, built from the forest)
+            parent: {element: parent element}, roots are their own parent 
+            rank: {root: upper bound on the height of its tree}
+            members: {root: set of the elements in its class}
         '''
-        if classes == None:
-            self.classes = []
-        else:
-            self.classes = classes
-
-        self.check_classes()
+        self.parent = {}
+        self.rank = {}
+        self.members = {}
+        self.last_update = {} # {root: counter value of its last creation/merge}, orders self.classes
+        self.update_counter = 0
+
+        if classes != None:
+            for cl in classes:
+                if any(e in self.parent for e in cl):
+                    raise NameError(" Classes are not disjoint")
+                self.add_new_class(cl)
 
     def __repr__(self):
         s = "Equivalence Classes: \n"
@@ -30,29 +43,75 @@ class EquivalenceRelation:
             s += "    " + str(cl) + "\n"
         return s
 
+    @property
+    def classes(self):
+        return [self.members[root] for root in sorted(self.members, key = self.last_update.get)]
+
+    def find(self, element):
+        '''
+        Returns the root (representative) of the class of element, compressing the path to it.
+        The element must already belong to a class.
+        '''
+        root = element
+        while self.parent[root] != root:
+            root = self.parent[root]
+        while self.parent[element] != root:
+            self.parent[element], element = root, self.parent[element]
+        return root
+
+    def _touch(self, root):
+        self.last_update[root] = self.update_counter
+        self.update_counter += 1
+
+    def _union(self, root_1, root_2):
+        '''
+        Links two roots by rank and returns the new root. The smaller member set is merged into the larger.
+        '''
+        if root_1 == root_2:
+            return root_1
+        if self.rank[root_1] < self.rank[root_2]:
+            root_1, root_2 = root_2, root_1
+        self.parent[root_2] = root_1
+        if self.rank[root_1] == self.rank[root_2]:
+            self.rank[root_1] += 1
+        if len(self.members[root_1]) < len(self.members[root_2]):
+            self.members[root_1], self.members[root_2] = self.members[root_2], self.members[root_1]
+        self.members[root_1] |= self.members.pop(root_2)
+        self.rank.pop(root_2)
+        self.last_update.pop(root_2)
+        return root_1
+
+    def merge_roots(self, root_1, root_2):
+        '''
+        Merges the classes of two roots (see find) and returns the root of the merged class
+        '''
+        root = self._union(root_1, root_2)
+        self._touch(root)
+        return root
+
+    def _add_to_root(self, element, root):
+        self.parent[element] = root
+        self.members[root].add(element)
         
     def add_relation(self, elements):
         '''
         Inputs
             elements: (list) holds strings of elements to be added to related * MAYBE CHANGE TO TUPLE?
         '''
-        #print("     I am adding a relation", elements)
-        cls = []
-        for e in elements:
-            cl = self.find_class(e) 
-            if cl:
-                if cl not in cls:
-                    cls.append(cl)
+        roots = [self.find(e) for e in elements if e in self.parent]
     
-        if cls: # at least one element belongs in a class already
-            new_cl = self.merge_classes(cls)  #if only one element in cls, returns cls[0]
-            self.add_elements_to_class(elements, new_cl)  
+        if roots: # at least one element belongs in a class already
+            root = roots[0]
+            for other in roots[1:]:
+                root = self._union(root, other)
+            for e in elements:
+                if e not in self.parent:
+                    self._add_to_root(e, root)
+            self._touch(root)
         
         else:
             self.add_new_class(elements) 
 
-        self.check_classes() 
-
     def find_class(self, element):
         '''
         Finds class the element belongs to
@@ -62,11 +121,9 @@ class EquivalenceRelation:
             cl: (set) The set containing the element if element is already in a class
                 (None) if element is not in a set
         '''
-        for cl in self.classes:
-            if element in cl:
-                return cl
-        #print('Element', element, "classes", self.classes)
-        return None 
+        if element not in self.parent:
+            return None 
+        return self.members[self.find(element)]
             
     def merge_classes(self, cls):
         '''
@@ -78,13 +135,11 @@ class EquivalenceRelation:
         Return:
             megacl: (set) merged classes
         '''
-        megacl = set()
-        for cl in cls:
-            megacl = megacl.union(cl) # build merged class
-            self.classes.remove(cl) # remove individual classes
-
-        self.classes.append(megacl) # add merged class
-        return megacl
+        root = self.find(next(iter(cls[0])))
+        for cl in cls[1:]:
+            root = self._union(root, self.find(next(iter(cl))))
+        self._touch(root)
+        return self.members[root]
         
     def add_elements_to_class(self, elements, cl):
         '''
@@ -93,8 +148,12 @@ class EquivalenceRelation:
             elements: (list) contains strings or int to be added to cl
             cl: (set) equivalence class 
         '''  
+        root = self.find(next(iter(cl)))
         for e in elements:
-            cl.add(e)
+            if e not in self.parent:
+                self._add_to_root(e, root)
+            else:
+                root = self._union(root, self.find(e))
 
     def add_new_class(self, elements):
         '''
@@ -102,18 +161,30 @@ class EquivalenceRelation:
 
         elements: List or tuple of elements 
         '''
-        new_class = set()
+        if any(e in self.parent for e in elements):
+            raise NameError(" Classes are not disjoint")
+        root = None
         for e in elements:
-            new_class.add(e)
-        self.classes.append(new_class)
+            if e in self.parent: # repeated element, e.g. the pair (u, u)
+                continue
+            if root is None:
+                root = e
+                self.parent[e] = e
+                self.rank[e] = 0
+                self.members[e] = {e}
+            else:
+                self._add_to_root(e, root)
+        if root is not None:
+            self._touch(root)
 
     def check_classes(self):
         '''
         checks that your equivalence classes are disjoint 
+        (always true for the disjoint-set forest, kept as a consistency check)
         '''
         full_union = set()
         
-        for cl in self.classes:
+        for cl in self.members.values():
             for e in cl:
                 if e in full_union:
                     raise NameError(" Classes are not disjoint")
@@ -128,19 +199,16 @@ class EquivalenceRelation:
         Returns:
             Bool, true if elements are related, false otherwise 
         '''  
-        cls = []
+        if len(elements) == 0: 
+            Warning("You are asking if an empty set of elements are related. Returned False")
+            return False
+
+        roots = set()
         for e in elements:
-            e_cl = self.find_class(e)
-            if e_cl == None: # element is not in any equivalence class, elements cannot be related
+            if e not in self.parent: # element is not in any equivalence class, elements cannot be related
                 return False 
-            cls.append(e_cl)
-        if len(cls) == 1:
-            return True
-
-        if len(cls) == 0: 
-            Warning("You are asking if an empty set of elements are related. Returned False")
-        
-        return False #elements belonged to more than one equivalenc class
+            roots.add(self.find(e))
+        return len(roots) == 1 # False if elements belonged to more than one equivalence class
 
     def get_all_related_combos(self):
         '''
@@ -152,17 +220,23 @@ class EquivalenceRelation:
         Returns: list set of sets
         '''
         all_related_combos = set()
-        for cl in self.classes:
+        for cl in self.members.values():
             related_combos= set(itertools.combinations(cl, 2))
             for x in related_combos:
                 all_related_combos.add(x)
         return all_related_combos    
 
+
 def get_relation(event_space, rm):
     '''
     generates equivalence class relation given set of events and a reward machine
     Follows definition of equivalence relation outlined in Cyrus' paper (above Def 2)
 
+    Worklist congruence closure: states joined by an event outside event_space are merged, and 
+    whenever two classes merge, their successors under each shared event in event_space are queued 
+    to be merged too. Each class keeps one successor per event, so every transition is looked at a 
+    constant number of times.
+
     Inputs
         event_space: (set) set of strings, subset of rm.events
         rm: (SparseRewardMachine)
@@ -171,42 +245,36 @@ def get_relation(event_space, rm):
 
     '''
     relation = EquivalenceRelation()
+    successors = {} # {root: {e: a successor state of the class under e}}, e in event_space
+    to_merge = []
+
+    for u in rm.U:
+        relation.add_new_class([u])
+        successors[u] = {}
+        for e, v in rm.delta_u.get(u, {}).items():
+            if e in event_space:
+                successors[u][e] = v
+            elif v in rm.state_set:
+                to_merge.append((u, v))
+
+    while to_merge:
+        u, v = to_merge.pop()
+        if relation.find_class(v) is None: # successor outside rm.U
+            relation.add_new_class([v])
+            successors[v] = {}
+        root_u, root_v = relation.find(u), relation.find(v)
+        if root_u == root_v:
+            continue
+        succ_u, succ_v = successors.pop(root_u), successors.pop(root_v)
+        if len(succ_u) < len(succ_v):
+            succ_u, succ_v = succ_v, succ_u
+        for e, v2 in succ_v.items():
+            if e in succ_u:
+                to_merge.append((succ_u[e], v2))
+            else:
+                succ_u[e] = v2
+        successors[relation.merge_roots(root_u, root_v)] = succ_u
 
-    state_pairs = list(itertools.combinations_with_replacement(rm.U, 2)) # all combinations length 2 of rm.U (order doesn't matter)
-    #print("     state pairs", state_pairs)
-    for state_pair in state_pairs: # pair is a tuple
-        if relation.are_related(state_pair) == False:
-            #print("     ", state_pair , " is related")
-            #print("     here", rm.events - event_space )
-            u1, u2 = state_pair
-            if u1 == u2:
-                relation.add_relation(state_pair)
-
-            for e in rm.events - event_space:
-                if rm.is_event_available(u1,e):
-                    if rm.delta_u[u1][e] == u2:
-                        relation.add_relation(state_pair)
-
-                if rm.is_event_available(u2,e):
-                    if rm.delta_u[u2][e] == u1: 
-                        relation.add_relation(state_pair)
-        else:
-            print("     ", state_pair, " is not related")
-    checked_combos = set()
-    all_related_combos = relation.get_all_related_combos()
-
-    while len(all_related_combos) != 0:
-        for u1, v1 in all_related_combos:
-            for e in event_space: 
-                if rm.is_event_available(u1,e) and rm.is_event_available(v1,e): 
-                    u2 = rm.delta_u[u1][e]
-                    v2 = rm.delta_u[v1][e]
-                    relation.add_relation((u2, v2))
-            checked_combos.add((u1, v1))
-            checked_combos.add((v1, u1))
-
-        all_related_combos = relation.get_all_related_combos() - checked_combos 
-    
     return relation
 
 def project_rm(event_space, rm):
@@ -230,10 +298,13 @@ def project_rm(event_space, rm):
     new_rm = SparseRewardMachine()
     class_name_dict = {}
     new_rm.events = event_space
-    for i , cl in enumerate(relation.classes):
-        # add states to new_rm
-        new_rm.U.append(i)
+    root_names = {} # {root of class in relation: new state name}
+    classes = relation.classes
+    # add states to new_rm, one per class
+    new_rm.set_states(range(len(classes)))
+    for i , cl in enumerate(classes):
         class_name_dict[i] = cl # new state name: class of original RM state names it represents 
+        root_names[relation.find(next(iter(cl)))] = i
         
         for u in cl:
             # check if cl should be terminal or inital 
@@ -251,13 +322,8 @@ def project_rm(event_space, rm):
         for e, v2 in v1_transitions.items():
             if e in event_space:
                 #need to find what class_name for v1 and v2 belongs to. 
-                 
-                v1_class = relation.find_class(v1)
-                v2_class = relation.find_class(v2)
-
-                #print("V1_CLass is", v1_class)
-                v1_name = new_rm.get_name_from_class(v1_class)
-                v2_name = new_rm.get_name_from_class(v2_class)
+                v1_name = root_names[relation.find(v1)]
+                v2_name = root_names[relation.find(v2)]
                 if v2_name in new_rm.T and v1_name not in new_rm.T:
                     reward = 1
                 else: 
@@ -278,7 +344,7 @@ def put_in_parallel(rm1, rm2):
     rm_parallel = SparseRewardMachine()
 
     U_parallel = itertools.product(rm1.U, rm2.U)
-    rm_parallel.U = U_parallel
+    rm_parallel.set_states(U_parallel)
 
     events_parallel = rm1.events.union(rm2.events)
     rm_parallel.events = events_parallel
@@ -373,7 +439,7 @@ def put_many_in_parallel(rms):
     
     # build parallel state space (cartesian product of all of the rm state spaces)
     U_parallel = list(itertools.product(*U_collection))
-    rm_parallel.U = U_parallel
+    rm_parallel.set_states(U_parallel)
     
     # get parallel event space 
     events_collection = [rm.events for rm in rms]
@@ -439,42 +505,152 @@ def put_many_in_parallel(rms):
     
     return rm_parallel
 
-def is_bisimilar(rm_1, rm_2):
-    #rm_2 = rm_parallel
-    R = [] #line 1 # should this be a set? 
-    todo = [] #line1
-    rm_1_o = rm_1.get_initial_state()
-    rm_2_o = rm_2.get_initial_state()
-    todo.append((rm_1_o , rm_2_o)) #line 2
-
-    #print("starting todo ", todo)
-    while todo: # line 3
-        # need to remove m from todo
-        m = todo[0] # line 3.1
-        todo.remove(m)
-        x, y = m 
+class LazyParallelRewardMachine:
+    '''
+    Parallel composition of several reward machines (same definition as put_many_in_parallel) 
+    whose transitions are only computed when asked for, and memoised. is_bisimilar only visits 
+    the product states reachable from the initial tuple, so the full Cartesian product is never built.
 
-        if m not in R:  # line 3.2  really says, if m in R then skip # TODO: check skip meaning 
-            # Do everything below 
+    Offers the parts of the SparseRewardMachine interface used by is_bisimilar and is_decomposable.
+    '''
+    def __init__(self, rms):
+        '''
+        Inputs
+            rms: (list) holding SparseRewardMachines
+        '''
+        self.rms = rms
+        self.events = set().union(*[rm.events for rm in rms])
+        self.u0 = tuple(rm.u0 for rm in rms)
+        self.equivalence_class_name_dict = {i: rm.equivalence_class_name_dict for i, rm in enumerate(rms)}
+        # {e: indices of the rms whose event space holds e}, the transition on e is only defined if all of them can take it
+        self.event_owners = {e: [i for i, rm in enumerate(rms) if e in rm.events] for e in self.events}
+        self.transitions = {} # {(u, e): next state tuple, or None if undefined}
+
+    def get_initial_state(self):
+        return self.u0
+
+    def is_terminal_state(self, u):
+        return all(rm.is_terminal_state(u[i]) for i, rm in enumerate(self.rms))
+
+    def is_event_available(self, u, event):
+        return self._get_transition(u, event) is not None
+
+    def get_next_state(self, u, event):
+        next_u = self._get_transition(u, event)
+        if next_u is None:
+            return u
+        return next_u
+
+    def get_reward(self, u1, u2, s1=None, a=None, s2=None):
+        if self.is_terminal_state(u2) and not self.is_terminal_state(u1):
+            return 1
+        return 0
+
+    def _get_transition(self, u, e):
+        key = (u, e)
+        if key not in self.transitions:
+            owners = self.event_owners.get(e, [])
+            next_u = None
+            if owners and all(self.rms[i].is_event_available(u[i], e) for i in owners):
+                next_u = tuple(rm.get_next_state(u[i], e) for i, rm in enumerate(self.rms))
+            self.transitions[key] = next_u
+        return self.transitions[key]
+
+def is_bisimilar(rm_1, rm_2, return_trace = False):
+    '''
+    Checks if rm_1 and rm_2 are bisimilar by walking the pairs of states reachable from their 
+    initial states (each pair is visited once), and comparing whether both are terminal. 
 
-            if rm_1.is_terminal_state(x) != rm_2.is_terminal_state(y): # line 3.3
-                #print("Was false, one of these is terminal and the other is not:")
-                #print("in rm_1", x, "terminal is",rm_1.T) 
-                #print("in rm_2", y, "terminal is", rm_2.T)
+    Inputs
+        rm_1: (SparseRewardMachine or LazyParallelRewardMachine) its events are the ones stepped on
+        rm_2: (SparseRewardMachine)
+        return_trace: (bool) if True, also return a counterexample trace
+    Returns
+        (bool) True if bisimilar
+        if return_trace, (bool, list) where the list holds the events leading from the initial 
+        states to the first pair where only one state is terminal (None if bisimilar)
+    '''
+    m0 = (rm_1.get_initial_state(), rm_2.get_initial_state()) #line 2
+    todo = deque([m0]) #line 1
+    R = {m0: None} # line 1, {pair: (previous pair, event)} for every pair ever put in todo
 
-                return False
-            for a in rm_1.events:  # line 3.4 # A = rm.events
-                x_next = rm_1.get_next_state(x,a) 
-                y_next = rm_2.get_next_state(y,a)
-                next_m = (x_next, y_next)
+    while todo: # line 3
+        m = todo.popleft() # line 3.1
+        x, y = m 
 
+        if rm_1.is_terminal_state(x) != rm_2.is_terminal_state(y): # line 3.3
+            if return_trace:
+                trace = []
+                while R[m] is not None:
+                    m, a = R[m]
+                    trace.append(a)
+                trace.reverse()
+                return False, trace
+            return False
+        for a in rm_1.events:  # line 3.4 # A = rm.events
+            next_m = (rm_1.get_next_state(x,a), rm_2.get_next_state(y,a))
+            if next_m not in R: # line 3.2, pairs already seen are skipped
+                R[next_m] = (m, a) # line 3.5
                 todo.append(next_m) 
-            R.append(m)  # line 3.5            
+    if return_trace:
+        return True, None
     return True #line 4
 
+def get_reverse_adjacency(rm):
+    '''
+    Builds the reverse transition index of rm in one pass over delta_u.
+    Returns
+        (dict) {u2: set of states u1 with a transition u1 -> u2}
+    '''
+    reverse_adjacency = {}
+    for u1, transitions in rm.delta_u.items():
+        for u2 in transitions.values():
+            reverse_adjacency.setdefault(u2, set()).add(u1)
+    return reverse_adjacency
+
+def get_coreachable_states(rm, final_states, reverse_adjacency = None, u0 = None):
+    '''
+    Backward BFS from final_states over the reverse transition index. Labels every state that has 
+    a transition sequence landing in final_states. 
+    If u0 is given, stops as soon as u0 is found.
+    Returns
+        (set) co-reachable states (final_states included)
+    '''
+    if reverse_adjacency is None:
+        reverse_adjacency = get_reverse_adjacency(rm)
+    coreachable = set(final_states)
+    todo = deque(coreachable)
+    while todo:
+        if u0 is not None and u0 in coreachable:
+            break
+        u2 = todo.popleft()
+        for u1 in reverse_adjacency.get(u2, ()):
+            if u1 not in coreachable:
+                coreachable.add(u1)
+                todo.append(u1)
+    return coreachable
+
+def get_reachable_states(rm, u0 = None):
+    '''
+    Forward BFS over delta_u, returns the set of states reachable from u0 (rm.u0 by default).
+    '''
+    if u0 == None:
+        u0 = rm.u0
+    reachable = {u0}
+    todo = deque([u0])
+    while todo:
+        u1 = todo.popleft()
+        for u2 in rm.delta_u.get(u1, {}).values():
+            if u2 not in reachable:
+                reachable.add(u2)
+                todo.append(u2)
+    return reachable
+
 def can_win_check(rm, goal_state = None, u0 = None):
     '''
-    Checks to see if there is a transition sequence that lands us at '''
+    Checks to see if there is a transition sequence that lands us at goal_state (or at a terminal 
+    state if goal_state is None) starting from u0 (rm.u0 if None).
+    '''
 
     if u0 == None:
         u0= rm.u0
@@ -482,34 +658,16 @@ def can_win_check(rm, goal_state = None, u0 = None):
     if goal_state != None:
         final_states = {goal_state}
     else:
-        terminal_set = rm.T
-        final_states = terminal_set.copy()
-
-    for u in final_states:
-        if u == u0: #was rm.u0
-            return True
+        final_states = rm.T
 
-    reachability_set = final_states
-    keep_searching = True
-
-    while keep_searching:
-        origins = rm.get_origins(reachability_set)
-        new_origins = origins - reachability_set
-        if len(new_origins) == 0:  
-            return False
-        for u in new_origins:
-            if u == u0: #was rm.u0
-                return True
-            reachability_set.add(u)
-
-    return False
+    return u0 in get_coreachable_states(rm, final_states, u0 = u0)
 
 def remove_rm_transitions(rm, strategy_set): # should really be called remove_transitions
     '''
     return a reward machine with only transitions in strategy_set remaining. 
     '''
     strategic_rm = SparseRewardMachine()
-    strategic_rm.U = rm.U.copy()
+    strategic_rm.set_states(rm.U)
     strategic_rm.events = strategy_set
     strategic_rm.u0 = rm.u0
     strategic_rm.T = rm.T.copy()
@@ -547,65 +705,58 @@ def remove_rm_transitions(rm, strategy_set): # should really be called remove_tr
     return(strategic_rm)
 
 def remove_unreachable_states(rm):
-    unreachable = set()
-    for u in rm.U:
-        #print("looking at ", u)
-        if not can_win_check(rm, u):
-            unreachable.add(u)
-            if u in rm.delta_u.keys():
-                rm.delta_u.pop(u)
-            if u in rm.delta_u.keys():
-                rm.delta_r.pop(u)
-
-    #print("unreachable is", unreachable) 
+    '''
+    Removes the states that cannot be reached from rm.u0 (their transitions are dropped from delta_u).
+    '''
+    reachable = get_reachable_states(rm)
     new_U = []
     for u in rm.U:
-        if u not in unreachable:
+        if u in reachable:
             new_U.append(u)
-    rm.U = new_U
-    #print("rm U is", rm.U)
+        elif u in rm.delta_u.keys():
+            rm.delta_u.pop(u)
+    rm.set_states(new_U)
 
 def remove_dead_transitions(rm):
-    #print("before dead transitions")
-    #print(rm)
+    '''
+    Removes the dead states (states that can no longer reach a terminal state) and the transitions 
+    into them. The dead states are all labelled at once by a backward BFS from rm.T.
 
-    dead_states = set()
-    bad_dict = {}
+    rm.dead_transitions is set to {v: {e: dead state}} with the removed transitions of each 
+    state v in rm.U ({} if nothing is dead). For a dead v it only holds the transitions into dead 
+    states that come before v in rm.U, as the old state-by-state removal did.
+    '''
+    coreachable = get_coreachable_states(rm, rm.T)
+    dead_order = {} # {dead state: position among the dead states of rm.U}
     for u in rm.U:
-        if can_win_check(rm, u0 = u) == False:
-            dead_states.add(u)
-            for v in rm.U:
-                if v in bad_dict.keys():
-                    bad_dict_v = bad_dict[v]
-                else:
-                    bad_dict_v = {}
-                if v != u:
-                    if v in rm.delta_u.keys():
-                        td = rm.delta_u[v].copy()
-                        for e, v2 in td.items():
-                            if v2 == u:
-                                bad_dict_v[e] = u
-                                rm.delta_u[v].pop(e)
-
-                    if v in rm.delta_r.keys():
-                        rd = rm.delta_r[v].copy()
-                        for v3, r in rd.items():
-                            if v3 == u:
-                                rm.delta_r[v].pop(u)
-                else:
-                    if u in rm.delta_u.keys():
-                        bad_dict[u] = rm.delta_u[u]
-                        rm.delta_u.pop(u)
-                    if u in rm.delta_u.keys():
-                         rm.delta_r.pop(u)
+        if u not in coreachable:
+            dead_order[u] = len(dead_order)
 
-                bad_dict[v] = bad_dict_v
+    bad_dict = {}
+    if dead_order:
+        for v in rm.U:
+            bad_dict_v = {}
+            if v in rm.delta_u.keys():
+                for e, v2 in list(rm.delta_u[v].items()):
+                    if v2 in dead_order and v2 != v:
+                        if v not in dead_order or dead_order[v2] < dead_order[v]:
+                            bad_dict_v[e] = v2
+                        rm.delta_u[v].pop(e)
+            if v in rm.delta_r.keys():
+                for v3 in list(rm.delta_r[v].keys()):
+                    if v3 in dead_order and v3 != v:
+                        rm.delta_r[v].pop(v3)
+            bad_dict[v] = bad_dict_v
+
+        for u in dead_order:
+            if u in rm.delta_u.keys():
+                rm.delta_u.pop(u)
 
     new_U = []
     for u in rm.U:
-        if u not in dead_states:
+        if u not in dead_order:
             new_U.append(u)
-    rm.U = new_U
+    rm.set_states(new_U)
     rm.dead_transitions = bad_dict 
 
 
@@ -671,9 +822,12 @@ def is_decomposable(rm_f, rm_p, agent_event_spaces_dict, num_agents, enforced_se
                             return False
                     
     ##### 5 bisimilarity holds ####
-    if not is_bisimilar(rm_p, rm_f):
-        if prints:
-            print("fails case 5, not bisimilar")
+    if prints:
+        bisimilar, trace = is_bisimilar(rm_p, rm_f, return_trace = True)
+        if not bisimilar:
+            print("fails case 5, not bisimilar, counterexample trace:", trace)
+            return False
+    elif not is_bisimilar(rm_p, rm_f):
         return False
     
     return True 
@@ -742,7 +896,7 @@ def is_decomposible_no_accidents(configs, event_spaces):
             rm_p = project_rm(es, strategic_rm)  #project each reward machine down onto the event spaces
             rms.append(rm_p)
 
-        rm_parallel = put_many_in_parallel(rms) 
+        rm_parallel = LazyParallelRewardMachine(rms) 
         bisim_check = is_bisimilar(rm_parallel, strategic_rm)
 
         check_children = True # default is to check all children even if "bisim" fails. Why not. # CHECK 
@@ -800,7 +954,7 @@ def get_accident_avoidance_rm(individual_rm, accident_set):
     acc_rm_T.add(dead_state)
 
     acc_rm = SparseRewardMachine()
-    acc_rm.U = acc_rm_u
+    acc_rm.set_states(acc_rm_u)
     acc_rm.events = acc_rm_e
     acc_rm.T = acc_rm_T
     acc_rm.u0 = acc_rm_u0
@@ -856,7 +1010,7 @@ def get_accident_avoidance_rm_less(individual_rm, accident_set, rm):
     acc_rm_T.add(dead_state)
 
     acc_rm = SparseRewardMachine()
-    acc_rm.U = acc_rm_u
+    acc_rm.set_states(acc_rm_u)
     acc_rm.events = acc_rm_e
     acc_rm.T = acc_rm_T
     acc_rm.u0 = acc_rm_u0
@@ -931,7 +1085,7 @@ def get_accident_avoidance_rm_less_2(individual_rm, accident_set, rm):
     acc_rm_T.add(dead_state)
 
     acc_rm = SparseRewardMachine()
-    acc_rm.U = acc_rm_u
+    acc_rm.set_states(acc_rm_u)
     acc_rm.events = acc_rm_e
     acc_rm.T = acc_rm_T
     acc_rm.u0 = acc_rm_u0
@@ -1,12 +1,13 @@
 import itertools 
 
 import reward_machines.task_assignment.helper_functions as hf
+from reward_machines.task_assignment.rm_cache import RMCache
 
 
 ### Holds Configurations class that holds the task assignment experiment details and decomposition metric
 
 class Configurations():
-    def __init__(self, num_agents, rm, enforced_set = None, forbidden_set = None, agent_utility_function = None, weights = None , incompatible_pairs = None, include_all = True):
+    def __init__(self, num_agents, rm, enforced_set = None, forbidden_set = None, agent_utility_function = None, weights = None , incompatible_pairs = None, include_all = True, break_symmetry = True, rm_cache_size = 1024):
         '''
         This is for experiment parameters that do not change throughout the experiment. 
         Also for defining functions for calculating scores
@@ -18,6 +19,9 @@ class Configurations():
         forbidden_set: {(event, agent)}, set that cannot be assigned (must be removed from knapsack) 
         agent_utility_function: (dict)
         weights: list len 3 with ints. [shared events, fairness, utility] weights of importance 
+        break_symmetry: if True, the tree search only explores one of the assignments that differ by 
+                        swapping interchangeable agents (see get_interchangeable_agents)
+        rm_cache_size: number of entries kept by each LRU cache of rm_cache (0 disables caching)
         
 
         Attributes:
@@ -36,6 +40,18 @@ class Configurations():
             agent_utility_function: {agent: {event: utility} }
             total_utility_score: sum of all the agents utility 
 
+            Bitmask encoding of knapsacks (see hf.get_event_bits), used by the tree search and the scores:
+            event_list: [(e,a)], event_list[i] is bit i
+            event_bits: {(e,a): 1 << i}
+            all_events_mask: mask of all_events
+            agent_events: {agent: [(bit, event)]} 
+            agent_masks: {agent: mask of the (e, agent) events}
+
+            break_symmetry: bool
+            interchangeable_agents: [[agents]] classes of agents that can be swapped without changing any score or constraint
+
+            rm_cache: (RMCache) projections, strategy RMs and win-ability results of the tree search, rm_cache.get_stats() has its hits and misses
+
         '''
         self.rm = rm 
         self.num_agents = num_agents
@@ -99,68 +115,239 @@ class Configurations():
         self.restrictions = {'enforced_assignments': self.enforced_set, 'incompatible_assignments': self.incompatible_pairs, 'forbidden_assingments': self.forbidden_set}
         self.type = 'no_accidents'
 
+        # enforced/forbidden assignments are included so any knapsack can be encoded
+        self.event_list, self.event_bits = hf.get_event_bits(self.all_events | self.enforced_set | self.forbidden_set)
+        self.all_events_mask = hf.get_mask_from_knapsack(self.event_bits, self.all_events)
+        self.agent_events = {a: [] for a in self.agents}
+        for (e, a), bit in self.event_bits.items():
+            if a in self.agent_events and bit & self.all_events_mask:
+                self.agent_events[a].append((bit, e))
+        self.agent_masks = {a: hf.get_mask_from_knapsack(self.event_bits, [(e, a) for bit, e in bit_events]) for a, bit_events in self.agent_events.items()}
+
+        self.break_symmetry = break_symmetry
+        self.interchangeable_agents = self.get_interchangeable_agents()
+
+        self.rm_cache = RMCache(rm_cache_size)
+
     
+    def get_fail_first_events(self):
+        '''
+        future_events reordered so that the events few agents can keep come first (most constrained first), 
+        ties broken by name. Giving such an event away quickly makes the task unwinnable, so the tree search 
+        cuts doomed subtrees close to the root and reaches valid knapsacks sooner. Used by the anytime search.
+        '''
+        num_keepers = {} # {event: number of agents that can keep it}
+        for e, a in list(self.future_events) + list(self.enforced_set):
+            num_keepers[e] = num_keepers.get(e, 0) + 1
+        return sorted(self.future_events, key = lambda ea: (num_keepers[ea[0]], str(ea)))
+
+    def get_interchangeable_agents(self):
+        '''
+        Groups the agents that have the same enforced events, forbidden events and utilities. 
+        Swapping two such agents in a knapsack changes neither its validity nor its score.
+        Returns [[agents]], only classes with at least two agents, each in agent order
+        '''
+        classes = {}
+        for a in self.agents:
+            signature = (frozenset(e for e, b in self.enforced_set if b == a), 
+                         frozenset(e for e, b in self.forbidden_set if b == a), 
+                         tuple(sorted(self.agent_utility_function.get(a, {}).items(), key = lambda item: str(item[0]))))
+            classes.setdefault(signature, []).append(a)
+        return [agents for agents in classes.values() if len(agents) > 1]
+
+    def get_symmetry_breaking_pairs(self, future_events):
+        '''
+        Lex-leader constraints for the tree search over future_events. Within a class of interchangeable 
+        agents, the kept events of each agent are compared as a vector over the class' shared future events, 
+        ordered by when the tree has decided the event for every agent of the class. Only knapsacks where 
+        these vectors do not increase from one agent to the next (in agent order) are canonical, every 
+        knapsack has exactly one canonical permutation of interchangeable agents.
+        Returns [[(position, bit_a, bit_b)]], one list per pair of consecutive agents a, b of a class, 
+                position is the number of decided future_events needed to compare the entry
+        '''
+        if not self.break_symmetry:
+            return []
+        position = {ea: i for i, ea in enumerate(future_events)}
+        pairs = []
+        for agents in self.interchangeable_agents:
+            shared_events = [e for e in self.rm.events if all((e, a) in position for a in agents)]
+            decided_at = {e: max(position[(e, a)] for a in agents) + 1 for e in shared_events}
+            shared_events.sort(key = lambda e: decided_at[e])
+            for a, b in zip(agents, agents[1:]):
+                pairs.append([(decided_at[e], self.event_bits[(e, a)], self.event_bits[(e, b)]) for e in shared_events])
+        return pairs
+
+    def is_canonical(self, knapsack, num_decided, symmetry_breaking_pairs):
+        '''
+        False if the decided part of knapsack already breaks one of the symmetry_breaking_pairs 
+        (see get_symmetry_breaking_pairs), i.e. a permutation of interchangeable agents is searched instead
+        knapsack: set of (e,a) or its mask 
+        '''
+        mask = self.get_knapsack_mask(knapsack)
+        for pair in symmetry_breaking_pairs:
+            for decided_at, bit_a, bit_b in pair:
+                if decided_at > num_decided:
+                    break
+                kept_a, kept_b = not mask & bit_a, not mask & bit_b
+                if kept_a != kept_b:
+                    if kept_b: 
+                        return False
+                    break
+        return True
+
     def get_utility(self, agent, event):
         return self.agent_utility_function[agent][event]
         
+    def get_knapsack_mask(self, knapsack):
+        '''
+        returns the bitmask of knapsack ({(e,a)} or [(e,a)]), masks are returned as they are
+        '''
+        if isinstance(knapsack, int):
+            return knapsack
+        return hf.get_mask_from_knapsack(self.event_bits, knapsack)
+
+    def get_knapsack_from_mask(self, mask):
+        return hf.get_knapsack_from_mask(self.event_list, mask)
+
+    def get_event_spaces(self, knapsack):
+        '''
+        Same as hf.get_event_spaces_from_knapsack(self.all_events, knapsack), computed on the bitmask.
+        knapsack: set of (e,a) or its mask 
+        '''
+        kept_mask = self.all_events_mask & ~self.get_knapsack_mask(knapsack)
+        return hf.get_event_spaces_from_mask(self.agent_events, kept_mask)
+
+    def get_mask_utility(self, mask):
+        '''
+        sum of the utilities of the (e,a) events in mask
+        '''
+        utility = 0
+        while mask:
+            low_bit = mask & -mask
+            e, a = self.event_list[low_bit.bit_length() - 1]
+            utility += self.get_utility(a, e)
+            mask ^= low_bit
+        return utility
+        
     def get_shared_event_score(self, knapsack):
         '''
         returns score of shared events
         we are hoping to minimize shared events 
         => maximize relative knapsack size
+        knapsack: set of (e,a) or its mask 
         '''
         if self.max_knapsack_size == 0:
             return 0
-        se_score = len(knapsack) / self.max_knapsack_size # technically this is above the max knapsack size according to our decomposition constraints
+        se_score = self.get_knapsack_mask(knapsack).bit_count() / self.max_knapsack_size # technically this is above the max knapsack size according to our decomposition constraints
         #print("se score", se_score, " max ", config.max_knapsack_size )
         return se_score
 
-    def get_fairness_score(self, knapsack, event_spaces_dict): 
-        kept_events = self.all_events - knapsack
+    def get_fairness_score(self, knapsack, event_spaces_dict = None): 
+        '''
+        knapsack: set of (e,a) or its mask. The kept events of each agent are counted on the mask, 
+        event_spaces_dict is no longer needed. 
+        '''
+        kept_mask = self.all_events_mask & ~self.get_knapsack_mask(knapsack)
+        num_kept = kept_mask.bit_count()
 
-        if len(kept_events) == 0:
+        if num_kept == 0:
             return 1
 
-        #event_spaces, event_spaces_dict = self.get_event_spaces_from_knapsack()
-        avg = len(kept_events) / self.num_agents
+        avg = num_kept / self.num_agents
 
         top_sum = 0
-        for i in event_spaces_dict.values():
-            top_sum += abs(len(i) - avg)
+        for agent_mask in self.agent_masks.values():
+            agent_kept = (kept_mask & agent_mask).bit_count()
+            if agent_kept: # agents without kept events have no event space
+                top_sum += abs(agent_kept - avg)
 
-        return 1 - ( top_sum / len(kept_events))
+        return 1 - ( top_sum / num_kept)
 
     def get_utility_score(self, knapsack):
         '''
         calculates a normalized total utility of the "kept events" and
         normalizes it to the total possible utility score
         We are trying to maximize knapsack score
+        knapsack: set of (e,a) or its mask 
         '''
         if self.total_utility_score == 0:
             return 0
-        knapsack_utility_score = 0
-        remaining_events = self.all_events - knapsack
-
-        for i in remaining_events: #SHOULD NOT BE KNAPSACK, should be kept events 
-            e, a = i 
-            us = self.get_utility(a,e) 
-            knapsack_utility_score += us
-
-        return knapsack_utility_score / self.total_utility_score
+        kept_mask = self.all_events_mask & ~self.get_knapsack_mask(knapsack)
+        return self.get_mask_utility(kept_mask) / self.total_utility_score
 
     def get_score(self, knapsack):
         '''
         combine the other three scores, weighted with weights. 
+        knapsack: set of (e,a) or its mask 
         '''
-        event_spaces, event_spaces_dict = hf.get_event_spaces_from_knapsack(self.all_events, knapsack)
+        mask = self.get_knapsack_mask(knapsack)
 
-        se  = self.get_shared_event_score(knapsack)
-        f = self.get_fairness_score(knapsack, event_spaces_dict)
-        u = self.get_utility_score(knapsack)
+        se  = self.get_shared_event_score(mask)
+        f = self.get_fairness_score(mask)
+        u = self.get_utility_score(mask)
         
         se_weight, f_weight, u_weight = self.weights
         score = se * se_weight + f * f_weight + u * u_weight
 
         #print(f"se score is:, {se} , f score is: {f}, u score is: {u}, for a total of {score}")
         
-        return score 
+        return score
+
+    def get_score_upper_bound(self, knapsack, future_events):
+        '''
+        Upper bound on get_score for every knapsack that extends knapsack with some of 
+        future_events (the assignments that are still undecided at a tree node). 
+        Used to cut subtrees of the tree search that can not beat the current best scores.
+        knapsack, future_events: sets/lists of (e,a) or their masks
+
+        Each term is bounded on its own:
+            shared events: largest when every future event goes into the knapsack
+            utility: the fixed kept events plus every future event with a positive utility
+            fairness: with N kept events, agent a keeps between lo_a and hi_a of them, so 
+                      |n_a - N/num_agents| is at least the distance from N/num_agents to [lo_a, hi_a] 
+                      (0 if lo_a = 0, agents with no kept events are not counted). Maximized over N.
+        '''
+        knapsack = self.get_knapsack_mask(knapsack)
+        future_events = self.get_knapsack_mask(future_events)
+        fixed_kept = self.all_events_mask & ~knapsack & ~future_events
+
+        # shared events 
+        if self.max_knapsack_size == 0:
+            se_bounds = (0, 0)
+        else:
+            se_bounds = (knapsack.bit_count() / self.max_knapsack_size, (knapsack | future_events).bit_count() / self.max_knapsack_size)
+
+        # utility 
+        if self.total_utility_score == 0:
+            u_bounds = (0, 0)
+        else:
+            fixed_utility = self.get_mask_utility(fixed_kept)
+            low, high = fixed_utility, fixed_utility
+            for e, a in self.get_knapsack_from_mask(future_events):
+                low += min(self.get_utility(a, e), 0)
+                high += max(self.get_utility(a, e), 0)
+            u_bounds = sorted((low / self.total_utility_score, high / self.total_utility_score))
+
+        # fairness 
+        lo = {a: (fixed_kept & agent_mask).bit_count() for a, agent_mask in self.agent_masks.items()}
+        hi = {a: lo[a] + (future_events & agent_mask).bit_count() for a, agent_mask in self.agent_masks.items()}
+        f_max = -float('inf')
+        for n in range(sum(lo.values()), sum(hi.values()) + 1):
+            if n == 0:
+                f_max = 1
+                continue
+            avg = n / self.num_agents
+            top_sum = 0
+            for a in self.agents:
+                if lo[a] > 0:
+                    top_sum += max(lo[a] - avg, 0, avg - hi[a])
+            f_max = max(f_max, 1 - (top_sum / n))
+        f_bounds = (-float('inf'), f_max) # only the upper bound is tight enough to use
+
+        score = 0
+        for weight, (low, high) in zip(self.weights, (se_bounds, f_bounds, u_bounds)):
+            if weight > 0:
+                score += weight * high
+            elif weight < 0:
+                score += weight * low
+        return score
@@ -87,7 +87,7 @@ def get_trivial_decomposition(configs, file_location, file_name):
     # Now I have what I want to return
     # You should sitll probably do a decomposition check right now... 
 
-    rm_p = bis.put_many_in_parallel(proj_rm_list)
+    rm_p = bis.LazyParallelRewardMachine(proj_rm_list)
     if bis.is_decomposable(configs.rm, rm_p, agent_event_spaces_dict, configs.num_agents, enforced_set = configs.enforced_set): 
         return rm_file_list, proj_rm_list, agent_event_spaces_dict, knap_score
     else:
@@ -136,7 +136,7 @@ def get_random_decomposition(configs, file_location, file_name): # I am by far t
                 # Now I have what I want to return
 
                 # You should sitll probably do a decomposition check right now... 
-                rm_p = bis.put_many_in_parallel(proj_rm_list)
+                rm_p = bis.LazyParallelRewardMachine(proj_rm_list)
 
                 if bis.is_decomposable(configs.rm, rm_p, agent_event_spaces_dict, configs.num_agents, enforced_set = configs.enforced_set, incompatible_pairs= configs.incompatible_pairs, upcomming_events= []): 
                     decomposition_success = True
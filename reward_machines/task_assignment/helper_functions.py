@@ -43,6 +43,57 @@ def get_sack_from_dict(dict):
     return knapsack
         
 
+### bitmask knapsacks: bit i of a mask is set if event_list[i] is in the knapsack ###
+
+def get_event_bits(all_events):
+    '''
+    all_events = {(event, agent)..}
+    Returns 
+        event_list: [(e,a)] all_events in a fixed (sorted) order, event_list[i] is bit i
+        event_bits: {(e,a): 1 << i}
+    '''
+    event_list = sorted(all_events, key = str)
+    event_bits = {ea: 1 << i for i, ea in enumerate(event_list)}
+    return event_list, event_bits
+
+def get_mask_from_knapsack(event_bits, knapsack = None):
+    '''
+    knapsack = {(e,a)} or [(e,a)], returns the int with the bits of its events set
+    '''
+    mask = 0
+    if knapsack:
+        for ea in knapsack:
+            mask |= event_bits[ea]
+    return mask
+
+def get_knapsack_from_mask(event_list, mask):
+    '''
+    returns the knapsack {(e,a)} encoded by mask 
+    '''
+    knapsack = set()
+    while mask:
+        low_bit = mask & -mask
+        knapsack.add(event_list[low_bit.bit_length() - 1])
+        mask ^= low_bit
+    return knapsack
+
+def get_event_spaces_from_mask(agent_events, kept_mask):
+    '''
+    Same output as get_event_spaces_from_knapsack, from the mask of the kept events
+    (all events that are not in the knapsack).
+    agent_events = {agent: [(bit, event)]}
+    Returns 
+        event_spaces: [{events for agent 1}, {events for agent 2}, ... ] (agents with no kept events are left out)
+        event_spaces_dict: {agent: [events]}
+    '''
+    event_spaces_dict = {}
+    for a, bit_events in agent_events.items():
+        events = [e for bit, e in bit_events if kept_mask & bit]
+        if events:
+            event_spaces_dict[a] = events
+    event_spaces = [set(events) for events in event_spaces_dict.values()]
+    return event_spaces, event_spaces_dict
+
 # this is a silly print function that shows the results of a tree run 
 def print_results(configs, bd):
     # bd has form = (score, [knapsacks with that score])
@@ -0,0 +1,107 @@
+from collections import OrderedDict
+
+import reward_machines.task_assignment.bisimilarity_check as bs
+
+### Memoization of the reward machine operations the tree search repeats on every node ###
+# Sibling knapsacks share most of their event spaces, so the same strategy sets and projections
+# come up over and over. Entries are keyed by (id of the RM, frozenset of events) and keep a
+# reference to the RM, so its id cannot be given to another object while the entry is cached.
+# Cached RMs are shared between callers and must not be modified.
+
+
+class LRUCache:
+    '''
+    Least recently used cache with at most maxsize entries (0 disables it) that counts its hits and misses
+    '''
+    def __init__(self, maxsize = 1024):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default = None):
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return self.entries[key]
+        self.misses += 1
+        return default
+
+    def put(self, key, value):
+        if self.maxsize <= 0:
+            return
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.maxsize:
+            self.entries.popitem(last = False)
+
+    def get_stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self.entries), 'maxsize': self.maxsize}
+
+
+class RMCache:
+    '''
+    LRU caches for bs.project_rm, bs.get_strategy_rm and the win-ability check of a strategy set.
+    Each process has its own entries: pickling a RMCache (e.g. to send Configurations to the workers
+    of the parallel search) only keeps its size, the counters of the workers are added back with add_stats.
+    '''
+    def __init__(self, maxsize = 1024):
+        self.maxsize = maxsize
+        self.projections = LRUCache(maxsize)
+        self.strategy_rms = LRUCache(maxsize)
+        self.win_ability = LRUCache(maxsize)
+
+    def __getstate__(self):
+        return {'maxsize': self.maxsize}
+
+    def __setstate__(self, state):
+        self.__init__(state['maxsize'])
+
+    def _lookup(self, cache, rm, events, compute):
+        key = (id(rm), events)
+        entry = cache.get(key)
+        if entry is not None:
+            return entry[1]
+        value = compute()
+        cache.put(key, (rm, value))
+        return value
+
+    def project_rm(self, event_space, rm):
+        '''
+        bs.project_rm(event_space, rm), cached
+        '''
+        event_space = frozenset(event_space)
+        return self._lookup(self.projections, rm, event_space, lambda: bs.project_rm(set(event_space), rm))
+
+    def get_strategy_rm(self, rm, strategy_set, full_removal = True):
+        '''
+        bs.get_strategy_rm(rm, strategy_set, full_removal), cached
+        '''
+        strategy_set = frozenset(strategy_set)
+        return self._lookup(self.strategy_rms, rm, (strategy_set, full_removal), lambda: bs.get_strategy_rm(rm, set(strategy_set), full_removal = full_removal))
+
+    def can_win(self, rm, strategy_set):
+        '''
+        True if the task of rm can still be finished with only the events in strategy_set, cached
+        '''
+        strategy_set = frozenset(strategy_set)
+        return self._lookup(self.win_ability, rm, strategy_set, lambda: bs.can_win_check(bs.get_strategy_rm(rm, set(strategy_set), full_removal = False)))
+
+    def get_stats(self):
+        '''
+        Returns {'projections'/'strategy_rms'/'win_ability': {'hits', 'misses', 'size', 'maxsize'}}
+        '''
+        return {'projections': self.projections.get_stats(), 'strategy_rms': self.strategy_rms.get_stats(), 'win_ability': self.win_ability.get_stats()}
+
+    def reset_stats(self):
+        for cache in (self.projections, self.strategy_rms, self.win_ability):
+            cache.hits = 0
+            cache.misses = 0
+
+    def add_stats(self, stats):
+        '''
+        Adds the hit and miss counters of stats (from get_stats, e.g. of a worker process) to this cache's
+        '''
+        for name, cache in (('projections', self.projections), ('strategy_rms', self.strategy_rms), ('win_ability', self.win_ability)):
+            cache.hits += stats[name]['hits']
+            cache.misses += stats[name]['misses']
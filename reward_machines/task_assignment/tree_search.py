@@ -1,13 +1,114 @@
 # holds node class which builds the tree
-# also runs the depth first tree search via recursion 
+# also runs the depth first tree search, via recursion or with an explicit stack (traverse_iterative)
+
+import heapq
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 import reward_machines.task_assignment.helper_functions as hf
 import reward_machines.task_assignment.bisimilarity_check as bs
 
 
 
+class SearchBudget:
+    '''
+    Time and node budget of an anytime tree search (traverse_iterative / traverse_parallel).
+    Once either runs out, the search stops and returns the best knapsacks found so far, 
+    and exhausted is set to True (the search was not exhaustive).
+    '''
+    def __init__(self, time_budget_s = None, max_nodes = None, deadline = None, node_counter = None):
+        '''
+        time_budget_s: (float) seconds from now, or deadline: (float) time.time() to stop at
+        max_nodes: (int) number of tree nodes that may be visited
+        node_counter: multiprocessing.Value counting the visited nodes of all processes (parallel search), 
+                      None to count locally
+        '''
+        if deadline is None and time_budget_s is not None:
+            deadline = time.time() + time_budget_s
+        self.deadline = deadline
+        self.max_nodes = max_nodes
+        self.node_counter = node_counter
+        self.num_nodes = 0
+        self.exhausted = False
+
+    def spend_node(self):
+        '''
+        Counts one visited node, returns False (and sets exhausted) if the budget ran out.
+        '''
+        if self.node_counter is not None:
+            with self.node_counter.get_lock():
+                self.node_counter.value += 1
+                self.num_nodes = self.node_counter.value
+        else:
+            self.num_nodes += 1
+        if self.max_nodes is not None and self.num_nodes > self.max_nodes:
+            self.exhausted = True
+        elif self.deadline is not None and time.time() > self.deadline:
+            self.exhausted = True
+        return not self.exhausted
+
+
+class BestSacks:
+    '''
+    The num_solutions best (score, knapsack) found by a tree search, kept in a bounded min-heap of 
+    (score, insertion number, knapsack) so a new knapsack is added in O(log num_solutions). 
+    For equal scores the knapsack found last wins: it replaces the earliest one and is listed after it.
+    '''
+    def __init__(self, num_solutions = 1, shared_threshold = None):
+        '''
+        shared_threshold: multiprocessing.Value holding a score reached by num_solutions knapsacks in some 
+                          process of a parallel search, read by get_threshold and raised when this heap is full
+        '''
+        self.num_solutions = num_solutions
+        self.shared_threshold = shared_threshold
+        self.heap = []
+        self.num_pushed = 0
+
+    def __len__(self):
+        return len(self.heap)
+
+    def is_full(self):
+        return len(self.heap) >= self.num_solutions
+
+    def get_threshold(self):
+        '''
+        Score a knapsack needs to get into the best num_solutions (a tie is enough), -inf while there is room
+        '''
+        threshold = self.heap[0][0] if self.heap and self.is_full() else -float('inf')
+        if self.shared_threshold is not None:
+            threshold = max(threshold, self.shared_threshold.value)
+        return threshold
+
+    def can_accept(self, score):
+        return self.num_solutions > 0 and (not self.is_full() or score >= self.heap[0][0])
+
+    def push(self, score, knapsack):
+        '''
+        Adds (score, knapsack) if it is among the num_solutions best, dropping the worst one. Returns whether it was kept.
+        '''
+        if not self.can_accept(score):
+            return False
+        entry = (score, self.num_pushed, knapsack)
+        self.num_pushed += 1
+        if self.is_full():
+            heapq.heapreplace(self.heap, entry)
+        else:
+            heapq.heappush(self.heap, entry)
+        if self.shared_threshold is not None and self.is_full() and self.heap[0][0] > self.shared_threshold.value:
+            with self.shared_threshold.get_lock():
+                self.shared_threshold.value = max(self.shared_threshold.value, self.heap[0][0])
+        return True
+
+    def get_sorted(self):
+        '''
+        [(score, knapsack)] sorted by score (worst first), ties in the order they were found
+        '''
+        return [(score, knapsack) for score, _, knapsack in sorted(self.heap, key = lambda entry: entry[:2])]
+
+
 class Node:
-    def __init__(self, name = None, children = None, value = -1, knapsack = None, future_events = None, all_events = None, depth = 0, is_vaild = True, doomed = False, is_parent_valid = True):
+    def __init__(self, name = None, children = None, value = -1, knapsack = None, future_events = None, all_events = None, depth = 0, is_vaild = True, doomed = False, is_parent_valid = True, knapsack_mask = None):
         if name: ## 'root' -> next_event_name= self.future_events[0]
             self.name = name
         else: 
@@ -22,8 +123,11 @@ class Node:
 
         if knapsack: ## configs.forbidden_events in 'root' -> new_knapsack knapsack.union({next_event_name}) ONLY FOR v =1 
             self.knapsack = knapsack
+        elif knapsack_mask is not None: ## traverse_iterative, the set is only built when needed (get_knapsack)
+            self.knapsack = None
         else:
             self.knapsack = set()
+        self.knapsack_mask = knapsack_mask ## bitmask of the knapsack over configs.event_list, see get_knapsack_mask
 
         if type(future_events) == list: ## configs.future_events in 'root' -> next_events = self.future_events[1:]
             self.future_events = future_events
@@ -42,6 +146,17 @@ class Node:
         self.is_parent_valid = is_parent_valid
         self.is_valid = is_vaild
         self.strategic_rm = None
+        self.found_sack = None ## (score, knapsack) if visit_last_minute_change put this leaf in best_sacks
+
+    def get_knapsack_mask(self, configs):
+        if self.knapsack_mask is None:
+            self.knapsack_mask = configs.get_knapsack_mask(self.knapsack)
+        return self.knapsack_mask
+
+    def get_knapsack(self, configs):
+        if self.knapsack is None:
+            self.knapsack = configs.get_knapsack_from_mask(self.knapsack_mask)
+        return self.knapsack
 
     def __repr__(self):
         s =  "(" + str(self.name) + ", " + str(self.value) + ")"
@@ -71,7 +186,7 @@ class Node:
         No forbidden set since tree search already has forbidden set in knapsack and no forbidden events in tree search levels
 
         '''
-        event_spaces, agent_event_spaces_dict = hf.get_event_spaces_from_knapsack(configs.all_events, self.knapsack)
+        event_spaces, agent_event_spaces_dict = configs.get_event_spaces(self.get_knapsack_mask(configs))
         
         # Get projected rm to put in parallel 
 
@@ -80,7 +195,7 @@ class Node:
             rm_p = bs.project_rm(es, configs.rm) 
             rms.append(rm_p)
 
-        rm_parallel = bs.put_many_in_parallel(rms) 
+        rm_parallel = bs.LazyParallelRewardMachine(rms) 
 
         is_decomp = True
         #if self.value != 0: # only check if you changed something
@@ -93,7 +208,7 @@ class Node:
         if configs.type != 'no_accidents':
             print("Freak out not ready for accidents yet")
 
-        event_spaces, agent_event_spaces_dict = hf.get_event_spaces_from_knapsack(configs.all_events, self.knapsack)
+        event_spaces, agent_event_spaces_dict = configs.get_event_spaces(self.get_knapsack_mask(configs))
 
         restrictions_pass, have_hope = bs.check_restrictions(configs, agent_event_spaces_dict, self.future_events)
 
@@ -122,8 +237,7 @@ class Node:
         for es in event_spaces:
             strategy_set = strategy_set.union(es)
 
-        strategic_rm = bs.get_strategy_rm(configs.rm, strategy_set, full_removal = False)
-        if  not bs.can_win_check(strategic_rm):
+        if not configs.rm_cache.can_win(configs.rm, strategy_set):
             self.doomed = True
             self.is_valid = False 
             #self.strategic_rm = strategic_rm
@@ -154,7 +268,7 @@ class Node:
                                           
     def run_check_last_minute(self, configs): 
 
-        event_spaces, agent_event_spaces_dict = hf.get_event_spaces_from_knapsack(configs.all_events, self.knapsack)
+        event_spaces, agent_event_spaces_dict = configs.get_event_spaces(self.get_knapsack_mask(configs))
         if self.is_valid:
 
             if self.value != 0:
@@ -182,7 +296,7 @@ class Node:
             self.is_parent_valid = self.is_valid
         
     def run_check_last_minute_2(self, configs):
-        event_spaces, agent_event_spaces_dict = hf.get_event_spaces_from_knapsack(configs.all_events, self.knapsack)
+        event_spaces, agent_event_spaces_dict = configs.get_event_spaces(self.get_knapsack_mask(configs))
         self.event_spaces = event_spaces
         self.agent_event_spaces_dict = agent_event_spaces_dict
         if self.value == -1: # this is the root node
@@ -397,18 +511,38 @@ class Node:
         strategy_set = set()
         for es in self.event_spaces:
             strategy_set = strategy_set.union(es)
-        strategic_rm = bs.get_strategy_rm(configs.rm, strategy_set, full_removal = True)
+        strategic_rm = configs.rm_cache.get_strategy_rm(configs.rm, strategy_set, full_removal = True)
       
         rms = []
         
         for es in self.event_spaces:
-            rm_p = bs.project_rm(es, strategic_rm)  #project each reward machine down onto the event spaces
+            rm_p = configs.rm_cache.project_rm(es, strategic_rm)  #project each reward machine down onto the event spaces
             rms.append(rm_p)
 
-        rm_parallel = bs.put_many_in_parallel(rms) 
+        rm_parallel = bs.LazyParallelRewardMachine(rms) 
         return bs.is_bisimilar(rm_parallel,strategic_rm)
 
-    def traverse_last_minute_change(self, configs, best_sacks = [], num_solutions=1, least_good_sack_score = -1):
+    def can_beat_best_sacks(self, configs, best_sacks):
+        '''
+        Branch and bound: False if no knapsack in this subtree can reach best_sacks.get_threshold() 
+        (the worst kept score once best_sacks is full, a tie can still replace it, or the shared 
+        threshold of a parallel search), so the subtree can be skipped.
+        best_sacks: (BestSacks)
+        '''
+        threshold = best_sacks.get_threshold()
+        if threshold == -float('inf'):
+            return True
+        upper_bound = configs.get_score_upper_bound(self.get_knapsack_mask(configs), self.future_events)
+        return upper_bound >= threshold - 1e-9 # tolerance for float rounding in the scores
+
+    def visit_last_minute_change(self, configs, best_sacks):
+        '''
+        Runs the checks of one tree search node. If it is a valid leaf and good enough, its knapsack 
+        is put in best_sacks (BestSacks) and (score, knapsack) in self.found_sack.
+        Returns True if the children of this node should be searched.
+        '''
+        if not self.can_beat_best_sacks(configs, best_sacks):
+            return False
         self.generate_prints()
 
         self.run_check_last_minute_2(configs)
@@ -416,39 +550,216 @@ class Node:
         
         if not self.doomed:
             if self.future_events:  # Make children if I can
-                next_event_name  = self.future_events[0]
-                next_events = self.future_events[1:]
-                new_depth = self.depth + 1
-                new_knapsack = self.knapsack.union({next_event_name}) # will only be used for child_1
-
-                # Add children
-                child_1 = Node(name = next_event_name, value = 1, knapsack = new_knapsack, future_events = next_events,  depth = new_depth, is_parent_valid= self.is_valid)
-                child_0 = Node(name = next_event_name, value = 0, knapsack = self.knapsack, future_events = next_events,  depth = new_depth, is_parent_valid= self.is_valid)
-                self.add_children([child_1, child_0])
-            else:
-                if self.is_valid: 
-                    knap_score = configs.get_score(self.knapsack)
-                    if knap_score > least_good_sack_score or len(best_sacks) < num_solutions: #fill up the sack
-                        if self.check_is_bisimilar(configs):                            
-                            best_sacks.append((knap_score, self.knapsack)) # max length of num_solutions
-                            best_sacks.sort(key = lambda x: x[0])
-                            if len(best_sacks) > num_solutions:
-                                popped_val = best_sacks.pop(0)
-                                least_good_sack_score = popped_val[0]
-                            else:
-                                least_good_sack_score = best_sacks[0][0]
+                return True
+            if self.is_valid: 
+                knap_score = configs.get_score(self.get_knapsack_mask(configs))
+                if best_sacks.can_accept(knap_score): 
+                    if self.check_is_bisimilar(configs):                            
+                        knapsack = self.get_knapsack(configs)
+                        best_sacks.push(knap_score, knapsack)
+                        self.found_sack = (knap_score, knapsack)
+        return False
+
+    def traverse_last_minute_change(self, configs, best_sacks = None, num_solutions=1):
+        '''
+        Recursive depth first search, returns the num_solutions best [(score, knapsack)] sorted by score.
+        best_sacks: (BestSacks) filled by the search, a new one if None
+        '''
+        if best_sacks is None:
+            best_sacks = BestSacks(num_solutions)
+        if self.visit_last_minute_change(configs, best_sacks):
+            next_event_name  = self.future_events[0]
+            next_events = self.future_events[1:]
+            new_depth = self.depth + 1
+            new_knapsack = self.knapsack.union({next_event_name}) # will only be used for child_1
+
+            # Add children
+            child_1 = Node(name = next_event_name, value = 1, knapsack = new_knapsack, future_events = next_events,  depth = new_depth, is_parent_valid= self.is_valid)
+            child_0 = Node(name = next_event_name, value = 0, knapsack = self.knapsack, future_events = next_events,  depth = new_depth, is_parent_valid= self.is_valid)
+            self.add_children([child_1, child_0])
         
         ### Recursion Step ###
         for child in self.children:
-            best_sacks = child.traverse_last_minute_change(configs, best_sacks = best_sacks, num_solutions=num_solutions, least_good_sack_score=least_good_sack_score)
+            child.traverse_last_minute_change(configs, best_sacks = best_sacks)
         
-        return best_sacks
-
-
-
+        return best_sacks.get_sorted()
 
+    def traverse_iterative(self, configs, best_sacks = None, num_solutions = 1, budget = None):
+        '''
+        Same depth first search (and result) as traverse_last_minute_change, without recursion.
+
+        The stack holds compact records (knapsack bitmask over configs.event_list, number of decided 
+        events, value, is_parent_valid). A Node is only built while its record is visited and children 
+        are never stored, so memory stays proportional to the depth of the tree and deep event lists 
+        do not hit the recursion limit.
+
+        budget: (SearchBudget) makes the search anytime. The child with the higher score upper bound is 
+                then searched first so good knapsacks are found early, and the search stops when the 
+                budget runs out (budget.exhausted). Knapsacks with tied scores can then differ from the 
+                unbudgeted search.
+        best_sacks: (BestSacks) filled by the search, a new one if None
+        Returns the num_solutions best [(score, knapsack)] sorted by score
+        '''
+        if best_sacks is None:
+            best_sacks = BestSacks(num_solutions)
+        for _ in self.iter_decompositions(configs, best_sacks, num_solutions, budget):
+            pass
+        return best_sacks.get_sorted()
 
+    def iter_decompositions(self, configs, best_sacks = None, num_solutions = 1, budget = None):
+        '''
+        Generator version of traverse_iterative: yields (score, knapsack) as soon as a valid, bisimilar 
+        leaf enters the current num_solutions best. Knapsacks are yielded in discovery order, not sorted by 
+        score, and one yielded early can later be pushed out of best_sacks by a better one. The caller can stop iterating at any time, 
+        best_sacks (BestSacks, a new one with num_solutions if None) then holds the best knapsacks found so far. 
+        '''
+        if best_sacks is None:
+            best_sacks = BestSacks(num_solutions)
+        if budget is not None and not budget.spend_node():
+            return
+        expand = self.visit_last_minute_change(configs, best_sacks)
+        if self.found_sack is not None:
+            yield self.found_sack
+        if expand:
+            yield from iter_search_records(configs, self.future_events, self.depth, self.get_child_records(configs, 0), best_sacks, budget = budget)
+
+    def get_child_records(self, configs, num_decided):
+        '''
+        Stack records of the two children of this node, child_0 first so child_1 is popped (searched) first.
+        num_decided: number of events of the search root's future_events decided at this node
+        '''
+        mask = self.get_knapsack_mask(configs)
+        bit = configs.event_bits[self.future_events[0]]
+        return [(mask, num_decided + 1, 0, self.is_valid), (mask | bit, num_decided + 1, 1, self.is_valid)]
 
+    def traverse_parallel(self, configs, num_solutions = 1, num_workers = None, split_depth = 4, budget = None):
+        '''
+        Parallel version of traverse_iterative with the same result. 
+        The nodes above split_depth are searched here, the subtrees below them are searched by a 
+        ProcessPoolExecutor with num_workers processes (None = one per cpu). Workers share the best 
+        known score of num_solutions knapsacks through a shared value, so each one can prune with what 
+        the others found. 
+        Leaves are ranked by (score, depth first search order), which is how traverse_iterative breaks ties.
+        budget: (SearchBudget) as in traverse_iterative, the deadline and node count are shared by all workers
+        '''
+        root_sacks = BestSacks(num_solutions)
+        frontier = []
+        if budget is not None and not budget.spend_node():
+            return []
+        if self.visit_last_minute_change(configs, root_sacks):
+            frontier = search_records(configs, self.future_events, self.depth, self.get_child_records(configs, 0), root_sacks, stop_depth = split_depth, budget = budget)
+        best_sacks = root_sacks.get_sorted()
+        if not frontier:
+            return best_sacks
+
+        # the workers start pruning with the score the search above split_depth already reached,
+        # the subtrees with the highest bound are searched first so the shared score rises early
+        shared_threshold = multiprocessing.Value('d', root_sacks.get_threshold())
+        frontier.sort(key = lambda record: configs.get_score_upper_bound(record[0], self.future_events[record[1]:]), reverse = True)
+        worker_budget = None
+        if budget is not None:
+            worker_budget = (budget.deadline, budget.max_nodes, multiprocessing.Value('q', budget.num_nodes))
+        found = [best_sacks]
+        with ProcessPoolExecutor(max_workers = num_workers, initializer = _init_search_worker, initargs = (configs, self.future_events, self.depth, num_solutions, shared_threshold, worker_budget)) as executor:
+            futures = [executor.submit(_search_subtree, record) for record in frontier]
+            for future in as_completed(futures):
+                worker_best_sacks, worker_exhausted, worker_cache_stats = future.result()
+                configs.rm_cache.add_stats(worker_cache_stats)
+                if worker_exhausted:
+                    budget.exhausted = True
+                found.append(worker_best_sacks)
+                best_sacks = merge_best_sacks(configs, self.future_events, found, num_solutions)
+                found = [best_sacks]
+                if num_solutions > 0 and len(best_sacks) >= num_solutions:
+                    with shared_threshold.get_lock():
+                        shared_threshold.value = max(shared_threshold.value, best_sacks[0][0])
+        if budget is not None:
+            budget.num_nodes = worker_budget[2].value
+        return best_sacks
 
-        
 
+def search_records(configs, future_events, depth, stack, best_sacks, stop_depth = None, budget = None):
+    '''
+    Runs iter_search_records to the end.
+    Returns
+        frontier: (list) the records that were not searched because of stop_depth, in the order they were reached
+    '''
+    frontier = []
+    for _ in iter_search_records(configs, future_events, depth, stack, best_sacks, stop_depth, budget, frontier):
+        pass
+    return frontier
+
+def iter_search_records(configs, future_events, depth, stack, best_sacks, stop_depth = None, budget = None, frontier = None):
+    '''
+    Runs the depth first search of traverse_iterative on a stack of records 
+    (knapsack mask, number of decided future_events, value, is_parent_valid) and yields (score, knapsack) 
+    whenever a leaf enters best_sacks (see Node.iter_decompositions).
+    Inputs
+        future_events: future_events of the search root, depth: its depth
+        best_sacks: (BestSacks) the best knapsacks so far, its threshold (shared with other processes 
+                    in a parallel search) prunes the subtrees that can not reach it
+        stop_depth: if given, records with this many decided events are not searched but put in frontier
+        budget: (SearchBudget) if given, children are searched best upper bound first and the search 
+                stops when the budget runs out
+        frontier: (list) the records that were not searched because of stop_depth are appended to it, 
+                  in the order they were reached
+    Records that only differ from an already searched one by swapping interchangeable agents 
+    (configs.is_canonical) are skipped.
+    '''
+    if frontier is None:
+        frontier = []
+    symmetry_breaking_pairs = configs.get_symmetry_breaking_pairs(future_events)
+    while stack:
+        mask, num_decided, value, is_parent_valid = stack.pop()
+        if symmetry_breaking_pairs and not configs.is_canonical(mask, num_decided, symmetry_breaking_pairs):
+            continue
+        if stop_depth is not None and num_decided >= stop_depth:
+            frontier.append((mask, num_decided, value, is_parent_valid))
+            continue
+        if budget is not None and not budget.spend_node():
+            break
+        node = Node(name = future_events[num_decided - 1], value = value, knapsack_mask = mask, future_events = future_events[num_decided:], depth = depth + num_decided, is_parent_valid = is_parent_valid)
+        expand = node.visit_last_minute_change(configs, best_sacks)
+        if node.found_sack is not None:
+            yield node.found_sack
+        if expand:
+            child_records = node.get_child_records(configs, num_decided)
+            if budget is not None: # best first: the child with the higher bound is popped first (child_1 on ties)
+                child_future_events = future_events[num_decided + 1:]
+                child_records.sort(key = lambda record: configs.get_score_upper_bound(record[0], child_future_events))
+            stack.extend(child_records)
+
+def merge_best_sacks(configs, future_events, best_sacks_list, num_solutions):
+    '''
+    Merges best_sacks found on different subtrees into the num_solutions best, ordered like 
+    traverse_iterative orders them: by score, and for equal scores by when the depth first search 
+    (child_1 before child_0) reaches them. 
+    '''
+    future_bits = [configs.event_bits[e] for e in future_events]
+    def rank(sack):
+        score, knapsack = sack
+        mask = configs.get_knapsack_mask(knapsack)
+        dfs_order = tuple(0 if mask & bit else 1 for bit in future_bits) # child_1 (event in the knapsack) is searched first
+        return (score, dfs_order)
+    merged = sorted((sack for best_sacks in best_sacks_list for sack in best_sacks), key = rank)
+    return merged[-num_solutions:] if num_solutions > 0 else []
+
+_search_worker = {}
+
+def _init_search_worker(configs, future_events, depth, num_solutions, shared_threshold, budget):
+    _search_worker.update(configs = configs, future_events = future_events, depth = depth, num_solutions = num_solutions, shared_threshold = shared_threshold, budget = budget)
+
+def _search_subtree(record):
+    '''
+    Searches the subtree under record in a worker process, returns (best_sacks, whether the budget ran out, 
+    hits and misses of the worker's rm_cache during this search)
+    '''
+    w = _search_worker
+    best_sacks = BestSacks(w['num_solutions'], shared_threshold = w['shared_threshold'])
+    budget = None
+    if w['budget'] is not None:
+        deadline, max_nodes, node_counter = w['budget']
+        budget = SearchBudget(deadline = deadline, max_nodes = max_nodes, node_counter = node_counter)
+    w['configs'].rm_cache.reset_stats()
+    search_records(w['configs'], w['future_events'], w['depth'], [record], best_sacks, budget = budget)
+    return best_sacks.get_sorted(), budget is not None and budget.exhausted, w['configs'].rm_cache.get_stats()
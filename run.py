@@ -30,8 +30,10 @@ import pandas as pd
 from utils.plot_utils import generate_plots
 import re
 import torch as th
+from pettingzoo_product_env.pettingzoo_product_env import register_manager, unregister_manager
 from pettingzoo_product_env.overcooked_product_env import OvercookedProductEnv
 from pettingzoo_product_env.buttons_product_env import ButtonsProductEnv
+from pettingzoo_product_env.vectorized_buttons_product_env import VectorizedButtonsProductEnv
 from jaxmarl.environments.overcooked import overcooked_layouts
 from mdp_label_wrappers.overcooked_asymmetric_advantages_labeled import OvercookedAsymmetricAdvantagesLabeled
 from mdp_label_wrappers.overcooked_cramped_corridor_labeled import OvercookedCrampedCorridorLabeled
@@ -82,6 +84,12 @@ parser.add_argument('--seed', type=int, default=-1, help='Seed the runs')
 parser.add_argument('--ucb_c', type=float, default=-1, help='c value for ucb')
 parser.add_argument('--ucb_gamma', type=float, default=-1, help='discount value for ucb_gamma')
 parser.add_argument('--handpicked_decomp',type=str, default="None", help = "Provide an optional handpicked decomposition to be inserted into the generated candidates" )
+parser.add_argument('--decomposition_cache', type=str, default="None", help="Directory for caching generated decompositions across runs. Default is no caching")
+parser.add_argument('--decomposition_workers', type=int, default=1, help="Number of processes searching for decompositions. Default is 1")
+parser.add_argument('--decomposition_time_budget', type=float, default=-1, help="Seconds the decomposition search may take, the best decompositions found by then are used. Default is no limit")
+parser.add_argument('--decomposition_max_nodes', type=int, default=-1, help="Number of search tree nodes the decomposition search may visit. Default is no limit")
+parser.add_argument('--decomposition_cache_stats', type=str2bool, default=False, help="Print the hits and misses of the decomposition search's RM caches (and log them to W&B). Default is off")
+parser.add_argument('--num_vec_envs', type=int, default=0, help="Train the buttons envs on VectorizedButtonsProductEnv with this many episodes at once. Default is 0 (ButtonsProductEnv through supersuit)")
 
 # Add the sweep flag
 parser.add_argument('--sweep', type=str2bool, default=False, help='Set to True when running a W&B sweep.')
@@ -192,9 +200,16 @@ if __name__ == "__main__":
                 for idx, req in enumerate(run_config["required_events"]):
                     required[idx] = req
                 new_initial_rm_states = []
-                train_rm, rm_initial_states = generate_rm_decompositions(
+                train_rm, rm_initial_states, _ = generate_rm_decompositions(
                     train_rm, run_config['num_agents'], top_k=args.num_candidates,
-                    enforced_dict=required, forbidden_dict=forbidden, handpicked_decomp=handpicked_decomp, config=run_config)
+                    enforced_dict=required, forbidden_dict=forbidden, handpicked_decomp=handpicked_decomp, config=run_config,
+                    cache_dir=args.decomposition_cache if args.decomposition_cache != "None" else None,
+                    num_workers=args.decomposition_workers,
+                    time_budget_s=args.decomposition_time_budget if args.decomposition_time_budget > 0 else None,
+                    max_nodes=args.decomposition_max_nodes if args.decomposition_max_nodes > 0 else None,
+                    verbose=args.decomposition_cache_stats)
+                if args.decomposition_cache_stats and run is not None and train_rm.rm_cache_stats is not None:
+                    run.summary["rm_cache_stats"] = train_rm.rm_cache_stats
                 # import pdb; pdb.set_trace()
                 for rm in rm_initial_states:
                     istates = []
@@ -211,6 +226,8 @@ if __name__ == "__main__":
 
             log_dir = os.path.join(method_log_dir_base, f"iteration_{i}_seed_{curr_seed}")
             os.makedirs(log_dir, exist_ok=True)
+            # the train and eval envs (and supersuit's copies of them) all report to this manager
+            register_manager(log_dir, manager)
 
             train_kwargs = {
                 'manager': manager,
@@ -221,16 +238,20 @@ if __name__ == "__main__":
                 'is_monolithic': args.is_monolithic,
                 'render_mode': render_mode,
                 'addl_mono_rm': mono_rm,
+                'manager_key': log_dir,
             }
 
-            if args.env == "buttons":
-                env = ButtonsProductEnv(**train_kwargs)
-            elif args.env == "overcooked":
-                env = OvercookedProductEnv(**train_kwargs)
-
-            env = ss.black_death_v3(env)
-            env = ss.pettingzoo_env_to_vec_env_v1(env)
-            env = ss.concat_vec_envs_v1(env, 1, num_cpus=1, base_class="stable_baselines3")
+            if args.env == "buttons" and args.num_vec_envs > 0:
+                env = VectorizedButtonsProductEnv(**train_kwargs, num_vec_envs=args.num_vec_envs, seed=curr_seed)
+            else:
+                if args.env == "buttons":
+                    env = ButtonsProductEnv(**train_kwargs)
+                elif args.env == "overcooked":
+                    env = OvercookedProductEnv(**train_kwargs)
+
+                env = ss.black_death_v3(env)
+                env = ss.pettingzoo_env_to_vec_env_v1(env)
+                env = ss.concat_vec_envs_v1(env, 1, num_cpus=1, base_class="stable_baselines3")
             env = VecMonitor(env)
 
             eval_kwargs = train_kwargs.copy()
@@ -292,9 +313,12 @@ if __name__ == "__main__":
                 callback_list = CallbackList([eval_callback])
                 print("Wandb Disabled")
 
-            model.learn(total_timesteps=args.timesteps, callback=callback_list, log_interval=10, progress_bar=False)
-            env.close()
-            eval_env.close()
+            try:
+                model.learn(total_timesteps=args.timesteps, callback=callback_list, log_interval=10, progress_bar=False)
+            finally:
+                env.close()
+                eval_env.close()
+                unregister_manager(log_dir)
             # Finish your run
             if args.wandb and not args.sweep:
                 wandb.finish()